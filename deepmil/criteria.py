@@ -1,7 +1,10 @@
 import sys
+import time
+import math
 
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 
 sys.path.append("..")
 
@@ -11,7 +14,8 @@ from reproducibility import force_seed
 
 from shared import announce_msg
 
-__all__ = ["TrainLoss", "KLUniformLoss", "NegativeEntropy", "Metrics"]
+__all__ = ["TrainLoss", "FusedTrainLoss", "KLUniformLoss", "NegativeEntropy",
+           "Metrics", "ConfusionMeter"]
 
 
 class KLUniformLoss(nn.Module):
@@ -117,10 +121,14 @@ class TrainLoss(nn.Module):
                                        mulcoef=mulcoef
                                        )
 
-    def size_const(self, masks_pred):
+    def size_const(self, masks_pred, full_size=None):
         """
         Compute the loss over the size of the masks.
         :param masks_pred: foreground predicted mask. shape: (bs, 1, h, w).
+        :param full_size: None or int. Number of pixels of the input when
+        the mask is at a lower resolution (deepmil.models.ResNet
+        lowres_mask). If the sizes are not normalized, they are rescaled to
+        this number of pixels (the same constraint as at full resolution).
         :return: ELB loss. a scalar that is the sum of the losses over bs.
         """
         assert masks_pred.ndim == 4, "Expected 4 dims, found {}.".format(
@@ -135,19 +143,26 @@ class TrainLoss(nn.Module):
         h = backgmsk.shape[2]
         w = backgmsk.shape[3]
         l1 = torch.abs(backgmsk.contiguous().view(bsz, -1)).sum(dim=1)
+        rescale = (not self.normalize_sz) and (full_size is not None) and (
+                full_size != h * w)
         if self.normalize_sz:
             l1 = l1 / float(h * w)
+        elif rescale:
+            l1 = l1 * (float(full_size) / float(h * w))
 
         l1 = l1 - self.epsilon
-        loss_back = self.elb(-l1)
 
         # foreground
         l1_fg = torch.abs(masks_pred.contiguous().view(bsz, -1)).sum(dim=1)
         if self.normalize_sz:
             l1_fg = l1_fg / float(h * w)
+        elif rescale:
+            l1_fg = l1_fg * (float(full_size) / float(h * w))
 
         l1_fg = l1_fg - self.epsilon
-        loss_fg = self.elb(-l1_fg)
+
+        # both constraints in one call.
+        loss_back, loss_fg = self.elb(- torch.stack((l1, l1_fg), dim=0))
 
         loss = loss_back + loss_fg
 
@@ -177,10 +192,24 @@ class TrainLoss(nn.Module):
                 sc_cl_se,
                 labels,
                 masks_pred,
-                scores_neg=None
+                scores_neg=None,
+                neg_weight=1.,
+                full_size=None
                 ):
         """
         Performs forward function: computes the losses.
+        :param scores_neg: scores of X- or None. If None, the negative branch
+        has been skipped at this step, and the regularization is not
+        computed.
+        :param neg_weight: float >= 0. extra weight of the regularization term
+        at this step. When the negative branch is evaluated only every k steps
+        , it is set to k so the regularization keeps the same expected
+        weight.
+        :param full_size: None or int. Number of pixels of the input when
+        `masks_pred` is at a lower resolution. See self.size_const().
+        :param masks_pred: predicted masks, or None. If None, the masks are
+        not in memory (tiled inference. See deepmil.train.evaluate_tiled()),
+        and the size constraint is not computed.
         """
         # classification loss over the localizer
         loss_cl_seg = self.CE(sc_cl_se, labels)
@@ -193,16 +222,16 @@ class TrainLoss(nn.Module):
 
         # regularization: loss over negative regions.
         loss_neg = torch.tensor([0.])
-        if self.reg_loss is not None:
-            assert scores_neg is not None, "ERROR"
+        if (self.reg_loss is not None) and (scores_neg is not None):
             loss_neg = self.reg_loss(scores_neg)
-            total_loss = total_loss + self.lambda_neg * loss_neg
+            total_loss = total_loss + neg_weight * self.lambda_neg * loss_neg
 
         # constraint on background size.
         loss_sz_con = torch.tensor([0.])
         bsz = float(scores_pos.shape[0])
-        if self.use_size_const:
-            loss_sz_con = self.size_const(masks_pred=masks_pred) / bsz
+        if self.use_size_const and (masks_pred is not None):
+            loss_sz_con = self.size_const(masks_pred=masks_pred,
+                                          full_size=full_size) / bsz
             total_loss = total_loss + loss_sz_con
 
 
@@ -211,6 +240,68 @@ class TrainLoss(nn.Module):
     def __str__(self):
         return "{}()".format(self.__class__.__name__,)
 
+
+class FusedTrainLoss(TrainLoss):
+    """
+    The same loss as TrainLoss computed in one pass over the scores:
+    the scores of the localizer, of X+ and of X- are stacked, and a single
+    log-softmax gives both cross-entropies and the regularization over X- (
+    KL to the uniform distribution, or negative entropy, in log2). The
+    size constraint evaluates the background and the foreground in one call
+    of the ELB. No tensor is allocated on the host at each step (the zero
+    losses are the buffer self.zero).
+
+    The values are the same as TrainLoss up to the rounding (log-softmax
+    instead of log(softmax)).
+    """
+    def forward(self,
+                scores_pos,
+                sc_cl_se,
+                labels,
+                masks_pred,
+                scores_neg=None,
+                neg_weight=1.,
+                full_size=None
+                ):
+        """
+        Performs forward function: computes the losses. See
+        TrainLoss.forward().
+        :return: total_loss, loss_pos, loss_neg, loss_cl_seg.
+        """
+        b = scores_pos.shape[0]
+        use_neg = (self.reg_loss is not None) and (scores_neg is not None)
+        if use_neg:
+            scores = torch.cat((sc_cl_se, scores_pos, scores_neg), dim=0)
+        else:
+            scores = torch.cat((sc_cl_se, scores_pos), dim=0)
+        logprobs = F.log_softmax(scores, dim=1)
+
+        # cross-entropies of the localizer and of X+.
+        nll = - logprobs[:2 * b].gather(
+            1, labels.repeat(2).view(-1, 1)).view(2, b).mean(dim=1)
+        loss_cl_seg, loss_pos = nll[0], nll[1]
+        total_loss = loss_cl_seg + loss_pos
+
+        # regularization: loss over negative regions.
+        loss_neg = self.zero
+        if use_neg:
+            logprobs_neg = logprobs[2 * b:]
+            if isinstance(self.reg_loss, KLUniformLoss):
+                loss_neg = (- logprobs_neg).mean(dim=1).mean()
+            else:  # NegativeEntropy.
+                loss_neg = (logprobs_neg.exp() * logprobs_neg).sum(
+                    dim=1).mean()
+            loss_neg = loss_neg / math.log(2.)  # log2.
+            total_loss = total_loss + neg_weight * self.lambda_neg * loss_neg
+
+        # constraint on background size.
+        if self.use_size_const and (masks_pred is not None):
+            total_loss = total_loss + self.size_const(
+                masks_pred=masks_pred, full_size=full_size) / float(b)
+
+        return total_loss, loss_pos, loss_neg, loss_cl_seg
+
+
 class _LossExtendedLB(nn.Module):
     """
     Extended log-barrier loss (ELB).
@@ -306,36 +397,47 @@ class _LossExtendedLB(nn.Module):
         """
         self.set_t(torch.min(self.t_lb * self.mulcoef, self.max_t))
 
-    def forward(self, fx):
+    def elementwise(self, fx):
         """
-        The forward function.
-        :param fx: pytorch tensor. a vector.
-        :return: real value extended-log-barrier-based loss.
+        Compute the extended-log-barrier of each element of `fx`.
+        Both branches are computed over all the elements, then selected with
+        torch.where(): no index sets (nonzero() synchronizes with the host),
+        no gather/scatter.
+        :param fx: pytorch tensor of any shape.
+        :return: tensor of the same shape as `fx`.
         """
-        assert fx.ndim == 1, "fx.ndim must be 1. found {}.".format(fx.ndim)
-
-        loss_fx = fx * 0.
-
         # vals <= -1/(t**2).
         ct = - (1. / (self.t_lb**2))
+        less = fx <= ct
 
-        idx_less = ((fx < ct) | (fx == ct)).nonzero().squeeze()
-        if idx_less.numel() > 0:
-            val_less = fx[idx_less]
-            loss_less = - (1. / self.t_lb) * torch.log(- val_less)
-            loss_fx[idx_less] = loss_less
+        # The log is evaluated at ct where the other branch is selected: no
+        # nan (and no nan gradient) from log(-fx) with fx >= 0.
+        val_less = torch.where(less, fx, ct.expand_as(fx))
+        loss_less = - (1. / self.t_lb) * torch.log(- val_less)
 
         # vals > -1/(t**2).
-        idx_great = (fx > ct).nonzero().squeeze()
-        if idx_great.numel() > 0:
-            val_great = fx[idx_great]
-            loss_great = self.t_lb * val_great - (1. / self.t_lb) * \
-                torch.log((1. / (self.t_lb**2))) + (1. / self.t_lb)
-            loss_fx[idx_great] = loss_great
+        loss_great = self.t_lb * fx - (1. / self.t_lb) * \
+            torch.log((1. / (self.t_lb**2))) + (1. / self.t_lb)
 
-        loss = loss_fx.sum()
+        return torch.where(less, loss_less, loss_great)
 
-        return loss
+    def forward(self, fx):
+        """
+        The forward function.
+        :param fx: pytorch tensor. a vector, or a matrix (k, n): k
+        constraints (e.g. the background and the foreground sizes) evaluated
+        in one call.
+        :return: real value extended-log-barrier-based loss. If `fx` is a
+        matrix, a vector (k) of the loss of each row.
+        """
+        msg = "fx.ndim must be 1 or 2. found {}.".format(fx.ndim)
+        assert fx.ndim in [1, 2], msg
+
+        loss_fx = self.elementwise(fx)
+        if fx.ndim == 1:
+            return loss_fx.sum()
+
+        return loss_fx.sum(dim=1)
 
     def __str__(self):
         return "{}(): extended-log-barrier-based method.".format(
@@ -487,7 +589,8 @@ class Metrics(nn.Module):
                 masks_pred,
                 masks_trg,
                 avg=False,
-                threshold=None
+                threshold=None,
+                meter=None
                 ):
         """
         The forward function.
@@ -502,6 +605,8 @@ class Metrics(nn.Module):
         by dividing by the total number of samples.
         :param threshold: float. threshold in [0., 1.] or None. if None,
         we use self.threshold. otherwise, we us this threshold.
+        :param meter: None or ConfusionMeter. If not None, the confusion
+        counts of the samples are accumulated in it (dataset-level metrics).
         :return:
             acc: scalar (torch.tensor of size 1). classification
             accuracy (avg or sum).
@@ -554,27 +659,46 @@ class Metrics(nn.Module):
             cur_threshold = threshold
 
         # This class should not be included in any gradient computation.
+        with torch.no_grad():
+            # 2. Dice index in [0, 1], and 3. mIOU: from the confusion
+            # counts of each sample (the same values as self.dice and
+            # self.iou over the foreground and the background).
+            counts = self.confusion(masks_pred=masks_pred,
+                                    masks_trg=masks_trg,
+                                    threshold=cur_threshold)
+
+        return self.forward_counts(scores, labels, counts, avg=avg,
+                                   meter=meter)
+
+    def forward_counts(self, scores, labels, counts, avg=False, meter=None):
+        """
+        Compute the metrics from the confusion counts of the samples (see
+        self.confusion()). Used when the masks are not in memory at once:
+        the counts are accumulated by blocks of pixels.
+        :param scores: matrix (n, nbr_c) of unormalized-scores or probabilities.
+        :param labels: vector of Log integers. The ground truth labels.
+        :param counts: tensor (n, 4). tp, fp, fn, tn of each sample.
+        :param avg: bool If True, the metrics are averaged
+        by dividing by the total number of samples.
+        :param meter: None or ConfusionMeter. See self.forward().
+        :return: acc, dice_forg, dice_back, iou. See self.forward().
+        """
+        n = scores.shape[0]
+        msg = "batch size mismatches. scores {}, counts {} .... " \
+              "[NOT OK]".format(n, counts.shape[0])
+        assert n == counts.shape[0], msg
+
         with torch.no_grad():
             plabels = self.predict_label(scores)  # predicted labels
             # 1. ACC in [0, 1]
             acc = ((plabels - labels) == 0.).float().sum()
 
-            # 2. Dice index in [0, 1]
-            ppixels = self.get_binary_mask(
-                pred_m=masks_pred, threshold=cur_threshold)
-            dice_forg = self.dice(pred_m=ppixels,
-                                  true_m=masks_trg
-                                  ).sum()
-            dice_back = self.dice(pred_m=1. - ppixels,
-                                  true_m=1. - masks_trg
-                                  ).sum()
-
-            # 3. mIOU:
-            # foreground
-            iou_fgr = self.iou(pred_m=ppixels, true_m=masks_trg)
-            # background
-            iou_bgr = self.iou(pred_m=1.-ppixels, true_m=1-masks_trg)
-            iou = (iou_fgr + iou_bgr) / 2.  # avg. over classes (2)
+            if meter is not None:
+                meter.update(counts)
+            dice_forg, dice_back, iou = self.seg_metrics_from_confusion(
+                counts, smooth=self.iou.smooth)
+            dice_forg = dice_forg.sum()
+            dice_back = dice_back.sum()
             iou = iou.sum()
 
             if avg:
@@ -584,6 +708,52 @@ class Metrics(nn.Module):
                 iou = iou / float(n)
         return acc, dice_forg, dice_back, iou
 
+    def confusion(self, masks_pred, masks_trg, threshold):
+        """
+        Compute the confusion counts of the binary segmentation of each
+        sample: true positives, false positives, false negatives, true
+        negatives (the foreground is the positive class).
+
+        Three reductions over the pixels (intersection, predicted size, true
+        size), instead of one intersection and two sums for each Dice/IOU
+        over the foreground and the background.
+        The counts are exact (integers in float) as long as the number of
+        pixels of a mask is < 2^24.
+
+        :param masks_pred: tensor (n, m) of normalized-scores.
+        :param masks_trg: tensor (n, m). binary target masks (float).
+        :param threshold: float. threshold in [0., 1.].
+        :return: tensor (n, 4) float: tp, fp, fn, tn of each sample.
+        """
+        ppixels = self.binarize_mask(masks_pred, threshold)
+        tp = (ppixels * masks_trg).sum(dim=1)
+        psize = ppixels.sum(dim=1)
+        tsize = masks_trg.sum(dim=1)
+        fp = psize - tp
+        fn = tsize - tp
+        tn = float(masks_trg.shape[1]) - psize - fn
+
+        return torch.stack((tp, fp, fn, tn), dim=1)
+
+    @staticmethod
+    def seg_metrics_from_confusion(counts, smooth=1.):
+        """
+        Compute the Dice index of the foreground and the background, and the
+        mean IOU (over both) from confusion counts. See Dice, IOU.
+        :param counts: tensor (..., 4): tp, fp, fn, tn. Per sample (n, 4) or
+        accumulated over a dataset (4).
+        :param smooth: float > 0. smoothing value of the IOU.
+        :return: dice_forg, dice_back, iou: tensors (...).
+        """
+        tp, fp, fn, tn = counts.unbind(dim=-1)
+        dice_forg = (2. * tp) / ((tp + fp) + (tp + fn))
+        dice_back = (2. * tn) / ((tn + fn) + (tn + fp))
+        iou_fgr = (tp + smooth) / ((tp + fp) + (tp + fn) - tp + smooth)
+        iou_bgr = (tn + smooth) / ((tn + fn) + (tn + fp) - tn + smooth)
+        iou = (iou_fgr + iou_bgr) / 2.  # avg. over classes (2)
+
+        return dice_forg, dice_back, iou
+
     def binarize_mask(self, masks_pred, threshold):
         """
         Predict the binary mask for segmentation.
@@ -627,6 +797,49 @@ class Metrics(nn.Module):
         return "{}(): computes ACC, Dice index metrics.".format(
             self.__class__.__name__)
 
+
+class ConfusionMeter(object):
+    """
+    Accumulate the confusion counts (tp, fp, fn, tn) of the binary
+    segmentation over a dataset, on the device (see Metrics.confusion()).
+    The dataset-level Dice indices and mean IOU are computed from the total
+    counts (all the pixels of the dataset), while Metrics.forward() averages
+    the metrics of the samples.
+    """
+    def __init__(self, smooth=1.):
+        """
+        Init. function.
+        :param smooth: float > 0. smoothing value of the IOU.
+        """
+        self.smooth = smooth
+        self.counts = None
+        self.nbr_samples = 0
+
+    def update(self, counts):
+        """
+        Add the counts of some samples.
+        :param counts: tensor (n, 4) (see Metrics.confusion()).
+        """
+        self.nbr_samples += counts.shape[0]
+        counts = counts.detach().double().sum(dim=0)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def compute(self):
+        """
+        Compute the dataset-level metrics.
+        :return: dice_forg, dice_back, iou: floats in [0, 1].
+        """
+        msg = "No counts were accumulated .... [NOT OK]"
+        assert self.counts is not None, msg
+        dice_forg, dice_back, iou = Metrics.seg_metrics_from_confusion(
+            self.counts, smooth=self.smooth)
+        return dice_forg.item(), dice_back.item(), iou.item()
+
+    def reset(self):
+        self.counts = None
+        self.nbr_samples = 0
+
+
 # ====================== TEST =========================================
 
 def test_TrainLoss():
@@ -656,7 +869,60 @@ def test_TrainLoss():
         print(l, l.size())
 
 
-def test__LossExtendedLB():
+def test_FusedTrainLoss(benchmark=False):
+    """
+    Check that FusedTrainLoss gives the same losses and gradients as
+    TrainLoss.
+    :param benchmark: bool. If True, also compare their speed.
+    """
+    force_seed(0, check_cudnn=False)
+    DEVICE = torch.device(
+        "cuda:0" if torch.cuda.is_available() else "cpu")
+    b, c, h, w = 8, 2, 416, 416
+
+    for reg_loss in constants.reg_losses:
+        kwargs = dict(use_reg=True, reg_loss=reg_loss, use_size_const=True,
+                      normalize_sz=True)
+        losses = [TrainLoss(**kwargs).to(DEVICE),
+                  FusedTrainLoss(**kwargs).to(DEVICE)]
+        announce_msg("Testing {} ({})".format(losses[1], reg_loss))
+        scores = torch.randn(3, b, c).to(DEVICE)
+        labels = torch.randint(0, c, (b,)).to(DEVICE)
+        masks_pred = torch.rand(b, 1, h, w).to(DEVICE)
+
+        for scores_neg in [scores[2], scores[2][:3], None]:
+            outs, grads = [], []
+            for loss in losses:
+                x = scores.clone().requires_grad_(True)
+                m = masks_pred.clone().requires_grad_(True)
+                sc_neg = None
+                if scores_neg is not None:
+                    sc_neg = x[2][:scores_neg.shape[0]]
+                out = loss(x[1], x[0], labels, m, sc_neg, neg_weight=2.)
+                out[0].backward()
+                outs.append(out)
+                grads.append((x.grad, m.grad))
+
+            for v_ref, v_fused in zip(*outs):
+                assert torch.allclose(v_ref.to(DEVICE).view(-1),
+                                      v_fused.view(-1), atol=1e-6), \
+                    "{} {}".format(v_ref, v_fused)
+            for g_ref, g_fused in zip(*grads):
+                assert torch.allclose(g_ref, g_fused, atol=1e-6)
+
+        if not benchmark:
+            continue
+        for loss in losses:
+            t0 = time.perf_counter()
+            for _ in range(200):
+                loss(scores[1], scores[0], labels, masks_pred, scores[2])
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            print("{}: {:.3f}ms".format(
+                loss.__class__.__name__, (time.perf_counter() - t0) * 5.))
+
+
+def test__LossExtendedLB(benchmark=False):
     force_seed(0, check_cudnn=False)
     instance = _LossExtendedLB(init_t=1., max_t=10., mulcoef=1.01)
     announce_msg("Testing {}".format(instance))
@@ -677,7 +943,120 @@ def test__LossExtendedLB():
         print("epoch {}. t: {}.".format(r, instance.t_lb))
     print("Loss ELB.sum(): {}".format(out))
 
+    # Compare with the implementation with index sets (before
+    # _LossExtendedLB.elementwise()): values and gradients (and speed if
+    # benchmark).
+    def reference(elb, fx):
+        loss_fx = fx * 0.
+        ct = - (1. / (elb.t_lb ** 2))
+        idx_less = ((fx < ct) | (fx == ct)).nonzero().squeeze()
+        if idx_less.numel() > 0:
+            loss_fx[idx_less] = - (1. / elb.t_lb) * torch.log(- fx[idx_less])
+        idx_great = (fx > ct).nonzero().squeeze()
+        if idx_great.numel() > 0:
+            loss_fx[idx_great] = elb.t_lb * fx[idx_great] - (
+                    1. / elb.t_lb) * torch.log((1. / (elb.t_lb ** 2))) + (
+                    1. / elb.t_lb)
+        return loss_fx.sum()
+
+    # both branches: fx in [-2, 2].
+    fx = (torch.rand(b) * 4. - 2.).to(DEVICE)
+    fx[0] = - (1. / (instance.t_lb.item() ** 2))  # on the boundary.
+    x_ref = fx.clone().requires_grad_(True)
+    x_new = fx.clone().requires_grad_(True)
+    loss_ref, loss_new = reference(instance, x_ref), instance(x_new)
+    loss_ref.backward()
+    loss_new.backward()
+    assert torch.equal(loss_ref, loss_new), "{} {}".format(loss_ref, loss_new)
+    assert torch.equal(x_ref.grad, x_new.grad)
+
+    # batched: background and foreground in one call.
+    fx2 = (torch.rand(2, b) * 4. - 2.).to(DEVICE).requires_grad_(True)
+    loss_rows = instance(fx2)
+    for k in range(2):
+        assert torch.allclose(loss_rows[k], reference(instance, fx2[k]))
+    grad_rows = torch.autograd.grad(loss_rows.sum(), fx2)[0]
+    grad_ref = torch.autograd.grad(reference(instance, fx2[0]) + reference(
+        instance, fx2[1]), fx2)[0]
+    assert torch.allclose(grad_rows, grad_ref)
+
+    if not benchmark:
+        return
+    fx2 = fx2.detach()
+    for name, func in [("index sets", lambda: reference(instance, fx2[0]) +
+                        reference(instance, fx2[1])),
+                       ("torch.where", lambda: instance(fx2[0]) +
+                        instance(fx2[1])),
+                       ("torch.where batched", lambda: instance(fx2).sum())]:
+        t0 = time.perf_counter()
+        for _ in range(1000):
+            func()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print("{}: {:.3f}ms".format(name, (time.perf_counter() - t0)))
+
+
+def test_Metrics_confusion(benchmark=False):
+    """
+    Check that the Dice indices and the mean IOU computed from the confusion
+    counts are the same as with Dice and IOU, per sample and over a dataset
+    (ConfusionMeter).
+    :param benchmark: bool. If True, also compare their speed.
+    """
+    force_seed(0, check_cudnn=False)
+    DEVICE = torch.device(
+        "cuda:0" if torch.cuda.is_available() else "cpu")
+    metrics = Metrics(threshold=0.5).to(DEVICE)
+    announce_msg("Testing {}".format(metrics))
+
+    b, m = 8, 416 * 416
+    masks_pred = torch.rand(b, m).to(DEVICE)
+    masks_trg = (torch.rand(b, m) > 0.6).float().to(DEVICE)
+    masks_trg[0] = 0.  # empty target.
+
+    def reference(masks_pred=masks_pred, masks_trg=masks_trg):
+        ppixels = metrics.get_binary_mask(masks_pred)
+        dice_forg = metrics.dice(ppixels, masks_trg)
+        dice_back = metrics.dice(1. - ppixels, 1. - masks_trg)
+        iou = (metrics.iou(ppixels, masks_trg) + metrics.iou(
+            1. - ppixels, 1 - masks_trg)) / 2.
+        return dice_forg, dice_back, iou
+
+    def from_counts():
+        counts = metrics.confusion(masks_pred, masks_trg, 0.5)
+        return metrics.seg_metrics_from_confusion(counts)
+
+    for x, y in zip(reference(), from_counts()):
+        assert torch.equal(x, y), "{} {}".format(x, y)
+
+    meter = ConfusionMeter()
+    for k in range(b):
+        metrics(scores=torch.rand(1, 2).to(DEVICE),
+                labels=torch.zeros(1).long().to(DEVICE),
+                masks_pred=masks_pred[k: k + 1],
+                masks_trg=masks_trg[k: k + 1],
+                meter=meter)
+    assert meter.nbr_samples == b
+    # dataset-level: all the pixels of the dataset as one sample.
+    refs = reference(masks_pred.view(1, -1), masks_trg.view(1, -1))
+    for x, y in zip(refs, meter.compute()):
+        assert abs(x.item() - y) < 1e-6, "{} {}".format(x.item(), y)
+
+    if not benchmark:
+        return
+    for name, func in [("Dice/IOU", reference), ("confusion", from_counts)]:
+        t0 = time.perf_counter()
+        for _ in range(100):
+            func()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print("{}: {:.3f}ms".format(
+            name, (time.perf_counter() - t0) * 10.))
+
+
 if __name__ == "__main__":
     # test_TrainLoss()
     test__LossExtendedLB()
+    test_Metrics_confusion()
+    test_FusedTrainLoss()
 
@@ -1,4 +1,5 @@
 import threading
+import time
 
 
 import numpy as np
@@ -13,7 +14,45 @@ thread_lock = threading.Lock()  # lock for threads to protect the instruction th
 import reproducibility
 
 
-__all__ = ["WildCatPoolDecision", "ClassWisePooling"]
+__all__ = ["WildCatPoolDecision", "ClassWisePooling", "find_selection_crossover"]
+
+
+# Strategies to select the kmax/kmin features in WildCatPoolDecision.
+SORT = "sort"
+TOPK = "topk"
+KTHVALUE = "kthvalue"
+AUTO = "auto"
+
+SELECTIONS = [SORT, TOPK, KTHVALUE, AUTO]
+
+# Default crossovers of the `auto` selection. They depend on the device and the version of torch: measure them with
+# find_selection_crossover() (printed by test_wildcat_selection()) and pass them to WildCatPoolDecision.
+MIN_N_SELECTION = 64  # below this number of features, a full sort is as fast as anything else.
+MAX_RATIO_SELECTION = 0.5  # above this ratio k / n, a full sort is as fast as a partial selection.
+
+
+def sum_k_extreme(activations, k, largest=True):
+    """
+    Sum the k largest (or smallest) values of `activations` along the last dimension without sorting.
+    We get the k-th value (threshold) using torch.kthvalue(), then we sum the values strictly above (below) the
+    threshold and complete with the threshold itself to account for the ties.
+
+    :param activations: tensor of size (b, c, n).
+    :param k: int in [1, n].
+    :param largest: bool. If True, sum the k largest values. Else, the k smallest.
+    :return: tensor of size (b, c).
+    """
+    n = activations.shape[-1]
+    if largest:
+        thres = torch.kthvalue(activations, n - k + 1, dim=-1, keepdim=True)[0]
+        selected = (activations > thres).type_as(activations)
+    else:
+        thres = torch.kthvalue(activations, k, dim=-1, keepdim=True)[0]
+        selected = (activations < thres).type_as(activations)
+
+    ties = float(k) - selected.sum(-1)
+
+    return (activations * selected).sum(-1) + ties * thres.squeeze(-1)
 
 
 class WildCatPoolDecision(nn.Module):
@@ -21,7 +60,8 @@ class WildCatPoolDecision(nn.Module):
     Reference to wildcat pooling:
     http://webia.lip6.fr/~cord/pdfs/publis/Durand_WILDCAT_CVPR_2017.pdf
     """
-    def __init__(self, kmax=0.5, kmin=None, alpha=1, dropout=0.0):
+    def __init__(self, kmax=0.5, kmin=None, alpha=1, dropout=0.0, selection=AUTO, min_n_selection=MIN_N_SELECTION,
+                 max_ratio_selection=MAX_RATIO_SELECTION):
         """
         Input:
             kmax: int or float scalar. The number of maximum features to consider.
@@ -29,6 +69,12 @@ class WildCatPoolDecision(nn.Module):
             consider.
             alpha: float scalar. A weight , used to compute the final score.
             dropout: float scalar. If not zero, a dropout is performed over the min and max selected features.
+            selection: str. How to select the kmax/kmin features: `sort` (full sort), `topk` (partial selection),
+            `kthvalue` (k-th value threshold, only without an active dropout) or `auto` (pick one depending on n,
+            k and the device). See self.get_selection().
+            min_n_selection: int. With `auto`, below this number of features, the full sort is used.
+            max_ratio_selection: float in ]0, 1]. With `auto`, above this ratio k / n, the full sort is used.
+            See find_selection_crossover() to measure both.
         """
         super(WildCatPoolDecision, self).__init__()
 
@@ -36,10 +82,15 @@ class WildCatPoolDecision(nn.Module):
         assert kmin is None or (isinstance(kmin, (int, float)) and kmin >= 0), "kmin must be None or the same type " \
                                                                                "as " \
                                                                                "kmax, and it must be >= 0 or None"
+        assert selection in SELECTIONS, "selection must be in {}. found {} .... [NOT OK]".format(SELECTIONS,
+                                                                                                 selection)
         self.kmax = kmax
         self.kmin = kmax if kmin is None else kmin
         self.alpha = alpha
         self.dropout = dropout
+        self.selection = selection
+        self.min_n_selection = min_n_selection
+        self.max_ratio_selection = max_ratio_selection
 
         self.dropout_md = nn.Dropout(p=dropout, inplace=False)
 
@@ -57,53 +108,151 @@ class WildCatPoolDecision(nn.Module):
         else:
             return int(k)
 
-    def forward(self, x, seed=None, prngs_cuda=None):
+    def get_selection(self, n, k, use_dropout, is_cuda):
+        """
+        Pick the strategy used to select the features.
+
+        - A full sort is O(n log n). It is the fastest only when k is close to n.
+        - topk is a partial selection. It is fast when k is small compared to n, and it is the best choice on GPU
+        (radix-select).
+        - kthvalue is a quick-select O(n) on CPU. We only get the k-th value then sum everything above it.
+        Since the selected features are not materialized, it can not be used when the dropout is active.
+
+        :param n: int, number of features (h * w).
+        :param k: int, max(kmax, kmin).
+        :param use_dropout: bool. if True, the dropout is active.
+        :param is_cuda: bool. if True, the features are on GPU.
+        :return: str, a selection strategy.
+        """
+        if self.selection != AUTO:
+            if self.selection == KTHVALUE and use_dropout:
+                return TOPK
+            return self.selection
+
+        if n < self.min_n_selection or k >= n * self.max_ratio_selection:
+            return SORT
+        if is_cuda or use_dropout:
+            return TOPK
+        return KTHVALUE
+
+    def apply_dropout(self, features, seed=None, prngs_cuda=None, generator=None):
+        """
+        Apply the dropout over the selected features.
+        :param features: tensor.
+        :param seed: int, seed for the thread to guarantee reproducibility over a fixed number of gpus.
+        :param prngs_cuda: value returned by torch.cuda.get_prng_state().
+        :param generator: CPU torch.Generator or None. If not None (and seed is None), the dropout mask is drawn from
+        it instead of the global generator (see reproducibility.SeedStream). The mask is drawn on CPU, then moved to
+        the device of the features (it is small: only the selected features).
+        :return: tensor.
+        """
+        if (seed is None) and (generator is not None):
+            if not self.dropout_md.training:
+                return features
+
+            keep = 1. - self.dropout
+            if keep <= 0.:
+                return features * 0.
+
+            mask = torch.empty(features.shape).bernoulli_(keep, generator=generator)
+            mask = mask.to(device=features.device, dtype=features.dtype).div_(keep)
+
+            return features * mask
+
+        if seed is not None:
+            thread_lock.acquire()
+            assert prngs_cuda is not None, "`prngs_cuda` is expected to not be None. Exiting .... [NOT OK]"
+            prng_state = (torch.cuda.get_rng_state().cpu())
+            reproducibility.force_seed(seed)
+            torch.cuda.set_rng_state(prngs_cuda.cpu())
+
+            features = self.dropout_md(features)  # instruction that causes randomness.
+
+            reproducibility.force_seed(seed)
+            torch.cuda.set_rng_state(prng_state)
+            thread_lock.release()
+        else:
+            features = self.dropout_md(features)
+
+        return features
+
+    def forward(self, x, seed=None, prngs_cuda=None, generator=None, sizes=None):
         """
         Input:
             In the case of K classes:
                 x: torch tensor of size (n, c, h, w), where n is the batch size, c is the number of classes,
                 h is the height of the feature map, w is its width.
             seed: int, seed for the thread to guarantee reproducibility over a fixed number of gpus.
+            generator: CPU torch.Generator or None. Generator for the dropout. See self.apply_dropout().
+            sizes: None or list of tuples (h_k, w_k): the valid region (top-left) of each map of a padded batch (see
+            loader.pad_collate). Each map is pooled over its valid region only. If None, the entire maps.
         Output:
             scores: torch vector of size (k). Contains the wildcat score of each class. A score is a linear combination
             of different features. The class with the highest features is the winner.
         """
         b, c, h, w = x.shape
+        if (sizes is not None) and any([tuple(sz) != (h, w) for sz in sizes]):
+            # the padding must not enter the selection (nor n): one sample at a time.
+            return torch.cat([self(x[k: k + 1, :, :hk, :wk].contiguous(), seed=seed, prngs_cuda=prngs_cuda,
+                                   generator=generator) for k, (hk, wk) in enumerate(sizes)], dim=0)
+
         activations = x.view(b, c, h * w)
 
         n = h * w
 
-        sorted_features = torch.sort(activations, dim=-1, descending=True)[0]
         kmax = self.get_k(self.kmax, n)
         kmin = self.get_k(self.kmin, n)
+        use_min = kmin > 0 and self.alpha != 0.
+        use_dropout = self.dropout != 0. and self.dropout_md.training
+
+        selection = self.get_selection(n, max(kmax, kmin if use_min else 0), use_dropout, x.is_cuda)
+
+        sum_min = None
+        if selection == SORT:
+            sorted_features = torch.sort(activations, dim=-1, descending=True)[0]
 
-        # dropout
-        if self.dropout != 0.:
-            if seed is not None:
-                thread_lock.acquire()
-                assert prngs_cuda is not None, "`prngs_cuda` is expected to not be None. Exiting .... [NOT OK]"
-                prng_state = (torch.cuda.get_rng_state().cpu())
-                reproducibility.force_seed(seed)
-                torch.cuda.set_rng_state(prngs_cuda.cpu())
+            # dropout
+            if self.dropout != 0.:
+                sorted_features = self.apply_dropout(sorted_features, seed=seed, prngs_cuda=prngs_cuda,
+                                                     generator=generator)
 
-                sorted_features = self.dropout_md(sorted_features)  # instruction that causes randomness.
+            sum_max = sorted_features.narrow(-1, 0, kmax).sum(-1)
+            if use_min:
+                sum_min = sorted_features.narrow(-1, n - kmin, kmin).sum(-1)
 
-                reproducibility.force_seed(seed)
-                torch.cuda.set_rng_state(prng_state)
-                thread_lock.release()
-            else:
-                sorted_features = self.dropout_md(sorted_features)
+        elif selection == TOPK:
+            selected = torch.topk(activations, kmax, dim=-1, largest=True, sorted=False)[0]
+            if use_min:
+                selected = torch.cat(
+                    (selected, torch.topk(activations, kmin, dim=-1, largest=False, sorted=False)[0]), dim=-1)
 
-        scores = sorted_features.narrow(-1, 0, kmax).sum(-1).div_(kmax)
+            # dropout: over the selected features only. Each one of them is still dropped independently with the
+            # same probability as in the full sort.
+            if self.dropout != 0.:
+                selected = self.apply_dropout(selected, seed=seed, prngs_cuda=prngs_cuda, generator=generator)
 
-        if kmin > 0 and self.alpha != 0.:
-            scores.add(sorted_features.narrow(-1, n - kmin, kmin).sum(-1).mul_(self.alpha / kmin)).div_(2.)
+            sum_max = selected.narrow(-1, 0, kmax).sum(-1)
+            if use_min:
+                sum_min = selected.narrow(-1, kmax, kmin).sum(-1)
+
+        elif selection == KTHVALUE:
+            sum_max = sum_k_extreme(activations, kmax, largest=True)
+            if use_min:
+                sum_min = sum_k_extreme(activations, kmin, largest=False)
+
+        else:
+            raise ValueError("Unsupported selection {} .... [NOT OK]".format(selection))
+
+        scores = sum_max.div_(kmax)
+
+        if use_min:
+            scores.add(sum_min.mul_(self.alpha / kmin)).div_(2.)
 
         return scores
 
     def __repr__(self):
-        return self.__class__.__name__ + "(kmax={}, kmin={}, alpha={}, dropout={}".format(self.kmax, self.kmin,
-                                                                                          self.alpha, self.dropout)
+        return self.__class__.__name__ + "(kmax={}, kmin={}, alpha={}, dropout={}, selection={}".format(
+            self.kmax, self.kmin, self.alpha, self.dropout, self.selection)
 
 
 class ClassWisePooling(nn.Module):
@@ -133,6 +282,122 @@ class ClassWisePooling(nn.Module):
         return self.__class__.__name__ + '(classes={}, modalities={})'.format(self.C, self.M)
 
 
+def find_selection_crossover(device, c=2, nbr_runs=20, sizes=(4, 6, 8, 12, 16, 24, 32, 48, 64),
+                             ratios=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)):
+    """
+    Measure the crossovers of the `auto` selection of WildCatPoolDecision on a device: the full sort against the
+    partial selection that `auto` picks above them (topk on cuda, kthvalue on cpu), without dropout.
+    :param device: torch.device.
+    :param c: int, number of classes.
+    :param nbr_runs: int, number of runs of each timing.
+    :param sizes: list of int, sides of the (square) maps.
+    :param ratios: list of floats, ratios k / n.
+    :return: min_n_selection, max_ratio_selection: the smallest n from which the partial selection is faster than the
+    sort (with the smallest ratio), and the largest ratio up to which it is faster (with the largest n). To be passed
+    to WildCatPoolDecision.
+    """
+    partial = TOPK if device.type == "cuda" else KTHVALUE
+
+    def timing(selection, n, ratio):
+        side = int(round(n ** 0.5))
+        x = torch.randn(1, c, side, side, device=device)
+        func = WildCatPoolDecision(kmax=ratio, kmin=0., dropout=0., selection=selection).to(device)
+        func.eval()
+        with torch.no_grad():
+            func(x)  # warm up.
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            for _ in range(nbr_runs):
+                func(x)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+        return time.perf_counter() - t0
+
+    min_n = None
+    for side in sizes:
+        if timing(partial, side * side, ratios[0]) < timing(SORT, side * side, ratios[0]):
+            min_n = side * side
+            break
+    if min_n is None:  # the sort is always faster.
+        return (sizes[-1] ** 2) + 1, ratios[0]
+
+    max_ratio = ratios[0]
+    for ratio in ratios:
+        if timing(partial, sizes[-1] ** 2, ratio) >= timing(SORT, sizes[-1] ** 2, ratio):
+            break
+        max_ratio = ratio
+
+    return min_n, max_ratio
+
+
+def test_wildcat_selection(benchmark=False, nbr_runs=20):
+    """
+    Check that all the selection strategies of WildCatPoolDecision give the same scores as the full sort (without
+    dropout), and the same average scores with dropout, for a few map sizes and number of classes.
+    Maps: 13x13 (training, crop 416), 25x19 (evaluation, ~800x600), 60x60 (large evaluation images).
+    :param benchmark: bool. If True, also time the strategies, and measure the crossovers of `auto` on the device
+    (see find_selection_crossover()).
+    :param nbr_runs: int > 0, number of runs of each timing.
+    """
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    def run(func, x):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        for _ in range(nbr_runs if benchmark else 1):
+            out = func(x)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return out, (time.perf_counter() - t0) / float(nbr_runs if benchmark else 1)
+
+    for c in [2, 200]:
+        for b, h, w in [(8, 13, 13), (1, 25, 19), (1, 60, 60)]:
+            for kmax, kmin, alpha in [(0.3, 0., 0.6), (0.1, 0.1, 0.6)]:
+                x = torch.randn(b, c, h, w, device=DEVICE)
+                ref = None
+                msg = "c {}, x ({}, {}, {}), kmax {}, kmin {}:".format(c, b, h, w, kmax, kmin)
+                for selection in [SORT, TOPK, KTHVALUE, AUTO]:
+                    func = WildCatPoolDecision(kmax=kmax, kmin=kmin, alpha=alpha, dropout=0.,
+                                               selection=selection).to(DEVICE)
+                    func.eval()
+                    with torch.no_grad():
+                        out, t = run(func, x)
+                    if ref is None:
+                        ref = out
+                    assert torch.allclose(ref, out, atol=1e-5), (ref - out).abs().max().item()
+                    msg += " {}: {:.6f}s".format(selection, t)
+                if benchmark:
+                    print(msg)
+
+    # Crossovers of `auto` (measured on this device if benchmark): same scores as the full sort.
+    min_n, max_ratio = MIN_N_SELECTION, MAX_RATIO_SELECTION
+    if benchmark:
+        min_n, max_ratio = find_selection_crossover(DEVICE, nbr_runs=nbr_runs)
+    for n_sel, ratio_sel in [(min_n, max_ratio), (1, 1.)]:  # (1, 1.): never the sort.
+        x = torch.randn(2, 2, 25, 19, device=DEVICE)
+        for kmax in [0.1, 0.3, 0.7]:
+            ref = WildCatPoolDecision(kmax=kmax, kmin=kmax, dropout=0., selection=SORT)(x)
+            out = WildCatPoolDecision(kmax=kmax, kmin=kmax, dropout=0., selection=AUTO, min_n_selection=n_sel,
+                                      max_ratio_selection=ratio_sel)(x)
+            assert torch.allclose(ref, out, atol=1e-5), (ref - out).abs().max().item()
+    if benchmark:
+        print("Measured crossover on {}: min_n_selection={}, max_ratio_selection={} (defaults: {}, {}).".format(
+            DEVICE, min_n, max_ratio, MIN_N_SELECTION, MAX_RATIO_SELECTION))
+
+    # Dropout: same distribution. The average score over many draws must match the one of the full sort.
+    x = torch.randn(4, 2, 13, 13, device=DEVICE)
+    avg = []
+    for selection in [SORT, TOPK]:
+        reproducibility.force_seed(0)
+        func = WildCatPoolDecision(kmax=0.3, kmin=0., dropout=0.5, selection=selection).to(DEVICE)
+        func.train()
+        avg.append(torch.stack([func(x) for _ in range(2000)]).mean(dim=0))
+    diff = (avg[0] - avg[1]).abs().max().item()
+    assert diff < 0.05, "Dropout. max diff. of the average scores sort/topk: {} .... [NOT OK]".format(diff)
+
+
 if __name__ == "__main__":
     b, c = 10, 2
     reproducibility.force_seed(0)
@@ -142,3 +407,5 @@ if __name__ == "__main__":
         out = func(x)
         print(func.__class__.__name__, '->', out.size(), out)
 
+    test_wildcat_selection()
+
@@ -31,6 +31,7 @@
 import threading
 import sys
 import math
+import time
 import os
 import collections
 import numbers
@@ -41,7 +42,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-from tools import check_if_allow_multgpu_mode, announce_msg
+from tools import check_if_allow_multgpu_mode, announce_msg, StageTimer
 
 sys.path.append("..")
 
@@ -75,6 +76,29 @@ else:
         announce_msg("Synchronized BN has been deactivated.\n"
                      "MultiGPU mode has been deactivated. {} GPUs".format(torch.cuda.device_count()))
 
+
+class ChunkedBatchNorm2d(BatchNorm2d):
+    """
+    BatchNorm2d that can normalize its input batch as `chunks` independent
+    sub-batches (in training mode).
+
+    Used when X+ and X- are concatenated along the batch axis and sent
+    through the classifier trunk in one pass: each one of them has to be
+    normalized with its own batch statistics (and update the running stats.
+    in the same order), exactly as if they were forwarded separately.
+    In evaluation mode, the running stats. are used, so the batch is never
+    split.
+    """
+    chunks = None  # None or list of the sizes of the sub-batches.
+
+    def forward(self, input):
+        if self.chunks is None or not self.training:
+            return super(ChunkedBatchNorm2d, self).forward(input)
+
+        return torch.cat([super(ChunkedBatchNorm2d, self).forward(x_c)
+                          for x_c in input.split(self.chunks, dim=0)], dim=0)
+
+
 # DEFAULT SEGMENTATION PARAMETERS ###########################
 
 INNER_FEATURES = 256  # ASPPModule
@@ -112,10 +136,10 @@ class BasicBlock(nn.Module):
     def __init__(self, inplanes, planes, stride=1, downsample=None):
         super(BasicBlock, self).__init__()
         self.conv1 = conv3x3(inplanes, planes, stride)
-        self.bn1 = BatchNorm2d(planes)
+        self.bn1 = ChunkedBatchNorm2d(planes)
         self.relu = nn.ReLU(inplace=True)
         self.conv2 = conv3x3(planes, planes)
-        self.bn2 = BatchNorm2d(planes)
+        self.bn2 = ChunkedBatchNorm2d(planes)
         self.downsample = downsample
         self.stride = stride
 
@@ -144,12 +168,12 @@ class Bottleneck(nn.Module):
     def __init__(self, inplanes, planes, stride=1, downsample=None):
         super(Bottleneck, self).__init__()
         self.conv1 = nn.Conv2d(inplanes, planes, kernel_size=1, bias=False)
-        self.bn1 = BatchNorm2d(planes)
+        self.bn1 = ChunkedBatchNorm2d(planes)
         self.conv2 = nn.Conv2d(planes, planes, kernel_size=3, stride=stride,
                                padding=1, bias=False)
-        self.bn2 = BatchNorm2d(planes)
+        self.bn2 = ChunkedBatchNorm2d(planes)
         self.conv3 = nn.Conv2d(planes, planes * 4, kernel_size=1, bias=False)
-        self.bn3 = BatchNorm2d(planes * 4)
+        self.bn3 = ChunkedBatchNorm2d(planes * 4)
         self.relu = nn.ReLU(inplace=True)
         self.downsample = downsample
         self.stride = stride
@@ -184,15 +208,67 @@ class WildCatClassifierHead(nn.Module):
     def __init__(self, inplans, modalities, num_classes, kmax=0.5, kmin=None, alpha=0.6, dropout=0.0):
         super(WildCatClassifierHead, self).__init__()
 
+        self.num_classes = num_classes
+        self.modalities = modalities
         self.to_modalities = nn.Conv2d(inplans, num_classes * modalities, kernel_size=1, bias=True)
         self.to_maps = ClassWisePooling(num_classes, modalities)
         self.wildcat = WildCatPoolDecision(kmax=kmax, kmin=kmin, alpha=alpha, dropout=dropout)
 
-    def forward(self, x, seed=None, prngs_cuda=None):
+        # If True, in evaluation mode, the 1x1 conv. and the class-wise
+        # pooling are replaced by one 1x1 conv. (see self.get_folded_conv()).
+        self.fold = False
+        self._folded = None  # cache: (key of the params, weight, bias).
 
-        modalities = self.to_modalities(x)
-        maps = self.to_maps(modalities)
-        scores = self.wildcat(x=maps, seed=seed, prngs_cuda=prngs_cuda)
+    def get_folded_conv(self):
+        """
+        Fold ClassWisePooling into the 1x1 conv. self.to_modalities: both are
+        linear, so the mean over the modalities of the conv. is the conv. with
+        the weights (and biases) averaged over the modalities.
+        The folded params. are cached, and computed again when the params.
+        change (in-place update, new storage after .to(), load_state_dict()).
+        They do not carry gradients: inference only.
+        :return: weight (num_classes, inplans, 1, 1), bias (num_classes).
+        """
+        conv = self.to_modalities
+        key = (conv.weight._version, conv.bias._version, conv.weight.data_ptr(), conv.bias.data_ptr())
+        if self._folded is None or self._folded[0] != key:
+            with torch.no_grad():
+                weight = conv.weight.view(self.num_classes, self.modalities, *conv.weight.shape[1:]).mean(dim=1)
+                bias = conv.bias.view(self.num_classes, self.modalities).mean(dim=1)
+            self._folded = (key, weight, bias)
+        return self._folded[1], self._folded[2]
+
+    def check_folding(self, name=""):
+        """
+        Check numerically that the folded conv. gives the same maps as the
+        conv. followed by the class-wise pooling, and report the
+        multiply-accumulates (MACs) per position of the maps of both.
+        :param name: str, name of the head in the report.
+        """
+        weight, bias = self.get_folded_conv()
+        x = torch.randn(2, weight.shape[1], 7, 7, device=weight.device)
+        with torch.no_grad():
+            maps = self.to_maps(self.to_modalities(x))
+            maps_folded = F.conv2d(x, weight, bias)
+        diff = (maps - maps_folded).abs().max().item()
+        msg = "Folding of {} is not equivalent. max diff: {} .... [NOT OK]".format(name, diff)
+        assert torch.allclose(maps, maps_folded, atol=1e-4, rtol=1e-4), msg
+
+        inplans, c, m = weight.shape[1], self.num_classes, self.modalities
+        macs = inplans * c * m + c * m  # conv. + average over the modalities.
+        macs_folded = inplans * c
+        announce_msg("Folding {}: {} --> {} MACs per position (x{:.2f} fewer). max diff: {:.2e} .... [OK]".format(
+            name, macs, macs_folded, macs / float(macs_folded), diff))
+
+    def forward(self, x, seed=None, prngs_cuda=None, generator=None, sizes=None):
+
+        if self.fold and not self.training:
+            maps = F.conv2d(x, *self.get_folded_conv())
+        else:
+            modalities = self.to_modalities(x)
+            maps = self.to_maps(modalities)
+        scores = self.wildcat(x=maps, seed=seed, prngs_cuda=prngs_cuda,
+                              generator=generator, sizes=sizes)
 
         return scores, maps
 
@@ -229,6 +305,115 @@ class MaskHead(nn.Module):
         return masks
 
 
+def get_resize_weights(size_in, size_out, device):
+    """
+    Compute the indices and the weights of the linear interpolation along one
+    axis, as F.interpolate(mode='bilinear', align_corners=ALIGN_CORNERS):
+        out[i] = l0[i] * in[i0[i]] + l1[i] * in[i1[i]].
+    :param size_in: int, size of the input along the axis.
+    :param size_out: int, size of the output along the axis.
+    :param device: torch.device of the outputs.
+    :return: i0, i1 (long tensors (size_out)), l0, l1 (double tensors
+    (size_out)).
+    """
+    dst = torch.arange(size_out, dtype=torch.float64)
+    if ALIGN_CORNERS:
+        scale = (size_in - 1) / float(size_out - 1) if size_out > 1 else 0.
+        src = dst * scale
+    else:
+        scale = size_in / float(size_out)
+        src = ((dst + 0.5) * scale - 0.5).clamp(min=0.)
+
+    i0 = src.floor().long().clamp(max=size_in - 1)
+    i1 = (i0 + 1).clamp(max=size_in - 1)
+    l1 = src - i0.double()
+    l0 = 1. - l1
+
+    return i0.to(device), i1.to(device), l0.to(device), l1.to(device)
+
+
+def resize_adjoint(grad, size):
+    """
+    Apply the adjoint of the bilinear resize (from `size` to the size of
+    `grad`) to `grad`: the gradient of the input of F.interpolate().
+    The resize is separable: its adjoint scatters each value of `grad` back
+    to the (two) rows, then the (two) columns it was interpolated from, with
+    the same fixed weights (see get_resize_weights()). No autograd graph is
+    built.
+    :param grad: tensor (n, c, h_s, w_s).
+    :param size: tuple (h, w). size of the input of the resize.
+    :return: tensor (n, c, h, w).
+    """
+    n, c, h_s, w_s = grad.shape
+    h, w = size
+
+    # rows: (n, c, h_s, w_s) --> (n, c, h, w_s).
+    i0, i1, l0, l1 = get_resize_weights(h, h_s, grad.device)
+    rows = grad.new_zeros((n, c, h, w_s))
+    rows.index_add_(2, i0, grad * l0.to(grad.dtype).view(1, 1, -1, 1))
+    rows.index_add_(2, i1, grad * l1.to(grad.dtype).view(1, 1, -1, 1))
+
+    # columns: (n, c, h, w_s) --> (n, c, h, w).
+    j0, j1, m0, m1 = get_resize_weights(w, w_s, grad.device)
+    out = grad.new_zeros((n, c, h, w))
+    out.index_add_(3, j0, rows * m0.to(grad.dtype).view(1, 1, 1, -1))
+    out.index_add_(3, j1, rows * m1.to(grad.dtype).view(1, 1, 1, -1))
+
+    return out
+
+
+class MaskDownscale(torch.autograd.Function):
+    """
+    Fused application of a mask and its complement over an image, and
+    bilinear downscale of both (to the input resolution of the classifier):
+        out[:b] = resize(x * mask), out[b:] = resize(x * (1 - mask)).
+    The result is written into one buffer (2b, c, h_s, w_s) that can be
+    classified in one pass (see ResNet.classify_stacked()).
+
+    Unlike ResNet.apply_mask() followed by ResNet.classify(), the two
+    full-resolution masked images are not kept: one full-resolution buffer
+    is reused for both in the forward, and nothing but the inputs is saved
+    for the backward.
+    The backward is written by hand, using the linearity of the resize (R):
+        grad_mask = sum_c x * R^T(g_pos - g_neg)
+        grad_x = R^T(g_neg) + mask * R^T(g_pos - g_neg)
+    """
+    @staticmethod
+    def forward(ctx, x, mask, size):
+        """
+        :param x: tensor (b, c, h, w). the image.
+        :param mask: tensor (b, 1, h, w). the mask.
+        :param size: tuple (h_s, w_s). the size of the outputs.
+        :return: tensor (2b, c, h_s, w_s): X+ then X-, downscaled.
+        """
+        b = x.shape[0]
+        out = x.new_empty((2 * b, x.shape[1]) + tuple(size))
+        tmp = x * mask
+        out[:b] = F.interpolate(input=tmp, size=size, mode='bilinear',
+                                align_corners=ALIGN_CORNERS)
+        torch.mul(x, 1. - mask, out=tmp)
+        out[b:] = F.interpolate(input=tmp, size=size, mode='bilinear',
+                                align_corners=ALIGN_CORNERS)
+        ctx.save_for_backward(x, mask)
+
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, mask = ctx.saved_tensors
+        b = x.shape[0]
+        size = tuple(x.shape[2:])
+        grad_x = grad_mask = None
+
+        # R^T(g_pos - g_neg): one adjoint for both terms.
+        diff = resize_adjoint(grad_out[:b] - grad_out[b:], size)
+        if ctx.needs_input_grad[1]:
+            grad_mask = (x * diff).sum(dim=1, keepdim=True)
+        if ctx.needs_input_grad[0]:
+            grad_x = resize_adjoint(grad_out[b:], size) + mask * diff
+
+        return grad_x, grad_mask, None
+
 
 class ResNet(nn.Module):
     def __init__(self,
@@ -242,13 +427,29 @@ class ResNet(nn.Module):
                  kmax=0.5,
                  kmin=None,
                  alpha=0.6,
-                 dropout=0.0
+                 dropout=0.0,
+                 batch_pos_neg=False,
+                 lowres_mask=False,
+                 fused_mask=False
                  ):
         """
         Init. function.
         :param block: class of the block.
         :param layers: list of int, number of layers per block.
         :param num_masks: int, number of masks to output. (supports only 1).
+        :param batch_pos_neg: bool. If True, X+ and X- are concatenated
+        along the batch axis and classified in one single pass through the
+        trunk (see self.classify_pos_neg()).
+        :param lowres_mask: bool. If True, in training mode, M+ is upsampled
+        to the input resolution of the classifier (`scale`) instead of the
+        resolution of the input. The mask is applied to the downscaled input
+        (instead of downscaling the masked input). The mask returned by
+        self.forward() is then at this low resolution. In evaluation mode,
+        the mask is always at the resolution of the input.
+        :param fused_mask: bool. If True, X+ and X- are computed and
+        downscaled to the input resolution of the classifier in one fused
+        operation (see MaskDownscale) when all the samples are used for X-
+        (single GPU).
         """
 
         # classifier stuff
@@ -274,6 +475,9 @@ class ResNet(nn.Module):
 
         self.scale = scale
         self.num_classes = num_classes
+        self.batch_pos_neg = batch_pos_neg
+        self.lowres_mask = lowres_mask
+        self.fused_mask = fused_mask
 
 
         self.inplanes = 128
@@ -282,13 +486,13 @@ class ResNet(nn.Module):
         # Encoder
 
         self.conv1 = conv3x3(3, 64, stride=2)
-        self.bn1 = BatchNorm2d(64)
+        self.bn1 = ChunkedBatchNorm2d(64)
         self.relu1 = nn.ReLU(inplace=True)
         self.conv2 = conv3x3(64, 64)
-        self.bn2 = BatchNorm2d(64)
+        self.bn2 = ChunkedBatchNorm2d(64)
         self.relu2 = nn.ReLU(inplace=True)
         self.conv3 = conv3x3(64, 128)
-        self.bn3 = BatchNorm2d(128)
+        self.bn3 = ChunkedBatchNorm2d(128)
         self.relu3 = nn.ReLU(inplace=True)
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
 
@@ -352,6 +556,10 @@ class ResNet(nn.Module):
                                           )
         # ======================================================================
 
+        # Timers of the stages of the forward (disabled by default). See
+        # tools.StageTimer.
+        self.timer = StageTimer(enabled=False)
+
     def _make_layer(self, block, planes, blocks, stride=1, dilation=1,
                     multi_grid=1):
         downsample = None
@@ -359,7 +567,7 @@ class ResNet(nn.Module):
             downsample = nn.Sequential(
                 nn.Conv2d(self.inplanes, planes * block.expansion,
                           kernel_size=1, stride=stride, bias=False),
-                BatchNorm2d(planes * block.expansion)
+                ChunkedBatchNorm2d(planes * block.expansion)
             )
 
         layers = []
@@ -370,7 +578,8 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x, code=None, mask_c=None, seed=None, prngs_cuda=None):
+    def forward(self, x, code=None, mask_c=None, seed=None, prngs_cuda=None,
+                neg_ratio=1., generator=None, valid=None):
         """
         Forward function.
 
@@ -401,25 +610,108 @@ class ResNet(nn.Module):
         In the case of one GPU, the seed in not necessary (and it will not be
          used); se set it to None.
         :param prngs_cuda: value returned by torch.cuda.get_prng_state().
+        :param neg_ratio: float in [0, 1]. Ratio of the samples of the batch
+        over which X- is classified. 1.: all the samples. 0.: X- is not
+        classified at all (scores_neg is None). In ]0, 1[: a random subset
+        of the samples is used (at least one). Used during training to
+        reduce the cost of the negative branch (see
+        deepmil.train.get_neg_branch_schedule()).
+        :param generator: CPU torch.Generator or None. If not None, and
+        seed is None, all the randomness of the forward (wildcat dropout,
+        subset of X-) is drawn from it instead of the global generator.
+        See reproducibility.SeedStream.
+        :param valid: None or tensor (nb_batch, 2) of long. The valid region
+        (h, w) (top-left) of each image of a padded batch (see
+        loader.pad_collate). Used in evaluation: the mask of each image is
+        normalized over its valid region, and the wildcat poolings ignore the
+        padding. The outputs of an image do not depend on the other images of
+        the batch. If None, the images are not padded.
         :return:
         """
         if code is None:
+            # Low-resolution path (training): the mask, X+ and X- are
+            # computed at the input resolution of the classifier.
+            lowres = self.lowres_mask and self.training
+            size = self.get_classifier_size(x.shape[2], x.shape[3]) if \
+                lowres else None
+            ratios = self.get_valid_ratios(valid, x.shape[2], x.shape[3])
+
             # 1. Segment: forward.
-            mask, cl_scores_seg = self.segment(x=x,
+            with self.timer.stage("segment"):
+                mask, cl_scores_seg = self.segment(x=x,
+                                                   seed=seed,
+                                                   prngs_cuda=prngs_cuda,
+                                                   generator=generator,
+                                                   size=size,
+                                                   ratios=ratios
+                                                   )
+
+            if self.fused_mask and (not lowres) and (seed is None) and (
+                    neg_ratio >= 1.):
+                return self.forward_fused_mask(x, mask, cl_scores_seg,
+                                               generator=generator,
+                                               ratios=ratios)
+
+            with self.timer.stage("get_mask_xpos_xneg"):
+                if lowres:
+                    x = F.interpolate(input=x, size=size, mode='bilinear',
+                                      align_corners=ALIGN_CORNERS)
+                mask, x_pos, x_neg = self.get_mask_xpos_xneg(x, mask,
+                                                             ratios=ratios)
+
+            if neg_ratio <= 0.:
+                with self.timer.stage("classify_pos"):
+                    scores_pos = self.classify(x=x_pos,
                                                seed=seed,
-                                               prngs_cuda=prngs_cuda
+                                               prngs_cuda=prngs_cuda,
+                                               generator=generator,
+                                               resized=lowres,
+                                               ratios=ratios
+                                               )
+                return scores_pos, None, mask, cl_scores_seg
+
+            ratios_neg = ratios
+            if neg_ratio < 1.:
+                b = x_neg.shape[0]
+                nbr_neg = max(1, int(math.ceil(neg_ratio * b)))
+                if generator is not None:
+                    idx = torch.randperm(b, generator=generator)[:nbr_neg]
+                    idx = idx.to(x_neg.device)
+                else:
+                    idx = torch.randperm(b, device=x_neg.device)[:nbr_neg]
+                x_neg = x_neg[idx]
+                if ratios is not None:
+                    ratios_neg = [ratios[j] for j in idx.tolist()]
+
+            if self.batch_pos_neg:
+                with self.timer.stage("classify_pos_neg"):
+                    scores_pos, scores_neg = self.classify_pos_neg(
+                        x_pos=x_pos,
+                        x_neg=x_neg,
+                        seed=seed,
+                        prngs_cuda=prngs_cuda,
+                        generator=generator,
+                        resized=lowres,
+                        ratios_pos=ratios,
+                        ratios_neg=ratios_neg
+                    )
+            else:
+                with self.timer.stage("classify_pos"):
+                    scores_pos = self.classify(x=x_pos,
+                                               seed=seed,
+                                               prngs_cuda=prngs_cuda,
+                                               generator=generator,
+                                               resized=lowres,
+                                               ratios=ratios
+                                               )
+                with self.timer.stage("classify_neg"):
+                    scores_neg = self.classify(x=x_neg,
+                                               seed=seed,
+                                               prngs_cuda=prngs_cuda,
+                                               generator=generator,
+                                               resized=lowres,
+                                               ratios=ratios_neg
                                                )
-
-            mask, x_pos, x_neg = self.get_mask_xpos_xneg(x, mask)
-
-            scores_pos = self.classify(x=x_pos,
-                                    seed=seed,
-                                    prngs_cuda=prngs_cuda
-                                    )
-            scores_neg = self.classify(x=x_neg,
-                                    seed=seed,
-                                    prngs_cuda=prngs_cuda
-                                    )
 
             return scores_pos, scores_neg, mask, cl_scores_seg
 
@@ -427,29 +719,74 @@ class ResNet(nn.Module):
             return self.get_mask_xpos_xneg(x, mask_c)
 
         if code == "segment":
-            return self.segment(x=x, seed=seed, prngs_cuda=prngs_cuda)
+            return self.segment(x=x, seed=seed, prngs_cuda=prngs_cuda,
+                                generator=generator)
 
         if code == "classify":
-            return self.classify(x=x, seed=seed, prngs_cuda=prngs_cuda)
+            return self.classify(x=x, seed=seed, prngs_cuda=prngs_cuda,
+                                 generator=generator)
 
         raise ValueError("You seem to have figure it out how to use model.forward() using multiGPU. However, "
                          "you provided an unsupported code {}. Please double check. This is the list of supported "
                          "codes: None, 'get_mask_xpos_xneg', 'segment', 'classify'. Exiting .... [NOT OK]")
 
-    def get_mask_xpos_xneg(self, x, mask_c):
+    def forward_fused_mask(self, x, mask_c, cl_scores_seg, generator=None,
+                           ratios=None):
+        """
+        End of self.forward() (after the segmentation) where X+ and X- are
+        computed and downscaled at once (MaskDownscale), then classified.
+        :param x: input X.
+        :param mask_c: continous mask (M+).
+        :param cl_scores_seg: scores of the segmentor.
+        :param ratios: see self.get_valid_ratios().
+        :return: see self.forward().
+        """
+        b, _, h, w = x.shape
+        with self.timer.stage("get_mask_xpos_xneg"):
+            mask = self.get_pseudo_binary_mask(
+                mask_c, sizes=self.get_valid_sizes(ratios, h, w))
+            x_pos_neg = MaskDownscale.apply(x, mask,
+                                            self.get_classifier_size(h, w))
+
+        if self.batch_pos_neg:
+            with self.timer.stage("classify_pos_neg"):
+                scores_pos, scores_neg = self.classify_stacked(
+                    x_pos_neg, b, generator=generator, resized=True,
+                    ratios=None if ratios is None else ratios + ratios)
+        else:
+            with self.timer.stage("classify_pos"):
+                scores_pos = self.classify(x=x_pos_neg[:b],
+                                           generator=generator,
+                                           resized=True,
+                                           ratios=ratios
+                                           )
+            with self.timer.stage("classify_neg"):
+                scores_neg = self.classify(x=x_pos_neg[b:],
+                                           generator=generator,
+                                           resized=True,
+                                           ratios=ratios
+                                           )
+
+        return scores_pos, scores_neg, mask, cl_scores_seg
+
+    def get_mask_xpos_xneg(self, x, mask_c, ratios=None):
         """
         Compute X+, X-.
         :param x: input X.
         :param mask_c: continous mask.
+        :param ratios: see self.get_valid_ratios().
         :return:
         """
         # 2. Prepare the mask for multiplication.
-        mask = self.get_pseudo_binary_mask(mask_c)
+        mask = self.get_pseudo_binary_mask(
+            mask_c, sizes=self.get_valid_sizes(ratios, mask_c.shape[2],
+                                               mask_c.shape[3]))
         x_pos, x_neg = self.apply_mask(x, mask)
 
         return mask, x_pos, x_neg
 
-    def segment(self, x, seed=None, prngs_cuda=None):
+    def segment(self, x, seed=None, prngs_cuda=None, generator=None,
+                size=None, ratios=None):
         """
         Forward function.
         Any mask is is composed of two 2D plans:
@@ -459,6 +796,9 @@ class ResNet(nn.Module):
         :param x: tensor, input image with size (nb_batch, depth, h, w).
         :param seed: int, seed for thread (to guarantee reproducibility over
         a fixed number of multigpus.)
+        :param size: None or tuple (h, w). Resolution of M+. If None, the
+        resolution of the input.
+        :param ratios: see self.get_valid_ratios().
         :return: (out_pos, out_neg, mask):
             x_pos: tensor, the image with the mask applied.
             size (nb_batch, depth, h, w)
@@ -491,48 +831,116 @@ class ResNet(nn.Module):
         # x_16 = F.dropout(x_16, p=0.3, training=self.training, inplace=False)
         x_32 = self.layer4(x_16)   # 1 / 32: [n, 512/2048/--, 15, 15]   --> x2^5 to get back to 1.
 
-        scores, maps = self.mask_head(x=x_32,
-                                      seed=seed,
-                                      prngs_cuda=prngs_cuda
-                                      )
+        with self.timer.stage("wildcat_mask_head"):
+            scores, maps = self.mask_head(
+                x=x_32,
+                seed=seed,
+                prngs_cuda=prngs_cuda,
+                generator=generator,
+                sizes=self.get_valid_sizes(ratios, x_32.shape[2],
+                                           x_32.shape[3])
+            )
 
         # compute M+
         prob = F.softmax(scores, dim=1)
-        mpositive = torch.zeros((b, 1, maps.size()[2], maps.size()[3]),
-                                dtype=maps.dtype,
-                                layout=maps.layout,
-                                device=maps.device
-                                )
-        for i in range(b):  # for each sample
-            for j in range(prob.size()[1]):  # sum the: prob(class) * mask(class)
-                mpositive[i] = mpositive[i] + prob[i, j] * maps[i, j, :, :]
-
+        mpositive = self.get_mpositive(prob, maps)
 
         # does not work.
         # mpositive = self.mask_head(x_32)  # todo: try x32, x16, both.
 
         mpos_inter = F.interpolate(input=mpositive,
-                                   size=(h, w),
+                                   size=(h, w) if size is None else size,
                                    mode='bilinear',
                                    align_corners=ALIGN_CORNERS
                                    )
 
         return mpos_inter, scores
 
-    def classify(self, x, seed=None, prngs_cuda=None):
-        # Resize the image first.
-        _, _, h, w = x.shape
-        h_s, w_s = int(h * self.scale[0]), int(w * self.scale[1])
-        # reshape
-
-        if seed is not None:
-            # Detaching is not important since we do not compute any gradient below this instruction.
-            # When using multigpu, detaching seems to help obtain reproducible results.
-            # It does not guarantee the reproducibility 100%.
-            x = F.interpolate(input=x, size=(h_s, w_s), mode='bilinear', align_corners=ALIGN_CORNERS).detach()
-        else:
-            # It is ok to use this for one single gpu. The code is 100% reproducible.
-            x = F.interpolate(input=x, size=(h_s, w_s), mode='bilinear', align_corners=ALIGN_CORNERS)
+    @staticmethod
+    def get_mpositive(prob, maps):
+        """
+        Compute M+: the sum of the class maps weighted by the class
+        probabilities, for each sample.
+
+        This is done in one batched matrix product:
+        (b, 1, c) x (b, c, h*w) --> (b, 1, h*w), instead of looping over the
+        samples and the classes (which creates b * c tiny ops. and as many
+        autograd nodes).
+
+        :param prob: tensor of size (b, c). probabilities of the classes.
+        :param maps: tensor of size (b, c, h, w). maps of the classes.
+        :return: tensor of size (b, 1, h, w). M+.
+        """
+        b, c, h, w = maps.shape
+        mpositive = torch.bmm(prob.unsqueeze(1),
+                              maps.contiguous().view(b, c, h * w))
+
+        return mpositive.view(b, 1, h, w)
+
+    @staticmethod
+    def get_valid_ratios(valid, h, w):
+        """
+        Convert the valid regions of the images of a padded batch into
+        fractions of the padded size (the same at any resolution).
+        :param valid: None or tensor (nb_batch, 2) of long. See
+        self.forward().
+        :param h: int, height of the padded batch.
+        :param w: int, width of the padded batch.
+        :return: None, or list of tuples (float, float).
+        """
+        if valid is None:
+            return None
+        return [(hv / float(h), wv / float(w)) for hv, wv in valid.tolist()]
+
+    @staticmethod
+    def get_valid_sizes(ratios, h, w):
+        """
+        Compute the valid regions of the samples of a padded batch in maps
+        of size (h, w). A position of the maps is valid if it covers a part
+        of the valid region of the input.
+        :param ratios: None or list of tuples (float, float). See
+        self.get_valid_ratios().
+        :param h: int, height of the maps.
+        :param w: int, width of the maps.
+        :return: None, or list of tuples (int, int).
+        """
+        if ratios is None:
+            return None
+        return [(max(1, min(h, int(math.ceil(rh * h - 1e-6)))),
+                 max(1, min(w, int(math.ceil(rw * w - 1e-6)))))
+                for rh, rw in ratios]
+
+    def get_classifier_size(self, h, w):
+        """
+        Compute the input resolution of the classifier.
+        :param h: int, height of the input.
+        :param w: int, width of the input.
+        :return: h_s, w_s.
+        """
+        return int(h * self.scale[0]), int(w * self.scale[1])
+
+    def classify(self, x, seed=None, prngs_cuda=None, generator=None,
+                 resized=False, ratios=None):
+        """
+        Classify an image (X+ or X-).
+        :param resized: bool. If True, `x` is already at the input resolution
+        of the classifier (see self.get_classifier_size()).
+        :param ratios: see self.get_valid_ratios().
+        """
+        if not resized:
+            # Resize the image first.
+            _, _, h, w = x.shape
+            h_s, w_s = self.get_classifier_size(h, w)
+            # reshape
+
+            if seed is not None:
+                # Detaching is not important since we do not compute any gradient below this instruction.
+                # When using multigpu, detaching seems to help obtain reproducible results.
+                # It does not guarantee the reproducibility 100%.
+                x = F.interpolate(input=x, size=(h_s, w_s), mode='bilinear', align_corners=ALIGN_CORNERS).detach()
+            else:
+                # It is ok to use this for one single gpu. The code is 100% reproducible.
+                x = F.interpolate(input=x, size=(h_s, w_s), mode='bilinear', align_corners=ALIGN_CORNERS)
 
         x = self.relu1(self.bn1(self.conv1(x)))  # 1 / 2: [n, 64, 240, 240]   --> x2^1 to get back to 1.
         x = self.relu2(self.bn2(self.conv2(x)))  # 1 / 2: [n, 64, 240, 240]   --> x2^1 to get back to 1.
@@ -544,23 +952,131 @@ class ResNet(nn.Module):
         x_32 = self.layer4(x_16)  # 1 / 32: [n, 512/2048/--, 15, 15]   --> x2^5 to get back to 1.
 
         # classifier at 32.
-        scores32, maps32 = self.cl32(x=x_32, seed=seed, prngs_cuda=prngs_cuda)
+        with self.timer.stage("wildcat_cl32"):
+            scores32, maps32 = self.cl32(
+                x=x_32, seed=seed, prngs_cuda=prngs_cuda, generator=generator,
+                sizes=self.get_valid_sizes(ratios, x_32.shape[2],
+                                           x_32.shape[3]))
 
         # Final
         scores, maps = scores32, maps32
 
         return scores
 
-    def get_pseudo_binary_mask(self, x):
+    def set_fold_heads(self, fold, check=True):
+        """
+        Fold (or not) the class-wise pooling of the wildcat heads
+        (self.mask_head, self.cl32) into their 1x1 conv. in evaluation mode (see
+        WildCatClassifierHead.get_folded_conv()). The folded params. are
+        computed when the model is evaluated after a change of its params.
+        :param fold: bool. If True, fold.
+        :param check: bool. If True (and fold), check numerically the
+        equivalence, and report the savings.
+        """
+        for name, head in [("mask_head", self.mask_head), ("cl32", self.cl32)]:
+            head.fold = fold
+            if fold and check:
+                head.check_folding(name)
+
+    def set_bn_chunks(self, chunks):
+        """
+        Set the sizes of the independent sub-batches that each batch-norm
+        layer normalizes (in training mode). See ChunkedBatchNorm2d.
+        :param chunks: None (no split), or list of int (sizes of the
+        sub-batches).
+        """
+        for m in self.modules():
+            if isinstance(m, ChunkedBatchNorm2d):
+                m.chunks = chunks
+
+    def classify_pos_neg(self, x_pos, x_neg, seed=None, prngs_cuda=None,
+                         generator=None, resized=False, ratios_pos=None,
+                         ratios_neg=None):
+        """
+        Classify X+ and X- in one single pass through the trunk: they are
+        concatenated along the batch axis, then the scores are split.
+
+        The batch-norm layers normalize X+ and X- separately (in training
+        mode) so the scores are the same as calling self.classify() twice.
+        The only difference is the dropout of the wildcat pooling (if any):
+        the masks are drawn once for both X+ and X- instead of twice. The
+        distribution is the same.
+
+        :param x_pos: tensor, X+ of size (nb_batch, depth, h, w).
+        :param x_neg: tensor, X- of size (nb_batch_, depth, h, w). nb_batch_
+        may be different from nb_batch.
+        :param ratios_pos: see self.get_valid_ratios(). For X+.
+        :param ratios_neg: see self.get_valid_ratios(). For X-.
+        :return: scores_pos, scores_neg.
+        """
+        ratios = None
+        if ratios_pos is not None:
+            ratios = ratios_pos + ratios_neg
+        return self.classify_stacked(x=torch.cat((x_pos, x_neg), dim=0),
+                                     b=x_pos.shape[0],
+                                     seed=seed,
+                                     prngs_cuda=prngs_cuda,
+                                     generator=generator,
+                                     resized=resized,
+                                     ratios=ratios
+                                     )
+
+    def classify_stacked(self, x, b, seed=None, prngs_cuda=None,
+                         generator=None, resized=False, ratios=None):
+        """
+        Classify X+ and X- already concatenated along the batch axis (see
+        self.classify_pos_neg()).
+        :param x: tensor, X+ then X- of size (nb_batch + nb_batch_, depth, h,
+        w).
+        :param b: int, nb_batch: the number of samples of X+.
+        :param ratios: see self.get_valid_ratios(). For X+ then X-.
+        :return: scores_pos, scores_neg.
+        """
+        self.set_bn_chunks([b, x.shape[0] - b])
+        try:
+            scores = self.classify(x=x,
+                                   seed=seed,
+                                   prngs_cuda=prngs_cuda,
+                                   generator=generator,
+                                   resized=resized,
+                                   ratios=ratios
+                                   )
+        finally:
+            self.set_bn_chunks(None)
+
+        return scores[:b], scores[b:]
+
+    def get_pseudo_binary_mask(self, x, min_max=None, sizes=None):
         """
         Compute a mask by applying a sigmoid function.
         The mask is not binary but pseudo-binary (values are close to 0/1).
 
         :param x: tensor of size (batch_size, 1, h, w), contain the feature
          map representing the mask.
+        :param min_max: None or tuple (min, max) of floats. The values used
+        to normalize `x`. If None, the min and the max of `x` are used. Used
+        when `x` is a part of a larger map (tiled inference. see
+        deepmil.tiled_inference.TiledInference).
+        :param sizes: None or list of tuples (h_k, w_k). The valid region
+        (top-left) of each sample of a padded batch. If not None (and
+        min_max is None), each sample is normalized with the min and the max
+        over its own valid region.
         :return: tensor, mask. with size (nbr_batch, 1, h, w).
         """
-        x = (x - x.min()) / (x.max() - x.min())
+        if min_max is not None:
+            x = (x - min_max[0]) / (min_max[1] - min_max[0])
+        elif sizes is not None:
+            b = x.shape[0]
+            inside = torch.zeros_like(x, dtype=torch.uint8)
+            for k, (hk, wk) in enumerate(sizes):
+                inside[k, :, :hk, :wk] = 1
+            mn = x.masked_fill(inside == 0, float("inf")).view(b, -1).min(
+                dim=1)[0].view(b, 1, 1, 1)
+            mx = x.masked_fill(inside == 0, - float("inf")).view(b, -1).max(
+                dim=1)[0].view(b, 1, 1, 1)
+            x = (x - mn) / (mx - mn)
+        else:
+            x = (x - x.min()) / (x.max() - x.min())
         return torch.sigmoid(self.w * (x - self.sigma))
 
     def apply_mask(self, x, mask):
@@ -656,7 +1172,272 @@ def test_resnet():
     print(x.size(), mask.size())
 
 
+def get_mpositive_loop(prob, maps):
+    """
+    Reference implementation of ResNet.get_mpositive(): loop over the samples
+    and the classes. Used only for testing/benchmarking.
+    """
+    b = maps.shape[0]
+    mpositive = torch.zeros((b, 1, maps.size()[2], maps.size()[3]),
+                            dtype=maps.dtype,
+                            layout=maps.layout,
+                            device=maps.device
+                            )
+    for i in range(b):  # for each sample
+        for j in range(prob.size()[1]):  # sum the: prob(class) * mask(class)
+            mpositive[i] = mpositive[i] + prob[i, j] * maps[i, j, :, :]
+
+    return mpositive
+
+
+def test_get_mpositive(benchmark=False, nbr_runs=20):
+    """
+    Check that ResNet.get_mpositive() gives the same output and gradients as
+    the loop for 2, 5 and 200 classes at training size (batch 8, crop 416 -->
+    maps 13x13) and at evaluation size (batch 1, image ~ 800x600 --> maps
+    25x19).
+    :param benchmark: bool. If True, also time both (forward + backward) over
+    `nbr_runs` runs.
+    :param nbr_runs: int > 0, number of runs of the benchmark.
+    """
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    sizes = [("train", 8, 13, 13), ("eval", 1, 25, 19)]
+
+    runs = nbr_runs if benchmark else 1
+
+    def run(func, scores, maps):
+        # a new graph at each run (from the leaves).
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        for _ in range(runs):
+            scores.grad, maps.grad = None, None
+            out = func(F.softmax(scores, dim=1), maps)
+            out.sum().backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return out, scores.grad, maps.grad, (time.perf_counter() - t0) / \
+            float(runs)
+
+    for c in [2, 5, 200]:
+        for name, b, h, w in sizes:
+            scores = torch.randn(b, c, device=DEVICE, requires_grad=True)
+            maps = torch.randn(b, c, h, w, device=DEVICE, requires_grad=True)
+
+            out_loop, gs_loop, gm_loop, t_loop = run(get_mpositive_loop,
+                                                     scores, maps)
+            out_vec, gs_vec, gm_vec, t_vec = run(ResNet.get_mpositive,
+                                                 scores, maps)
+
+            diff = (out_loop - out_vec).abs().max().item()
+            assert torch.allclose(out_loop, out_vec, atol=1e-5), diff
+            assert torch.allclose(gs_loop, gs_vec, atol=1e-4)
+            assert torch.allclose(gm_loop, gm_vec, atol=1e-5)
+            if benchmark:
+                print("{} classes, {} ({}, {}, {}): loop {:.6f}s, bmm {:.6f}s. "
+                      "speedup x{:.1f}. max diff: {}".format(
+                        c, name, b, h, w, t_loop, t_vec, t_loop / t_vec,
+                        diff))
+
+
+def test_classify_pos_neg(benchmark=False):
+    """
+    Check that classifying X+ and X- in one pass (ResNet.classify_pos_neg())
+    gives the same scores, the same gradients of the params., and the same BN
+    running stats., as two separate passes in training mode.
+    :param benchmark: bool. If True, also time both (forward + backward).
+    """
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = resnet18(pretrained=False, dropout=0.0).to(DEVICE)
+    model.train()
+    twin = resnet18(pretrained=False, dropout=0.0).to(DEVICE)
+    twin.load_state_dict(model.state_dict())
+    twin.train()
+    x_pos = torch.randn(4, 3, 224, 224, device=DEVICE)
+    x_neg = torch.randn(4, 3, 224, 224, device=DEVICE)
+
+    def run(func):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        scores_pos, scores_neg = func()
+        # different weights for X+ and X-: a swap would change the gradients.
+        ((scores_pos ** 2).sum() + 2. * scores_neg.sum()).backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return scores_pos, scores_neg, time.perf_counter() - t0
+
+    scores_pos, scores_neg, t_sep = run(
+        lambda: (model.classify(x_pos), model.classify(x_neg)))
+    scores_pos_b, scores_neg_b, t_bat = run(
+        lambda: twin.classify_pos_neg(x_pos, x_neg))
+
+    assert torch.allclose(scores_pos, scores_pos_b, atol=1e-5)
+    assert torch.allclose(scores_neg, scores_neg_b, atol=1e-5)
+    for (name, p), p_b in zip(model.named_parameters(), twin.parameters()):
+        if p.grad is None:
+            assert p_b.grad is None, name
+            continue
+        assert torch.allclose(p.grad, p_b.grad, atol=1e-4, rtol=1e-4), \
+            "{}: {}".format(name, (p.grad - p_b.grad).abs().max().item())
+    for (name, buf), buf_b in zip(model.named_buffers(), twin.buffers()):
+        assert torch.allclose(buf.float(), buf_b.float(), atol=1e-5), name
+    if benchmark:
+        print("Separate passes: {:.4f}s. One batched pass: {:.4f}s.".format(
+            t_sep, t_bat))
+
+
+def test_mask_downscale(benchmark=False):
+    """
+    Check that MaskDownscale gives the same X+/X- (downscaled) and the same
+    gradients as ResNet.apply_mask() followed by the resize of ResNet.classify(
+    ).
+    :param benchmark: bool. If True, also report the peak memory of both
+    (cuda).
+    """
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    # adjoint of the resize: <R(z), g> = <z, R^T(g)> (down and up).
+    for size_in, size_out in [((17, 23), (13, 18)), ((13, 18), (17, 23))]:
+        z = torch.randn((2, 3) + size_in, dtype=torch.double, device=DEVICE)
+        g = torch.randn((2, 3) + size_out, dtype=torch.double, device=DEVICE)
+        lhs = (F.interpolate(input=z, size=size_out, mode='bilinear',
+                             align_corners=ALIGN_CORNERS) * g).sum()
+        rhs = (z * resize_adjoint(g, size_in)).sum()
+        assert torch.allclose(lhs, rhs), (lhs - rhs).abs().item()
+
+    # gradients: finite differences in double.
+    x = torch.randn(2, 3, 17, 23, dtype=torch.double, device=DEVICE,
+                    requires_grad=True)
+    m = torch.rand(2, 1, 17, 23, dtype=torch.double, device=DEVICE,
+                   requires_grad=True)
+    assert torch.autograd.gradcheck(
+        lambda x_, m_: MaskDownscale.apply(x_, m_, (13, 18)), (x, m))
+
+    b, h, w = 8, 416, 416
+    size = (int(h * 0.8), int(w * 0.8))
+    x = torch.randn(b, 3, h, w, device=DEVICE)
+    m_ = torch.rand(b, 1, h, w, device=DEVICE)
+
+    def reference(x, m):
+        x_pos, x_neg = x * m.expand_as(x), x * (1 - m.expand_as(x))
+        x_pos = F.interpolate(input=x_pos, size=size, mode='bilinear',
+                              align_corners=ALIGN_CORNERS)
+        x_neg = F.interpolate(input=x_neg, size=size, mode='bilinear',
+                              align_corners=ALIGN_CORNERS)
+        return torch.cat((x_pos, x_neg), dim=0)
+
+    outs, grads = [], []
+    for func in [reference, lambda x, m: MaskDownscale.apply(x, m, size)]:
+        m = m_.clone().requires_grad_(True)
+        if torch.cuda.is_available():
+            torch.cuda.reset_max_memory_allocated()
+        out = func(x, m)
+        (out ** 2).sum().backward()
+        outs.append(out.detach())
+        grads.append(m.grad)
+        if benchmark and torch.cuda.is_available():
+            print("Peak memory: {:.1f}MB".format(
+                torch.cuda.max_memory_allocated() / 2**20))
+
+    assert torch.equal(outs[0], outs[1])
+    assert torch.allclose(grads[0], grads[1], atol=1e-5)
+
+
+def test_fold_heads(benchmark=False):
+    """
+    Check that the folded wildcat heads give the same outputs as the unfolded
+    ones in evaluation mode (the whole model, and cl32 over evaluation-size
+    maps), and that they are not used in training mode.
+    :param benchmark: bool. If True, also time cl32 with and without folding
+    (200 classes, 5 modalities: CUB).
+    """
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = resnet18(pretrained=False, num_classes=200, modalities=5).to(
+        DEVICE)
+    model.eval()
+    x = torch.randn(2, 3, 224, 224, device=DEVICE)
+    with torch.no_grad():
+        outs = model(x=x)
+        model.set_fold_heads(True)
+        outs_folded = model(x=x)
+    for out, out_folded in zip(outs, outs_folded):
+        assert torch.allclose(out, out_folded, atol=1e-4, rtol=1e-4)
+
+    x_32 = torch.randn(16, 512, 25, 19, device=DEVICE)
+    outs = []
+    for fold in [False, True]:
+        model.cl32.fold = fold
+        with torch.no_grad():
+            outs.append(model.cl32(x_32))
+    for out, out_folded in zip(*outs):
+        assert torch.allclose(out, out_folded, atol=1e-4, rtol=1e-4), \
+            (out - out_folded).abs().max().item()
+
+    # training: the unfolded head (the folded params. carry no gradient).
+    model.train()
+    x_32.requires_grad_(True)
+    model.cl32(x_32)[0].sum().backward()
+    assert model.cl32.to_modalities.weight.grad is not None
+    model.eval()
+
+    if benchmark:
+        for fold in [False, True]:
+            model.cl32.fold = fold
+            with torch.no_grad():
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                t0 = time.perf_counter()
+                for _ in range(20):
+                    model.cl32(x_32)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            print("cl32, fold={}: {:.3f}ms".format(
+                fold, (time.perf_counter() - t0) * 50.))
+
+
+def test_padded_batch():
+    """
+    Check that the outputs of each image in evaluation do not depend on the
+    other images of its batch (images of mixed sizes):
+        - batches of images with the same size (valid_bucket_multiple=1) give
+        the same outputs as batches of 1 image.
+        - in padded batches, each image gives the same outputs as when it is
+        alone with the same padding.
+    """
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = resnet18(pretrained=False, dropout=0.0).to(DEVICE)
+    model.eval()
+    imgs = [torch.randn(3, h, w) for h, w in [(96, 128), (96, 128), (64, 96),
+                                              (80, 112)]]
+
+    def evaluate(batch, h, w):
+        data = torch.stack([F.pad(img, [0, w - img.shape[2], 0,
+                                        h - img.shape[1]]) for img in batch])
+        valid = torch.LongTensor([list(img.shape[1:]) for img in batch])
+        with torch.no_grad():
+            return model(x=data.to(DEVICE), valid=valid.to(DEVICE))
+
+    def check(outs, k, refs):
+        for out, ref in zip(outs, refs):
+            assert torch.allclose(out[k: k + 1], ref, atol=1e-4, rtol=1e-4), \
+                (out[k: k + 1] - ref).abs().max().item()
+
+    outs = evaluate(imgs[:2], 96, 128)
+    for k in range(2):
+        check(outs, k, evaluate([imgs[k]], 96, 128))
+
+    outs = evaluate(imgs, 96, 128)
+    for k, img in enumerate(imgs):
+        check(outs, k, evaluate([img], 96, 128))
+
+
 if __name__ == "__main__":
     import sys
 
+    test_padded_batch()
+    test_get_mpositive()
+    test_classify_pos_neg()
+    test_mask_downscale()
+    test_fold_heads()
     test_resnet()
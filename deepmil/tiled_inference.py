@@ -0,0 +1,347 @@
+"""
+Tiled (sliding-window) inference over arbitrarily large images.
+
+The image is processed by tiles through ResNet.segment() and
+ResNet.classify(): the memory (host and device) is bounded by the size of the
+tiles (and the batch of tiles) whatever the size of the image. The continuous
+mask is blended in a memory-mapped array on disc.
+"""
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.append("..")
+
+__all__ = ["TiledInference", "get_tiles_starts", "get_blending_window"]
+
+BLENDINGS = ["constant", "hann"]  # blending windows of the overlapping tiles.
+MIN_WEIGHT = 1e-3  # minimum weight of a pixel of a tile in the blending.
+
+
+def get_tiles_starts(size, tile, overlap):
+    """
+    Compute the start of the tiles along an axis. Two consecutive tiles
+    overlap by at least `overlap` pixels. The last tile ends at the end of the
+    axis.
+    :param size: int > 0, size of the axis.
+    :param tile: int > 0, size of the tiles. Clipped to `size`.
+    :param overlap: int >= 0, overlap between two consecutive tiles. Clipped
+    to `tile - 1`.
+    :return: list of int, the starts of the tiles.
+    """
+    tile = min(tile, size)
+    stride = tile - min(overlap, tile - 1)
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+
+def get_blending_window(h, w, blending):
+    """
+    Compute the weights of the pixels of a tile when blending the overlapping
+    tiles.
+    :param h: int, height of the tile.
+    :param w: int, width of the tile.
+    :param blending: str, in BLENDINGS. `constant`: all the pixels have the
+    same weight (average of the tiles). `hann`: 2D Hann window. The borders of
+    the tiles (where the receptive field is truncated) have less weight.
+    :return: numpy.ndarray float32 of shape (h, w). All the weights are > 0.
+    """
+    if blending == "constant":
+        return np.ones((h, w), dtype=np.float32)
+    elif blending == "hann":
+        # drop the zeros at both ends of the window.
+        window = np.outer(np.hanning(h + 2)[1:-1], np.hanning(w + 2)[1:-1])
+        return np.maximum(window, MIN_WEIGHT).astype(np.float32)
+    else:
+        raise ValueError("Blending {} unsupported. Supported: {} .... "
+                         "[NOT OK]".format(blending, BLENDINGS))
+
+
+class TiledInference(object):
+    """
+    Sliding-window inference of the model (deepmil.models.ResNet) over an
+    image that is too large to be processed at once.
+
+    Two passes over the tiles:
+        1. Segmentation: M+ of each tile (ResNet.segment()) is blended
+        (weighted by the blending window) into a memory-mapped array of the
+        size of the image. The min/max of the blended M+ are tracked.
+        2. Classification: each tile is masked with the pseudo-binary mask (
+        ResNet.get_pseudo_binary_mask()) computed with the min/max of the whole
+        M+ (as the model does over the entire image), and classified (
+        ResNet.classify()).
+    Finally, the blended M+ is converted in place into the pseudo-binary mask
+    by blocks of the size of the tiles.
+
+    The WildCat scores of the tiles (of the segmentor and of the classifier)
+    are averaged over the tiles. This is not exactly the WildCat pooling over
+    the entire image (the top-k regions are selected per tile).
+    """
+    def __init__(self,
+                 model,
+                 transform_tensor=None,
+                 tile_size=(512, 512),
+                 overlap=(64, 64),
+                 blending="hann",
+                 batch_size=1,
+                 device=torch.device("cpu"),
+                 rows_chunk=512
+                 ):
+        """
+        Init. function.
+        :param model: deepmil.models.ResNet (or wrapped in MyDataParallel). In
+        evaluation mode.
+        :param transform_tensor: transform that converts a uint8
+        numpy.ndarray tile (h, w, 3) into a normalized tensor (3, h, w) (see
+        tools.get_transforms_tensor()). Not used when the image is already a
+        tensor.
+        :param tile_size: int or tuple (h, w) of int > 0. Size of the tiles.
+        :param overlap: int or tuple (h, w) of int >= 0. Overlap between two
+        consecutive tiles.
+        :param blending: str, in BLENDINGS. Blending window of the overlapping
+        tiles. See get_blending_window().
+        :param batch_size: int > 0. Number of tiles processed at once.
+        :param device: torch.device where the model is.
+        :param rows_chunk: int > 0. Number of rows of the output mask
+        processed at once when normalizing it.
+        """
+        if isinstance(tile_size, int):
+            tile_size = (tile_size, tile_size)
+        if isinstance(overlap, int):
+            overlap = (overlap, overlap)
+
+        msg = "'tile_size' must be > 0. found {} .... [NOT OK]".format(
+            tile_size)
+        assert min(tile_size) > 0, msg
+        msg = "'overlap' must be >= 0. found {} .... [NOT OK]".format(overlap)
+        assert min(overlap) >= 0, msg
+        msg = "'blending' must be in {}. found {} .... [NOT OK]".format(
+            BLENDINGS, blending)
+        assert blending in BLENDINGS, msg
+        msg = "'batch_size' must be > 0. found {} .... [NOT OK]".format(
+            batch_size)
+        assert batch_size > 0, msg
+
+        self.model = model
+        self.transform_tensor = transform_tensor
+        self.tile_size = tuple(tile_size)
+        self.overlap = tuple(overlap)
+        self.blending = blending
+        self.batch_size = batch_size
+        self.device = device
+        self.rows_chunk = rows_chunk
+
+    def exceeds(self, h, w):
+        """
+        Check whether an image is larger than a tile (along an axis at least).
+        :param h: int, height of the image.
+        :param w: int, width of the image.
+        :return: bool.
+        """
+        return (h > self.tile_size[0]) or (w > self.tile_size[1])
+
+    def get_tiles(self, h, w):
+        """
+        Compute the tiles of an image.
+        :param h: int, height of the image.
+        :param w: int, width of the image.
+        :return: th, tw, positions: size of the tiles, list of tuples (i, j)
+        (top-left corner of the tiles).
+        """
+        th, tw = min(self.tile_size[0], h), min(self.tile_size[1], w)
+        positions = [(i, j) for i in get_tiles_starts(h, th, self.overlap[0])
+                     for j in get_tiles_starts(w, tw, self.overlap[1])]
+        return th, tw, positions
+
+    def get_tile(self, img, i, j, th, tw):
+        """
+        Extract a tile of the image and convert it into a normalized tensor.
+        :param img: numpy.ndarray uint8 (h, w, 3), or torch.Tensor float (3,
+        h, w).
+        :return: torch.Tensor float (3, th, tw).
+        """
+        if isinstance(img, torch.Tensor):
+            return img[:, i: i + th, j: j + tw]
+
+        # reads only the tile (memmap).
+        tile = np.ascontiguousarray(img[i: i + th, j: j + tw])
+        if self.transform_tensor is not None:
+            return self.transform_tensor(tile)
+        return torch.from_numpy(tile.transpose(2, 0, 1)).float().div_(255.)
+
+    def iter_batches(self, img, th, tw, positions):
+        """
+        Iterate over the batches of tiles.
+        :return: generator of (positions of the tiles, torch.Tensor float (b,
+        3, th, tw) on self.device).
+        """
+        for k in range(0, len(positions), self.batch_size):
+            batch = positions[k: k + self.batch_size]
+            x = torch.stack([self.get_tile(img, i, j, th, tw)
+                             for i, j in batch])
+            yield batch, x.to(self.device)
+
+    def iter_blocks(self, h, w):
+        """
+        Iterate over the non-overlapping blocks of the size of the tiles that
+        cover an image (or a mask).
+        :param h: int, height of the image.
+        :param w: int, width of the image.
+        :return: generator of (i0, i1, j0, j1): the block is [i0: i1, j0: j1].
+        """
+        for i0 in range(0, h, self.tile_size[0]):
+            for j0 in range(0, w, self.tile_size[1]):
+                yield i0, min(h, i0 + self.tile_size[0]), j0, min(
+                    w, j0 + self.tile_size[1])
+
+    def iter_rows(self, h):
+        """
+        Iterate over the chunks of rows of the output mask.
+        :return: generator of (first row, last row + 1).
+        """
+        for r0 in range(0, h, self.rows_chunk):
+            yield r0, min(h, r0 + self.rows_chunk)
+
+    def __call__(self, img, path_out):
+        """
+        Perform the tiled inference over an image.
+        :param img: numpy.ndarray uint8 of shape (h, w, 3) (it can be a
+        numpy.memmap: only the tiles are read), or torch.Tensor float of shape
+        (3, h, w) (already normalized).
+        :param path_out: str, path to the .npy file where the mask is written
+        (memory-mapped).
+        :return: mask, scores_seg, scores:
+            mask: numpy.memmap float32 of shape (h, w). The pseudo-binary mask
+            of the image.
+            scores_seg: torch.Tensor float of shape (1, nbr_classes). Scores
+            of the segmentor averaged over the tiles.
+            scores: torch.Tensor float of shape (1, nbr_classes). Scores of
+            the classifier over X+ averaged over the tiles.
+        """
+        if isinstance(img, torch.Tensor):
+            _, h, w = img.shape
+        else:
+            h, w = img.shape[:2]
+
+        th, tw, positions = self.get_tiles(h, w)
+        window = get_blending_window(th, tw, self.blending)
+
+        mask = np.lib.format.open_memmap(path_out, mode="w+",
+                                         dtype=np.float32, shape=(h, w))
+        fd, path_weights = tempfile.mkstemp(
+            suffix=".weights", dir=os.path.dirname(os.path.abspath(path_out)))
+        os.close(fd)
+        t0 = time.perf_counter()
+        try:
+            weights = np.memmap(path_weights, mode="w+", dtype=np.float32,
+                                shape=(h, w))
+            scores_seg, scores = 0., 0.
+
+            with torch.no_grad():
+                # 1. Segmentation: blend M+.
+                for batch, x in self.iter_batches(img, th, tw, positions):
+                    mpos, sc_seg = self.model(x=x, code="segment")
+                    scores_seg = scores_seg + sc_seg.sum(dim=0, keepdim=True)
+                    mpos = mpos.cpu().numpy()
+                    for k, (i, j) in enumerate(batch):
+                        mask[i: i + th, j: j + tw] += mpos[k, 0] * window
+                        weights[i: i + th, j: j + tw] += window
+
+                mn, mx = np.inf, - np.inf
+                for r0, r1 in self.iter_rows(h):
+                    mask[r0: r1] /= weights[r0: r1]
+                    mn = min(mn, float(mask[r0: r1].min()))
+                    mx = max(mx, float(mask[r0: r1].max()))
+
+                # 2. Classification of X+.
+                for batch, x in self.iter_batches(img, th, tw, positions):
+                    mpos = torch.from_numpy(np.stack(
+                        [mask[i: i + th, j: j + tw] for i, j in batch]))
+                    m = self.model.get_pseudo_binary_mask(
+                        mpos.unsqueeze(1).to(self.device), (mn, mx))
+                    sc = self.model(x=x * m.expand_as(x), code="classify")
+                    scores = scores + sc.sum(dim=0, keepdim=True)
+
+                # M+ --> pseudo-binary mask.
+                for i0, i1, j0, j1 in self.iter_blocks(h, w):
+                    mpos = torch.from_numpy(
+                        np.array(mask[i0: i1, j0: j1])).to(self.device)
+                    mask[i0: i1, j0: j1] = self.model.get_pseudo_binary_mask(
+                        mpos, (mn, mx)).cpu().numpy()
+
+            mask.flush()
+            del weights
+        finally:
+            os.remove(path_weights)
+
+        print("{}: {} tiles ({}, {}) over an image ({}, {}) in {:.2f}s .... "
+              "[OK]".format(self.__class__.__name__, len(positions), th, tw,
+                            h, w, time.perf_counter() - t0))
+
+        return mask, scores_seg / float(len(positions)), scores / float(
+            len(positions))
+
+    def __repr__(self):
+        return "{}(tile_size={}, overlap={}, blending={}, " \
+               "batch_size={})".format(self.__class__.__name__,
+                                       self.tile_size, self.overlap,
+                                       self.blending, self.batch_size)
+
+
+def test_tiled_inference():
+    """
+    Check that the tiled inference with one tile covering the image gives the
+    same mask and scores as the model over the entire image, and that small
+    overlapping tiles give a pseudo-binary mask in [0, 1] of the size of the
+    image.
+    """
+    from deepmil.models import resnet18
+    from torchvision import transforms
+
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = resnet18(pretrained=False).to(DEVICE)
+    model.eval()
+    transform_tensor = transforms.Compose(
+        [transforms.ToTensor(), transforms.Normalize([0.5, 0.5, 0.5],
+                                                     [0.5, 0.5, 0.5])])
+    img = np.random.randint(0, 256, size=(300, 420, 3)).astype(np.uint8)
+    x = transform_tensor(img).unsqueeze(0).to(DEVICE)
+
+    with torch.no_grad():
+        scores_pos, _, mask, scores_seg = model(x=x, neg_ratio=0.)
+
+    folder = tempfile.mkdtemp()
+    tiler = TiledInference(model, transform_tensor, tile_size=1024,
+                           device=DEVICE)
+    mask_t, scores_seg_t, scores_t = tiler(img, os.path.join(folder,
+                                                             "mask.npy"))
+    assert np.allclose(mask.squeeze().cpu().numpy(), mask_t, atol=1e-4)
+    assert torch.allclose(scores_seg, scores_seg_t, atol=1e-4)
+    assert torch.allclose(scores_pos, scores_t, atol=1e-4)
+
+    for blending in BLENDINGS:
+        tiler = TiledInference(model, transform_tensor, tile_size=128,
+                               overlap=32, blending=blending, batch_size=4,
+                               device=DEVICE, rows_chunk=64)
+        mask_t, scores_seg_t, scores_t = tiler(
+            img, os.path.join(folder, "mask-{}.npy".format(blending)))
+        assert mask_t.shape == (300, 420)
+        assert 0. <= mask_t.min() and mask_t.max() <= 1.
+        assert scores_seg_t.shape == scores_t.shape == scores_pos.shape
+        assert torch.isfinite(scores_seg_t).all()
+        assert torch.isfinite(scores_t).all()
+
+    assert tiler.exceeds(300, 420) and not tiler.exceeds(128, 100)
+    blocks = list(tiler.iter_blocks(300, 420))
+    assert sum([(i1 - i0) * (j1 - j0)
+                for i0, i1, j0, j1 in blocks]) == 300 * 420
+
+
+if __name__ == "__main__":
+    test_tiled_inference()
@@ -2,6 +2,8 @@ import os
 from os.path import join
 import pickle as pkl
 import subprocess
+import shutil
+import tempfile
 import datetime as dt
 from copy import deepcopy
 
@@ -12,16 +14,59 @@ import tqdm
 import numpy as np
 from scipy.special import softmax
 import torch
+from torch.nn import functional as F
 
 from tools import log
 from tools import announce_msg
 from tools import VisualiseMIL
+from tools import StageTimer
+from tools import StepProfiler
+from tools import DeviceAccumulator
 
 from deepmil.criteria import Metrics
+from deepmil.criteria import ConfusionMeter
+
+from loader import get_epoch_batches
+from loader import BatchPrefetcher
+from loader import stack_masks_batch
+from loader import decode_masks_batch
 
 import reproducibility
 
 
+def get_neg_branch_schedule(args, i):
+    """
+    Decide how the negative branch (classification of X-) is evaluated at the
+    training step `i`.
+
+    - If the regularization over the background is not used, X- is never
+    classified.
+    - X- is classified only every `args.neg_every` steps. To keep the same
+    expected weight of the regularization, it is multiplied by
+    `args.neg_every` at the steps where it is computed.
+    - At these steps, X- is classified over a random subset of the batch (
+    ratio: `args.neg_ratio`). The regularization is an average over the
+    samples, so it does not need to be rescaled.
+
+    :param args: object. Contains the configuration of the exp.
+    :param i: int, the index of the training step within the epoch.
+    :return: neg_ratio, neg_weight: float, float. see
+    deepmil.models.ResNet.forward(), and deepmil.criteria.TrainLoss.forward().
+    """
+    if not args.use_reg:
+        return 0., 0.
+
+    msg = "'neg_every' must be an int >= 1. found {}.".format(args.neg_every)
+    assert isinstance(args.neg_every, int) and args.neg_every >= 1, msg
+    msg = "'neg_ratio' must be in ]0, 1]. found {}.".format(args.neg_ratio)
+    assert 0. < args.neg_ratio <= 1., msg
+
+    if i % args.neg_every != 0:
+        return 0., 0.
+
+    return float(args.neg_ratio), float(args.neg_every)
+
+
 def train_one_epoch(model,
                     optimizer,
                     dataloader,
@@ -32,7 +77,10 @@ def train_one_epoch(model,
                     epoch=0,
                     log_file=None,
                     ALLOW_MULTIGPUS=False,
-                    NBRGPUS=1
+                    NBRGPUS=1,
+                    transform_batch=None,
+                    timer=None,
+                    profiler=None
                     ):
     """
     Perform one epoch of training.
@@ -45,8 +93,18 @@ def train_one_epoch(model,
     :param callback:
     :param log_file:
     :param ALLOW_MULTIGPUS: bool. If True, we are in multiGPU mode.
+    :param transform_batch: None or tools.BatchAugmenter. If not None, the
+    dataloader provides uint8 batches that are augmented and normalized on
+    the device.
+    :param timer: None or tools.StageTimer. Times the stages of the steps (
+    the stages of the forward are timed by model.timer).
+    :param profiler: None or tools.StepProfiler. Captures a window of steps.
     :return:
     """
+    if timer is None:
+        timer = StageTimer(enabled=False)
+    if profiler is None:
+        profiler = StepProfiler()
     model.train()
 
     metrics = Metrics(threshold=args.final_thres).to(device)
@@ -55,18 +113,44 @@ def train_one_epoch(model,
     f1pos_tr, f1neg_tr, miou_tr, acc_tr = 0., 0., 0., 0.
     cnt = 0.
 
+    # The batches are stacked, transferred and decoded on the device in
+    # advance by a background thread.
+    prefetcher = BatchPrefetcher(dataloader, device,
+                                 depth=args.prefetch_device_batches,
+                                 prepare=stack_masks_batch,
+                                 convert=decode_masks_batch)
     length = len(dataloader)
     t0 = dt.datetime.now()
     myseed = int(os.environ["MYSEED"])
+    # Per-step generators derived from (seed, epoch, step). No need to
+    # re-seed the global generators at every step.
+    seed_stream = reproducibility.SeedStream(myseed,
+                                             reproducibility.STREAM_TRAIN)
+    aug_stream = reproducibility.SeedStream(myseed,
+                                            reproducibility.STREAM_AUG)
+    wait_time, transfer_time = 0., 0.
+    # The losses stay on the device, and are flushed into tr_stats every
+    # `flush_stats_every` steps (one synchronization per flush).
+    tracker = DeviceAccumulator(device, stats=tr_stats,
+                                flush_every=args.flush_stats_every)
 
     for i, (data, masks, labels) in tqdm.tqdm(
-            enumerate(dataloader), ncols=80, total=length):
-        reproducibility.force_seed(myseed + epoch)
-
-        data = data.to(device)
-        labels = labels.to(device)
-        masks = torch.stack(masks)
-        masks = masks.to(device)
+            enumerate(prefetcher), ncols=80, total=length):
+
+        profiler.step("train", epoch, i)
+        timer.add("data_wait", prefetcher.wait_time - wait_time)
+        wait_time = prefetcher.wait_time
+        # The batch is already stacked, on the device, and its masks are
+        # decoded (by the prefetcher). Without background thread, the
+        # transfer is done on this thread.
+        if prefetcher.depth == 0:
+            timer.add("h2d", prefetcher.transfer_time - transfer_time)
+            transfer_time = prefetcher.transfer_time
+
+        if transform_batch is not None:
+            with timer.stage("augment"):
+                data = transform_batch(data,
+                                       aug_stream.torch_generator(epoch, i))
 
         model.zero_grad()
 
@@ -85,6 +169,7 @@ def train_one_epoch(model,
                       "Exiting .... [NOT OK]".format(NBRGPUS)
                 assert NBRGPUS <= 1, msg
             seeds_threads = None
+            generator = seed_stream.torch_generator(epoch, i)
         else:
             msg = "Something is wrong. You asked for multigpu mode. " \
                   "But, we found {} GPUs. Exiting " \
@@ -104,50 +189,66 @@ def train_one_epoch(model,
                 torch.cuda.manual_seed(seed)
                 prngs_cuda.append(torch.cuda.get_rng_state())
             reproducibility.force_seed(myseed + epoch + i)  # armor.
+            # The threads rely on the seeds and the global state.
+            generator = None
 
         # TODO: crack in optimal code.
         if prngs_cuda is not None and prngs_cuda != []:
             prngs_cuda = torch.stack(prngs_cuda)
 
-        reproducibility.force_seed(myseed + epoch + i)  # armor.
+        neg_ratio, neg_weight = get_neg_branch_schedule(args, i)
+
         scores_pos, scores_neg, mask_pred, sc_cl_se = model(
             x=data,
             seed=seeds_threads,
-            prngs_cuda=prngs_cuda
+            prngs_cuda=prngs_cuda,
+            neg_ratio=neg_ratio,
+            generator=generator
         )
-        reproducibility.force_seed(myseed + epoch + i)  # armor.
+
+        full_size = data.shape[2] * data.shape[3]
+        if masks.shape[2:] != mask_pred.shape[2:]:
+            # Low-resolution mask (model.lowres_mask): the true mask is
+            # downscaled for the metrics.
+            masks = F.interpolate(masks, size=mask_pred.shape[2:],
+                                  mode="nearest")
 
         msg = "shape mismatches: pred {}  true {}".format(
             masks.shape, mask_pred.shape)
         assert masks.shape == mask_pred.shape, msg
 
-        t_loss, l_p, l_n, l_seg = criterion(scores_pos,
-                                            sc_cl_se,
-                                            labels,
-                                            mask_pred,
-                                            scores_neg
-                                            )
-        t_loss.backward()
+        with timer.stage("loss"):
+            t_loss, l_p, l_n, l_seg = criterion(scores_pos,
+                                                sc_cl_se,
+                                                labels,
+                                                mask_pred,
+                                                scores_neg,
+                                                neg_weight=neg_weight,
+                                                full_size=full_size
+                                                )
+        with timer.stage("backward"):
+            t_loss.backward()
 
         # Update params.
-        optimizer.step()
+        with timer.stage("optimizer_step"):
+            optimizer.step()
         # End optimization.
-        acc, dice_forg, dice_back, miou = metrics(
-            scores=scores_pos,
-            labels=labels,
-            masks_pred=mask_pred.contiguous().view(bsz, -1),
-            masks_trg=masks.contiguous().view(bsz, -1),
-            avg=True
-            )
+        with timer.stage("metrics"):
+            acc, dice_forg, dice_back, miou = metrics(
+                scores=scores_pos,
+                labels=labels,
+                masks_pred=mask_pred.contiguous().view(bsz, -1),
+                masks_trg=masks.contiguous().view(bsz, -1),
+                avg=True
+                )
 
         # tracking
-        tr_stats["total_loss"].append(t_loss.item())
-        tr_stats["loss_pos"].append(l_p.item())
-        tr_stats["loss_neg"].append(l_n.item())
-        tr_stats["acc"].append(acc * 100.)
-        tr_stats["f1pos"].append(dice_forg * 100.)
-        tr_stats["f1neg"].append(dice_back * 100.)
-        tr_stats['miou'].append(miou * 100.)
+        with timer.stage("logging"):
+            tracker.append(total_loss=t_loss, loss_pos=l_p, loss_neg=l_n)
+            tr_stats["acc"].append(acc * 100.)
+            tr_stats["f1pos"].append(dice_forg * 100.)
+            tr_stats["f1neg"].append(dice_back * 100.)
+            tr_stats['miou'].append(miou * 100.)
 
         f1pos_tr += dice_forg
         f1neg_tr += dice_back
@@ -155,6 +256,9 @@ def train_one_epoch(model,
         acc_tr += acc
         cnt += bsz
 
+    profiler.stop()
+    tracker.flush()
+
     # avg
     f1neg_tr = f1neg_tr * 100. / float(cnt)
     f1pos_tr = f1pos_tr * 100. / float(cnt)
@@ -162,10 +266,11 @@ def train_one_epoch(model,
     miou_tr = miou_tr * 100. / float(cnt)
 
     to_write = "Train epoch {:>2d}: f1+: {:.2f}, f1-: {:.2f}, " \
-               "miou: {:.2f}, acc: {:.2f}, LR {}, t:{}".format(
+               "miou: {:.2f}, acc: {:.2f}, LR {}, t:{}, data wait: " \
+               "{:.2f}s".format(
                 epoch, f1pos_tr, f1neg_tr, miou_tr, acc_tr,
                 ['{:.2e}'.format(group["lr"]) for group in optimizer.param_groups],
-                dt.datetime.now() - t0
+                dt.datetime.now() - t0, prefetcher.wait_time
                 )
     print(to_write)
     if log_file:
@@ -218,6 +323,60 @@ def store_pred_img(i,
                   args.extension[1], optimize=True)
 
 
+def crop_center(mask_pred, h, w):
+    """
+    Crop the center (h, w) of a predicted mask. Used when the input image has
+    been padded.
+    :param mask_pred: tensor or numpy.ndarray (..., hp, wp).
+    :param h: int, height of the true mask.
+    :param w: int, width of the true mask.
+    :return: a view (..., h, w) of `mask_pred`.
+    """
+    hp, wp = mask_pred.shape[-2:]
+    if (h == hp) and (w == wp):
+        return mask_pred
+
+    return mask_pred[...,
+                     int(hp / 2) - int(h / 2): int(hp / 2) + int(h / 2) + (
+                             h % 2),
+                     int(wp / 2) - int(w / 2): int(wp / 2) + int(w / 2) + (
+                             w % 2)]
+
+
+def evaluate_tiled(tiler, metrics, img, mask_trg, path_out):
+    """
+    Tiled inference over one image (see
+    deepmil.tiled_inference.TiledInference), and confusion counts of its
+    predicted mask. The mask stays on disc: the counts are accumulated by
+    blocks of the size of the tiles. Only tile-sized tensors are created on
+    the device.
+    :param tiler: deepmil.tiled_inference.TiledInference.
+    :param metrics: deepmil.criteria.Metrics.
+    :param img: tensor (3, h, w). The valid region of the image.
+    :param mask_trg: tensor (1, h_t, w_t). The true mask.
+    :param path_out: str. The .npy file where the predicted mask is written.
+    :return: mask, scores_seg, scores, counts:
+        mask: numpy.memmap (h_t, w_t). The predicted mask, cropped as the
+        true mask.
+        scores_seg, scores: tensors (1, nbr_classes). See TiledInference.
+        counts: tensor (1, 4). See Metrics.confusion().
+    """
+    mask, scores_seg, scores = tiler(img, path_out)
+    _, h, w = mask_trg.shape
+    mask = crop_center(mask, h, w)
+
+    counts = 0.
+    for i0, i1, j0, j1 in tiler.iter_blocks(h, w):
+        pred = torch.from_numpy(np.array(mask[i0: i1, j0: j1]))
+        counts = counts + metrics.confusion(
+            masks_pred=pred.to(scores.device).view(1, -1),
+            masks_trg=mask_trg[:, i0: i1, j0: j1].contiguous().view(1, -1),
+            threshold=metrics.threshold
+        )
+
+    return mask, scores_seg, scores, counts
+
+
 def validate(model,
              dataset,
              dataloader,
@@ -230,25 +389,42 @@ def validate(model,
              log_file=None,
              name_set="",
              store_on_disc=False,
-             store_imgs=False
+             store_imgs=False,
+             timer=None,
+             profiler=None,
+             tiler=None
              ):
     """
-    Perform a validation over the validation set. Assumes a batch size of 1.
-    (images do not have the same size,
-    so we can't stack them in one tensor).
+    Perform a validation over the validation set.
+    Images do not have the same size: a batch contains images of similar
+    sizes padded to the same size (see loader.BucketBatchSampler,
+    loader.pad_collate). The predicted mask of each image is cropped to its
+    valid region, and the metrics are computed per image.
     Validation samples may be large to fit all in the GPU at once.
 
     Note: criterion is deppmil.criteria.TotalLossEval().
+    timer: None or tools.StageTimer. Times the stages of the batches.
+    profiler: None or tools.StepProfiler. Captures a window of batches.
+    tiler: None or deepmil.tiled_inference.TiledInference. If not None, the
+    batches of images larger than a tile are processed by tiles, one image at
+    a time (see evaluate_tiled()). X- is not computed, and the predicted masks
+    stay on disc: no regularization nor size constraint in their loss.
     """
+    if timer is None:
+        timer = StageTimer(enabled=False)
+    if profiler is None:
+        profiler = StepProfiler()
     model.eval()
     metrics = Metrics(threshold=args.final_thres).to(device)
     metrics.eval()
 
     f1pos_, f1neg_, miou_, acc_ = 0., 0., 0., 0.
     cnt = 0.
-    total_loss_ = 0.
-    loss_pos_ = 0.
-    loss_neg_ = 0.
+    # The sums of the losses stay on the device (no synchronization per
+    # batch).
+    tracker = DeviceAccumulator(device)
+    # Confusion counts over the whole set (dataset-level metrics).
+    meter = ConfusionMeter()
 
     mask_fd = None
     name_fd_masks = "masks"  # where to store the predictions.
@@ -264,102 +440,163 @@ def validate(model,
 
     length = len(dataloader)
     t0 = dt.datetime.now()
-    myseed = int(os.environ["MYSEED"])
-
+    # Indices of the samples of each batch (the batches are not necessarily
+    # in the order of the samples).
+    batches_indices = get_epoch_batches(dataloader)
+    prefetcher = BatchPrefetcher(dataloader, device,
+                                 depth=args.prefetch_device_batches)
+    wait_time, transfer_time = 0., 0.
+
+    # Nothing is random in evaluation: no need to re-seed per image.
     with torch.no_grad():
-        for i, (data, mask, label) in tqdm.tqdm(
-                enumerate(dataloader), ncols=80, total=length):
+        for i, (data, mask, labels, valid) in tqdm.tqdm(
+                enumerate(prefetcher), ncols=80, total=length):
 
-            reproducibility.force_seed(myseed + epoch + 1)
+            profiler.step(name_set, epoch, i)
+            timer.add("data_wait", prefetcher.wait_time - wait_time)
+            wait_time = prefetcher.wait_time
+            # The batch is already on the device (by the prefetcher).
+            if prefetcher.depth == 0:
+                timer.add("h2d", prefetcher.transfer_time - transfer_time)
+                transfer_time = prefetcher.transfer_time
 
-            msg = "Expected a batch size of 1. Found `{}`  .... " \
-                  "[NOT OK]".format(data.size()[0])
-            assert data.size()[0] == 1, msg
             bsz = data.size()[0]
-
-            data = data.to(device)
-            labels = label.to(device)
-            mask = torch.tensor(mask[0])
-            mask_t = mask.unsqueeze(0).to(device)
-            assert mask_t.ndim == 4, "ndim = {} must be 4.".format(mask_t.ndim)
-
-            # In validation, we do not need reproducibility since everything
-            # is expected to deterministic. Plus,
-            # we use only one gpu since the batch size os 1.
-            scores_pos, scores_neg, mask_pred, sc_cl_se = model(x=data,
-                                                               seed=None
-                                                                )
-            t_loss, l_p, l_n, l_seg = criterion(scores_pos,
-                                                sc_cl_se,
-                                                labels,
-                                                mask_pred,
-                                                scores_neg
-                                               )
-
-
-            mask_pred = mask_pred.squeeze()
-            # check sizes of the mask:
-            _, _, h, w = mask_t.shape
-            hp, wp = mask_pred.shape
-
-            if (h != hp) or (w != wp):  # This means that we have padded the
-                # input image. We crop the predicted mask in the center.
-                mask_pred = mask_pred[int(hp / 2) - int(h / 2): int(hp / 2) + int(h / 2) + (h % 2),
-                                      int(wp / 2) - int(w / 2): int(wp / 2) + int(w / 2) + (w % 2)]
-
-            mask_pred = mask_pred.unsqueeze(0).unsqueeze(0)
-
-            acc, dice_forg, dice_back, miou = metrics(
-                scores=scores_pos,
-                labels=labels,
-                masks_pred=mask_pred.contiguous().view(bsz, -1),
-                masks_trg=mask_t.contiguous().view(bsz, -1),
-                avg=False
-            )
-
-            # tracking
-            f1pos_ += dice_forg
-            f1neg_ += dice_back
-            miou_ += miou
-            acc_ += acc
+            indices = batches_indices[i]
+            msg = "Batch {}: found {} samples. Expected {} .... " \
+                  "[NOT OK]".format(i, bsz, len(indices))
+            assert bsz == len(indices), msg
+
+            valid_sizes = valid.tolist()
+            tiled = (tiler is not None) and tiler.exceeds(data.shape[2],
+                                                          data.shape[3])
+
+            if tiled:
+                # Too large to be processed at once.
+                tiled_fd = tempfile.mkdtemp()
+                tiled_outs = [evaluate_tiled(tiler,
+                                             metrics,
+                                             data[k, :, :hv, :wv],
+                                             mask[k],
+                                             join(tiled_fd, "{}.npy".format(k))
+                                             )
+                              for k, (hv, wv) in enumerate(valid_sizes)]
+                scores_pos = torch.cat([out[2] for out in tiled_outs], dim=0)
+                sc_cl_se = torch.cat([out[1] for out in tiled_outs], dim=0)
+                scores_neg, mask_pred = None, None
+            else:
+                # In validation, we do not need reproducibility since
+                # everything is expected to deterministic.
+                # X- is needed only for the regularization over the
+                # background.
+                # The outputs of each image do not depend on the other
+                # images of the (padded) batch.
+                scores_pos, scores_neg, mask_pred, sc_cl_se = model(
+                    x=data,
+                    seed=None,
+                    neg_ratio=1. if args.use_reg else 0.,
+                    valid=valid
+                )
+            with timer.stage("loss"):
+                t_loss, l_p, l_n, l_seg = criterion(scores_pos,
+                                                    sc_cl_se,
+                                                    labels,
+                                                    mask_pred,
+                                                    scores_neg
+                                                    )
+
+            # the losses are averaged over the batch.
+            tracker.add(weight=bsz, total_loss=t_loss, loss_pos=l_p,
+                        loss_neg=l_n)
             cnt += bsz
-            total_loss_ += t_loss.item()
-            loss_pos_ += l_p.item()
-            loss_neg_ += l_n.item()
-
-            if (folderout is not None) and store_on_disc:
-                # binary mask
-                bin_pred_mask = metrics.get_binary_mask(mask_pred).squeeze()
-                bin_pred_mask = bin_pred_mask.cpu().detach().numpy().astype(np.bool)
-                to_save = {
-                    "bin_pred_mask": bin_pred_mask,
-                    "dice_forg": dice_forg,
-                    "dice_back": dice_back,
-                    "i": i
-                }
-
-                with open(join(bin_masks_fd, "{}.pkl".format(i)), "wb") as fbin:
-                    pkl.dump(to_save, fbin, protocol=pkl.HIGHEST_PROTOCOL)
-
-            if (folderout is not None) and store_imgs and store_on_disc:
-                pred_label = int(scores_pos.argmax().item())
-                probs = softmax(scores_pos.cpu().detach().numpy())
-                prob = float(probs[0, pred_label])
-
-                store_pred_img(i,
-                               dataset,
-                               bin_pred_mask * 1.,
-                               mask_pred.squeeze().cpu().detach().numpy(),
-                               dice_forg,
-                               dice_back,
-                               prob,
-                               pred_label,
-                               args,
-                               mask_fd,
-                               )
 
+            for k, idx in enumerate(indices):
+                mask_t = mask[k].unsqueeze(0).to(device)
+                assert mask_t.ndim == 4, "ndim = {} must be 4.".format(
+                    mask_t.ndim)
+
+                _, _, h, w = mask_t.shape
+                scores_pos_k = scores_pos[k: k + 1]
+
+                if tiled:
+                    # on disc, already cropped.
+                    mask_pred_k = tiled_outs[k][0]
+                    with timer.stage("metrics"):
+                        acc, dice_forg, dice_back, miou = \
+                            metrics.forward_counts(scores=scores_pos_k,
+                                                   labels=labels[k: k + 1],
+                                                   counts=tiled_outs[k][3],
+                                                   meter=meter
+                                                   )
+                else:
+                    # valid region of the image in the batch. If we have
+                    # padded the input image, we crop the predicted mask in
+                    # the center.
+                    hv, wv = valid_sizes[k]
+                    mask_pred_k = crop_center(mask_pred[k, 0, :hv, :wv], h, w)
+                    with timer.stage("metrics"):
+                        acc, dice_forg, dice_back, miou = metrics(
+                            scores=scores_pos_k,
+                            labels=labels[k: k + 1],
+                            masks_pred=mask_pred_k.contiguous().view(1, -1),
+                            masks_trg=mask_t.contiguous().view(1, -1),
+                            avg=False,
+                            meter=meter
+                        )
+
+                # tracking
+                f1pos_ += dice_forg
+                f1neg_ += dice_back
+                miou_ += miou
+                acc_ += acc
+
+                if (folderout is None) or not store_on_disc:
+                    continue
+
+                with timer.stage("storage"):
+                    # binary mask (see Metrics.binarize_mask()).
+                    if tiled:
+                        mask_con = np.asarray(mask_pred_k)
+                    else:
+                        mask_con = mask_pred_k.cpu().numpy()
+                    bin_pred_mask = mask_con >= metrics.threshold
+                    to_save = {
+                        "bin_pred_mask": bin_pred_mask,
+                        "dice_forg": dice_forg,
+                        "dice_back": dice_back,
+                        "i": idx
+                    }
+
+                    with open(join(bin_masks_fd, "{}.pkl".format(idx)),
+                              "wb") as fbin:
+                        pkl.dump(to_save, fbin, protocol=pkl.HIGHEST_PROTOCOL)
+
+                    if store_imgs:
+                        pred_label = int(scores_pos_k.argmax().item())
+                        probs = softmax(scores_pos_k.cpu().detach().numpy())
+                        prob = float(probs[0, pred_label])
+
+                        store_pred_img(idx,
+                                       dataset,
+                                       bin_pred_mask * 1.,
+                                       mask_con,
+                                       dice_forg,
+                                       dice_back,
+                                       prob,
+                                       pred_label,
+                                       args,
+                                       mask_fd,
+                                       )
+
+            if tiled:
+                del tiled_outs  # the memmaps of the predicted masks.
+                shutil.rmtree(tiled_fd)
+
+    profiler.stop()
 
     # avg
+    total_loss_ = tracker.sum("total_loss")
+    loss_pos_ = tracker.sum("loss_pos")
+    loss_neg_ = tracker.sum("loss_neg")
     total_loss_ /= float(cnt)
     loss_pos_ /= float(cnt)
     loss_neg_ /= float(cnt)
@@ -379,7 +616,7 @@ def validate(model,
 
     to_write = "EVAL ({}): TLoss: {:.2f}, L+: {:.2f}, L-: {:.2f}, " \
                "F1+: {:.2f}%, F1-: {:.2f}%, MIOU: {:.2f}%, ACC: {:.2f}%, " \
-               "t:{}, epoch {:>2d}.".format(
+               "t:{}, data wait: {:.2f}s, epoch {:>2d}.".format(
         name_set,
         total_loss_,
         loss_pos_,
@@ -389,8 +626,14 @@ def validate(model,
         miou_,
         acc_,
         dt.datetime.now() - t0,
+        prefetcher.wait_time,
         epoch
         )
+    # Dataset-level metrics: from the confusion counts of all the pixels.
+    f1pos_ds, f1neg_ds, miou_ds = meter.compute()
+    to_write += "\nEVAL ({}): dataset-level: F1+: {:.2f}%, F1-: {:.2f}%, " \
+                "MIOU: {:.2f}%.".format(name_set, f1pos_ds * 100.,
+                                        f1neg_ds * 100., miou_ds * 100.)
     print(to_write)
     if log_file:
         log(log_file, to_write)
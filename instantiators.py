@@ -17,16 +17,18 @@ def instantiate_train_loss(args):
      read from the yaml file.
     :return: eval_loss: instance of deepmil.criteria.TotalLossEval()
     """
-    return criteria.TrainLoss(use_reg=args.use_reg,
-                              reg_loss=args.reg_loss,
-                              use_size_const=args.use_size_const,
-                              init_t=args.init_t,
-                              max_t=args.max_t,
-                              mulcoef=args.mulcoef,
-                              normalize_sz=args.normalize_sz,
-                              epsilon=args.epsilon,
-                              lambda_neg=args.lambda_neg
-                              )
+    loss_class = criteria.FusedTrainLoss if args.fused_loss else \
+        criteria.TrainLoss
+    return loss_class(use_reg=args.use_reg,
+                      reg_loss=args.reg_loss,
+                      use_size_const=args.use_size_const,
+                      init_t=args.init_t,
+                      max_t=args.max_t,
+                      mulcoef=args.mulcoef,
+                      normalize_sz=args.normalize_sz,
+                      epsilon=args.epsilon,
+                      lambda_neg=args.lambda_neg
+                      )
 
 
 def instantiate_models(args):
@@ -52,9 +54,15 @@ def instantiate_models(args):
                                           kmax=p.kmax,
                                           kmin=p.kmin,
                                           alpha=p.alpha,
-                                          dropout=p.dropout
+                                          dropout=p.dropout,
+                                          batch_pos_neg=p.batch_pos_neg,
+                                          lowres_mask=p.lowres_mask,
+                                          fused_mask=p.fused_mask
                                           )
 
+    if p.fold_heads:
+        model.set_fold_heads(True)
+
     print("Mi-max entropy model `{}` was successfully instantiated. "
           "Nbr.params: {} .... [OK]".format(
         model.__class__.__name__, count_nb_params(model)))
@@ -1,9 +1,18 @@
 import csv
+import os
 from os.path import join
 import collections
 import copy
 import warnings
 import datetime as dt
+import hashlib
+import pickle as pkl
+import time
+import ctypes
+import threading
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import PIL
 from PIL import Image
@@ -13,14 +22,29 @@ import tqdm
 import torchvision.transforms.functional as TF
 from torchvision import transforms
 from torch.utils.data import Dataset
+from torch.utils.data import Sampler
+from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
 import torch
 import torch.nn.functional as F
 
 
 import reproducibility
+from tools import SeededCompose
+from tools import shared_array_multi_processes
 
 
-__all__ = ["PhotoDataset", "default_collate", "_init_fn"]
+__all__ = ["PhotoDataset", "DecodedImageStore", "EvalSampleCache", "BucketBatchSampler", "SeededRandomSampler",
+           "RepeatedBatchSampler", "PersistentDataLoader", "ThreadedDataLoader", "BatchPrefetcher",
+           "get_epoch_batches", "default_collate", "stack_collate",
+           "pad_collate", "decode_masks", "_init_fn"]
+
+# Number of epochs whose per-sample seeds are kept in the shared seed table of PhotoDataset (see
+# PhotoDataset.set_up_new_seeds(), RepeatedBatchSampler).
+NBR_SEED_SLOTS = 2
+
+# Encodings of the masks returned by PhotoDataset (see PhotoDataset.encode_mask()).
+MASK_TRANSPORTS = ["float", "uint8", "packed"]
 
 
 def default_collate(batch):
@@ -55,6 +79,91 @@ def default_collate(batch):
     return data, mask, target
 
 
+def stack_tensors(tensors):
+    """
+    Stack tensors of the same shape. Inside a dataloader worker, the output is allocated directly in shared memory
+    (as torch's default collate does) to avoid a copy when it is sent to the main process (where it is pinned if
+    pin_memory=True).
+    :param tensors: list of torch.Tensor of the same shape and type.
+    :return: torch.Tensor.
+    """
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        numel = sum([t.numel() for t in tensors])
+        storage = tensors[0].storage()._new_shared(numel)
+        out = tensors[0].new(storage)
+    return torch.stack(tensors, 0, out=out)
+
+
+def stack_collate(batch):
+    """
+    Collate function for the samples that have the same size (training with a random crop), in particular with the
+    uint8 transport (PhotoDataset(uint8_output=True, mask_transport="uint8" or "packed")): the images and the masks
+    are stacked into tensors allocated in shared memory (see stack_tensors()), and they are converted into float on the
+    consumer side (see tools.BatchAugmenter, decode_masks()).
+
+    :param batch: list of tuples (img, mask, label)
+    :return: 3 elements: tensor data, tensor of masks (encoded. see PhotoDataset.encode_mask()), tensor of labels.
+    """
+    data = stack_tensors([item[0] for item in batch])
+    mask = stack_tensors([item[1] for item in batch])
+    target = torch.LongTensor([item[2] for item in batch])
+
+    return data, mask, target
+
+
+def pad_collate(batch):
+    """
+    Collate function for the evaluation samples that do not have the same size (see BucketBatchSampler): the images
+    are padded with zeros (bottom, right) to the largest height/width of the batch, and the size of each image (its
+    valid region in the padded batch) is recorded. The masks are kept as a list (as in default_collate()).
+
+    :param batch: list of tuples (img, mask, label)
+    :return: 4 elements: tensor data (b, c, h_max, w_max), list of tensors of masks, tensor of labels, tensor (b, 2)
+    of long: the valid region (h, w) of each image (top-left corner).
+    """
+    sizes = [tuple(item[0].shape[1:]) for item in batch]
+    h_max = max([sz[0] for sz in sizes])
+    w_max = max([sz[1] for sz in sizes])
+    c = batch[0][0].shape[0]
+    data = batch[0][0].new_zeros((len(batch), c, h_max, w_max))
+    for k, item in enumerate(batch):
+        h, w = sizes[k]
+        data[k, :, :h, :w] = item[0]
+
+    mask = [item[1] for item in batch]  # each element is of size (1, h, w).
+    target = torch.LongTensor([item[2] for item in batch])
+    valid = torch.LongTensor(sizes)
+
+    return data, mask, target, valid
+
+
+def decode_masks(masks, h, w):
+    """
+    Decode a batch of masks into float. Inverse of PhotoDataset.encode_mask() over a batch. Can be done on the device
+    (the encoded masks are smaller to transfer).
+    :param masks: list of torch.Tensor float of shape (1, h, w) (see default_collate()), or torch.Tensor float of
+    shape (b, 1, h, w), or torch.Tensor uint8 of shape (b, 1, h, w) in {0, 1}, or torch.Tensor uint8 of shape
+    (b, ceil(h * w / 8)) (bit-packed masks).
+    :param h: int, height of the masks.
+    :param w: int, width of the masks.
+    :return: torch.Tensor float of shape (b, 1, h, w) in {0, 1}.
+    """
+    if isinstance(masks, (list, tuple)):
+        masks = torch.stack(masks)
+    if masks.is_floating_point():
+        return masks
+    if masks.dim() == 4:
+        return masks.float()
+
+    msg = "Expected bit-packed masks of shape (b, n). found {} .... [NOT OK]".format(tuple(masks.shape))
+    assert masks.dim() == 2 and masks.dtype == torch.uint8, msg
+    b = masks.shape[0]
+    bits = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=masks.device)
+    masks = (masks.unsqueeze(-1) & bits) > 0  # big-endian, as numpy.packbits().
+    return masks.view(b, -1)[:, :h * w].contiguous().view(b, 1, h, w).float()
+
+
 def _init_fn(worker_id):
     """
     Init. function for the worker in dataloader.
@@ -77,6 +186,504 @@ def csv_loader(fname, rootpath):
     return out
 
 
+def load_binary_mask(path_mask, dataset_name):
+    """
+    Read a mask from disc and binarize it.
+    :param path_mask: str, path to the mask.
+    :param dataset_name: str, name of the dataset.
+    :return: PIL.Image.Image L with values in {0, 255}.
+    """
+    mask = Image.open(path_mask, "r").convert("L")
+
+    # GLAS: a pixel belongs to the mask if its value > 0.
+    # Convert mask into binary. In the provided masks, the non-gland regions are 0, while the glands are
+    # enumerated as 1, 2, 3, 4, .... Therefore, the new binary mask contains only the values {0, 1},
+    # where 0 indicates non-gland regions, while 1 indicates gland-regions.
+
+    # Masks are used only for evaluation once the training is finished. They are not used for any reason
+    # during training. Therefore, we keep their format as PIL.Image.Image.
+
+    # Caltech-UCSD-Birds-200-2011: a pixel belongs to the mask if its value > 255/2. (an image is annotated
+    # by many workers. If more than half of the workers agreed on the pixel to be a bird, we consider that
+    # pixel as a bird.
+
+    # Oxford-flowers-102: a pixel belongs to the mask if its value > 0. The mask has only {0, 255} as values. The
+    # new binary mask will contain only {0, 1} values where 0 is the background and 1 is the foreground.
+    mask_np = np.array(mask)
+    if dataset_name == "glas":
+        mask_np = (mask_np != 0).astype(np.uint8)
+    elif dataset_name == "Caltech-UCSD-Birds-200-2011":
+        mask_np = (mask_np > (255 / 2.)).astype(np.uint8)
+    elif dataset_name == 'Oxford-flowers-102':
+        mask_np = (mask_np != 0).astype(np.uint8)
+    else:
+        raise ValueError("Dataset name {} unsupported. Exiting .... [NOT OK]".format(dataset_name))
+
+    mask = Image.fromarray(mask_np * 255, mode="L")
+
+    return mask
+
+
+def decode_sample(path_img, path_mask, dataset_name, resize=None):
+    """
+    Read from disc and decode an image and its mask. The mask is binarized.
+    Module-level function so it can be sent to a pool of processes (see PhotoDataset.iter_decoded_samples()).
+
+    :param path_img: str, path to the image.
+    :param path_mask: str, path to the mask.
+    :param dataset_name: str, name of the dataset.
+    :param resize: None or (w, h).
+    :return: img, mask, original size of the image (w, h).
+    """
+    img = Image.open(path_img, "r").convert("RGB")
+    mask = load_binary_mask(path_mask, dataset_name)
+    size = img.size
+
+    if resize:
+        img = img.resize(resize)
+        mask = mask.resize(resize)
+
+    return img, mask, size
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar sizes. The size of each sample is rounded up to a multiple of
+    `multiple`: samples with the same rounded size are in the same bucket, and each bucket is split into batches of at
+    most `batch_size` samples. The buckets are visited in the order of their first sample. The padding of a batch (see
+    pad_collate()) is at most `multiple - 1` pixels per dimension. With `multiple=1`, only the samples with the same
+    size are batched together (no padding).
+    """
+    def __init__(self, sizes, batch_size, multiple=1):
+        """
+        Init. function.
+        :param sizes: list of (h, w) of the samples (see PhotoDataset.get_prepared_size()).
+        :param batch_size: int > 0. Maximum size of a batch.
+        :param multiple: int > 0. The sizes are rounded up to a multiple of it to form the buckets.
+        """
+        super(BucketBatchSampler, self).__init__(None)
+        msg = "'batch_size' must be > 0. found {} .... [NOT OK]".format(batch_size)
+        assert batch_size > 0, msg
+        msg = "'multiple' must be > 0. found {} .... [NOT OK]".format(multiple)
+        assert multiple > 0, msg
+
+        self.batch_size = batch_size
+        self.multiple = multiple
+
+        buckets = collections.OrderedDict()
+        for index, (h, w) in enumerate(sizes):
+            key = (- (- h // multiple) * multiple, - (- w // multiple) * multiple)
+            buckets.setdefault(key, []).append(index)
+
+        self.batches = []
+        for indices in buckets.values():
+            for k in range(0, len(indices), batch_size):
+                self.batches.append(indices[k: k + batch_size])
+        self.nbr_buckets = len(buckets)
+
+    def __iter__(self):
+        return iter([list(batch) for batch in self.batches])
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __repr__(self):
+        return "{}(batch_size={}, multiple={}, buckets={}, batches={})".format(
+            self.__class__.__name__, self.batch_size, self.multiple, self.nbr_buckets, len(self.batches))
+
+
+class SeededRandomSampler(Sampler):
+    """
+    Random sampler (as torch.utils.data.RandomSampler) whose order at each pass (epoch) is drawn from a generator
+    derived from (seed, pass) (see reproducibility.SeedStream) instead of the global state. The order does not depend
+    on the moment the pass starts (a persistent loader starts the next pass before the end of the current one).
+    """
+    def __init__(self, n, base_seed):
+        """
+        Init. function.
+        :param n: int, number of samples.
+        :param base_seed: int, the seed of the experiment.
+        """
+        super(SeededRandomSampler, self).__init__(None)
+        self.n = n
+        self.seed_stream = reproducibility.SeedStream(base_seed, reproducibility.STREAM_SHUFFLE)
+        self.pass_ = 0
+
+    def __iter__(self):
+        generator = self.seed_stream.torch_generator(self.pass_)
+        self.pass_ += 1
+        return iter(torch.randperm(self.n, generator=generator).tolist())
+
+    def __len__(self):
+        return self.n
+
+
+class RepeatedBatchSampler(object):
+    """
+    Repeat a batch sampler forever: each pass over it is an epoch. At the start of each pass, the seeds of the new
+    epoch are set up in the shared seed table of the dataset (PhotoDataset.set_up_new_seeds()), and the indices of the
+    pass are encoded with their slot (PhotoDataset.encode_index()): the workers that are still preparing the samples
+    of the previous epoch keep using the seeds of the previous epoch.
+    """
+    def __init__(self, batch_sampler, dataset):
+        """
+        Init. function.
+        :param batch_sampler: iterable of lists of indices (one epoch).
+        :param dataset: PhotoDataset.
+        """
+        self.batch_sampler = batch_sampler
+        self.dataset = dataset
+
+    def __iter__(self):
+        while True:
+            slot = self.dataset.set_up_new_seeds()
+            for batch in self.batch_sampler:
+                yield [self.dataset.encode_index(index, slot) for index in batch]
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class PersistentDataLoader(DataLoader):
+    """
+    DataLoader whose workers are forked once and kept alive across the epochs (torch < 1.7 has no
+    `persistent_workers`): it iterates over one single iterator of RepeatedBatchSampler, and each `for` loop over it
+    consumes one epoch (len(self) batches). Epoch transitions cost nothing: the workers are not re-forked (and the
+    preloaded samples are not copied again), and they keep prefetching across the epochs.
+
+    The per-sample seeds of each epoch are set up by the sampler in the shared seed table of the dataset: do not call
+    dataset.set_up_new_seeds() yourself. Each epoch must be consumed entirely.
+    """
+    def __init__(self,
+                 dataset,
+                 batch_size=1,
+                 shuffle=False,
+                 sampler=None,
+                 batch_sampler=None,
+                 num_workers=0,
+                 drop_last=False,
+                 **kwargs
+                 ):
+        """
+        Init. function. Same arguments as torch.utils.data.DataLoader. The batch sampler of one epoch is built here,
+        and the DataLoader iterates over its RepeatedBatchSampler.
+        """
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        # One epoch.
+        self.epoch_batch_sampler = batch_sampler
+        # The workers prefetch 2 batches each: they must not prepare samples of more than NBR_SEED_SLOTS epochs at
+        # once.
+        if len(batch_sampler) < 2 * num_workers:
+            warnings.warn("An epoch has {} batches only: the number of workers is reduced from {} to {}.".format(
+                len(batch_sampler), num_workers, len(batch_sampler) // 2))
+            num_workers = len(batch_sampler) // 2
+
+        super(PersistentDataLoader, self).__init__(dataset,
+                                                   batch_sampler=RepeatedBatchSampler(batch_sampler, dataset),
+                                                   num_workers=num_workers,
+                                                   **kwargs)
+        self.iterator = None
+
+    def __len__(self):
+        return len(self.epoch_batch_sampler)
+
+    def __iter__(self):
+        if self.iterator is None:
+            self.iterator = super(PersistentDataLoader, self).__iter__()
+        for _ in range(len(self)):
+            yield next(self.iterator)
+
+
+class ThreadedDataLoader(object):
+    """
+    In-process data loader: the samples are prepared by a pool of threads of the main process (PIL and numpy release
+    the GIL while decoding/resizing/copying), and `prefetch_batches` batches are prepared in advance. There is no
+    process to fork at each epoch, and no sample to pickle between processes. Well suited to small datasets that are
+    preloaded in memory (e.g. GlaS), and to the evaluation with a small batch size.
+
+    Same interface as torch.utils.data.DataLoader for our usage (iteration, len(), batch_sampler). The pool of threads
+    is created once and kept across the epochs. The per-sample randomness must be drawn from the generator of the
+    sample (seeded transforms, see tools.SeededCompose): the global state is shared by the threads.
+    """
+    def __init__(self,
+                 dataset,
+                 batch_size=1,
+                 shuffle=False,
+                 sampler=None,
+                 batch_sampler=None,
+                 num_workers=4,
+                 collate_fn=default_collate,
+                 pin_memory=False,
+                 drop_last=False,
+                 prefetch_batches=2
+                 ):
+        """
+        Init. function.
+        :param dataset: PhotoDataset.
+        :param batch_size: int > 0. Size of the batches (if batch_sampler is None).
+        :param shuffle: bool. If True, the samples are shuffled at each epoch (if sampler and batch_sampler are None).
+        :param sampler: None or torch.utils.data.Sampler of the samples.
+        :param batch_sampler: None or iterable of lists of indices (one epoch).
+        :param num_workers: int > 0. Number of threads preparing the samples.
+        :param collate_fn: function that collates a list of samples.
+        :param pin_memory: bool. If True and cuda is available, the tensors of the batches are pinned.
+        :param drop_last: bool. Same as in DataLoader.
+        :param prefetch_batches: int > 0. Number of batches prepared in advance.
+        """
+        msg = "'num_workers' must be > 0. found {} .... [NOT OK]".format(num_workers)
+        assert num_workers > 0, msg
+        msg = "'prefetch_batches' must be > 0. found {} .... [NOT OK]".format(prefetch_batches)
+        assert prefetch_batches > 0, msg
+        transform_img = getattr(dataset, "transform_img", None)
+        msg = "The threads share the global random state: the transforms must be seeded (tools.SeededCompose). " \
+              "found {} .... [NOT OK]".format(transform_img)
+        assert transform_img is None or isinstance(transform_img, SeededCompose), msg
+
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.num_workers = num_workers
+        self.collate_fn = collate_fn
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.prefetch_batches = prefetch_batches
+        self.executor = None
+
+    def get_executor(self):
+        """
+        Returns the pool of threads (created at the first use, then kept).
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        return self.executor
+
+    def submit(self, indices):
+        """
+        Submit the preparation of the samples of a batch.
+        :param indices: list of int.
+        :return: list of concurrent.futures.Future.
+        """
+        executor = self.get_executor()
+        return [executor.submit(self.dataset.__getitem__, index) for index in indices]
+
+    def pin(self, batch):
+        """
+        Pin the tensors of a batch.
+        """
+        if isinstance(batch, torch.Tensor):
+            return batch.pin_memory()
+        if isinstance(batch, (list, tuple)):
+            return type(batch)([self.pin(item) for item in batch])
+        return batch
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        pending = collections.deque()
+        for indices in batches:
+            pending.append(self.submit(indices))
+            if len(pending) == self.prefetch_batches:
+                break
+
+        while pending:
+            futures = pending.popleft()
+            # keep the pool busy while this batch is collated/consumed.
+            indices = next(batches, None)
+            if indices is not None:
+                pending.append(self.submit(indices))
+
+            batch = self.collate_fn([future.result() for future in futures])
+            yield self.pin(batch) if self.pin_memory else batch
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __del__(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class BatchPrefetcher(object):
+    """
+    Iterate over a dataloader on a background thread that keeps `depth` batches ready: collated, prepared (e.g.
+    masks stacked), pinned, moved to the device (on a side cuda stream), and converted on the device (e.g. masks
+    decoded). The preparation of the next batches overlaps the computation over the current one.
+
+    The time the consumer waited for the batches during the last iteration is in self.wait_time (seconds).
+    With depth=0, the batches are prepared synchronously (no thread): self.wait_time is the time spent fetching them
+    from the dataloader, and self.transfer_time the time spent preparing, moving and converting them.
+    """
+    _END = object()  # end of the iteration.
+
+    def __init__(self, dataloader, device, depth=2, prepare=None, convert=None):
+        """
+        Init. function.
+        :param dataloader: iterable of batches (DataLoader, ThreadedDataLoader, ...).
+        :param device: torch.device where to move the batches.
+        :param depth: int >= 0. Number of batches kept ready. 0: no background thread.
+        :param prepare: None or function applied to a batch on the host before moving it (e.g. stack_masks_batch()).
+        :param convert: None or function applied to a batch once on the device (e.g. decode_masks_batch()).
+        """
+        msg = "'depth' must be >= 0. found {} .... [NOT OK]".format(depth)
+        assert depth >= 0, msg
+
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+        self.prepare = prepare
+        self.convert = convert
+        self.use_cuda = (device.type == "cuda") and torch.cuda.is_available()
+        self.wait_time = 0.
+        self.transfer_time = 0.  # only with depth=0. Otherwise, done in the background.
+
+    def to_device(self, batch):
+        """
+        Move (recursively) the tensors of a batch to self.device. They are pinned first when moving to cuda.
+        """
+        if isinstance(batch, torch.Tensor):
+            if self.use_cuda and not batch.is_pinned():
+                batch = batch.pin_memory()
+            return batch.to(self.device, non_blocking=self.use_cuda)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)([self.to_device(item) for item in batch])
+        return batch
+
+    def record_stream(self, batch, stream):
+        """
+        Mark (recursively) the cuda tensors of a batch as used by `stream` (they were allocated on the side stream).
+        """
+        if isinstance(batch, torch.Tensor):
+            if batch.is_cuda:
+                batch.record_stream(stream)
+        elif isinstance(batch, (list, tuple)):
+            for item in batch:
+                self.record_stream(item, stream)
+
+    def process(self, batch):
+        """
+        Prepare, move and convert a batch (on the current stream).
+        """
+        if self.prepare is not None:
+            batch = self.prepare(batch)
+        batch = self.to_device(batch)
+        if self.convert is not None:
+            batch = self.convert(batch)
+        return batch
+
+    def worker(self, out, stop):
+        """
+        Background thread: prepare the batches, and put them in the queue `out` (with the cuda event that marks the
+        end of their transfer, or None).
+        """
+        try:
+            stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+            iterator = iter(self.dataloader)
+            while True:
+                # Check before fetching: no batch is consumed after the stop (a persistent loader keeps its stream
+                # of batches, and its seeds, across the epochs).
+                if stop.is_set():
+                    break
+                batch = next(iterator, self._END)
+                if batch is self._END:
+                    break
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self.process(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self.process(batch)
+                out.put((batch, event))
+            out.put(self._END)
+        except BaseException:
+            out.put(sys.exc_info())
+
+    def __iter__(self):
+        self.wait_time = 0.
+        self.transfer_time = 0.
+        if self.depth == 0:
+            iterator = iter(self.dataloader)
+            while True:
+                t0 = time.perf_counter()
+                batch = next(iterator, self._END)
+                self.wait_time += time.perf_counter() - t0
+                if batch is self._END:
+                    return
+                t0 = time.perf_counter()
+                batch = self.process(batch)
+                self.transfer_time += time.perf_counter() - t0
+                yield batch
+
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.worker, args=(out, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                item = out.get()
+                self.wait_time += time.perf_counter() - t0
+                if item is self._END:
+                    return
+                if len(item) == 3:  # exception of the worker.
+                    raise item[1].with_traceback(item[2])
+
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    self.record_stream(batch, current)
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():  # unblock the worker.
+                try:
+                    out.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(timeout=0.01)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+
+def stack_masks_batch(batch):
+    """
+    Stack the list of masks of a training batch (data, masks, labels) (see default_collate()). Used as `prepare` of
+    BatchPrefetcher.
+    """
+    data, masks, labels = batch
+    if isinstance(masks, list):
+        masks = torch.stack(masks)
+    return data, masks, labels
+
+
+def decode_masks_batch(batch):
+    """
+    Decode the masks of a training batch (data, masks, labels) (see decode_masks()). Used as `convert` of
+    BatchPrefetcher.
+    """
+    data, masks, labels = batch
+    return data, decode_masks(masks, data.shape[2], data.shape[3]), labels
+
+
+def get_epoch_batches(dataloader):
+    """
+    Returns the batches of indices of one epoch of a dataloader (DataLoader or PersistentDataLoader).
+    :param dataloader: torch.utils.data.DataLoader.
+    :return: list of lists of int.
+    """
+    if isinstance(dataloader, BatchPrefetcher):
+        dataloader = dataloader.dataloader
+    return list(getattr(dataloader, "epoch_batch_sampler", dataloader.batch_sampler))
+
+
 class MyDataParallel(torch.nn.DataParallel):
     """
     Allow nn.DataParallel to call model's attributes.
@@ -118,10 +725,12 @@ class MyRandomCropper(transforms.RandomCrop):
     Class inherits from transforms.RandomCrop(). It does exactly the same thing, except, it returns the coordinates of
     along with the crop.
     """
-    def __call__(self, img):
+    def __call__(self, img, rng=None):
         """
         Args:
             img (PIL Image): Image to be cropped.
+            rng (numpy.random.RandomState or None): generator of the crop coordinates. If None, the global `random`
+            module is used.
 
         Returns:
             PIL Image: Cropped image.
@@ -137,10 +746,340 @@ class MyRandomCropper(transforms.RandomCrop):
         if self.pad_if_needed and img.size[1] < self.size[0]:
             img = F.pad(img, (0, int((1 + self.size[0] - img.size[1]) / 2)))
 
-        i, j, h, w = self.get_params(img, self.size)
+        if rng is None:
+            i, j, h, w = self.get_params(img, self.size)
+        else:
+            i, j, h, w = self.get_seeded_params(img, self.size, rng)
 
         return TF.crop(img, i, j, h, w), (i, j, h, w)
 
+    @staticmethod
+    def get_seeded_params(img, output_size, rng):
+        """
+        Same as transforms.RandomCrop.get_params() but the randomness is drawn from `rng`.
+        :param img: PIL Image.
+        :param output_size: tuple (h, w) of the crop.
+        :param rng: numpy.random.RandomState.
+        :return: tuple (i, j, h, w).
+        """
+        w, h = img.size
+        return MyRandomCropper.get_seeded_params_size(w, h, output_size, rng)
+
+    @staticmethod
+    def get_seeded_params_size(w, h, output_size, rng):
+        """
+        Same as self.get_seeded_params() but using only the size of the image (the image does not need to exist).
+        :param w: int, width of the image.
+        :param h: int, height of the image.
+        :param output_size: tuple (h, w) of the crop.
+        :param rng: numpy.random.RandomState.
+        :return: tuple (i, j, h, w).
+        """
+        th, tw = output_size
+        if w == tw and h == th:
+            return 0, 0, h, w
+
+        i = rng.randint(0, h - th + 1)
+        j = rng.randint(0, w - tw + 1)
+        return i, j, th, tw
+
+
+class DecodedImageStore(object):
+    """
+    Store of decoded images and binary masks of a set of samples (a fold) on disc.
+
+    All the decoded pixels (uint8) are written once in one contiguous file, with an index (offset, shape) of each
+    image and mask. Then, the file is memory-mapped read-only. Every process (DataLoader workers, other experiments on
+    the same node) that opens it shares the same physical pages (page cache): the resident memory is O(dataset) instead
+    of O(workers x dataset), and once the file exists, opening it is nearly instant.
+
+    The memory-map is not pickled: a worker that receives a copy of the store re-opens the file lazily.
+    """
+    def __init__(self, path_data, path_index):
+        """
+        Init. function. Use DecodedImageStore.build() or DecodedImageStore.get_paths() to get the paths.
+        :param path_data: str, path to the file of the pixels.
+        :param path_index: str, path to the file of the index.
+        """
+        self.path_data = path_data
+        self.path_index = path_index
+
+        with open(path_index, "rb") as fin:
+            index = pkl.load(fin)
+        self.index_imgs = index["images"]  # list of (offset, h, w, c)
+        self.index_masks = index["masks"]  # list of (offset, h, w)
+        self.n = len(self.index_imgs)
+
+        self._data = None  # memory-map. opened lazily in each process.
+
+        self.images = _StoreView(self, masks=False)
+        self.masks = _StoreView(self, masks=True)
+
+    @staticmethod
+    def get_paths(store_dir, dataset_name, samples, resize):
+        """
+        Returns the paths of the files of the store of a set of samples. The name depends on the samples, so each
+        fold has its own store.
+        :param store_dir: str, folder of the stores.
+        :param dataset_name: str, name of the dataset.
+        :param samples: list of samples [path image, path mask, label].
+        :param resize: None or (w, h).
+        :return: path_data, path_index.
+        """
+        key = "{}|{}|{}".format(dataset_name, resize, "|".join(
+            ["{},{}".format(sample[0], sample[1]) for sample in samples]))
+        name = "{}-{}".format(dataset_name, hashlib.md5(key.encode("utf-8")).hexdigest())
+
+        return join(store_dir, name + ".bin"), join(store_dir, name + ".pkl")
+
+    @classmethod
+    def build(cls, path_data, path_index, samples, n):
+        """
+        Decode all the samples and write their pixels in the store. The files are written under temporary names,
+        then renamed, so a store that exists is always complete.
+
+        :param path_data: str, path to the file of the pixels.
+        :param path_index: str, path to the file of the index.
+        :param samples: iterable of (img, mask) in the order of the samples: PIL.Image.Image RGB, PIL.Image.Image L.
+        :param n: int, number of samples.
+        :return: instance of DecodedImageStore.
+        """
+        folder = os.path.dirname(path_data)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        tmp_data = "{}.tmp.{}".format(path_data, os.getpid())
+        tmp_index = "{}.tmp.{}".format(path_index, os.getpid())
+
+        index_imgs, index_masks = [], []
+        offset = 0
+        msg = "The store expects {} samples. found {} .... [NOT OK]"
+        with open(tmp_data, "wb") as fout:
+            for img, mask in samples:
+                img_np = np.asarray(img, dtype=np.uint8)
+                mask_np = np.asarray(mask, dtype=np.uint8)
+
+                index_imgs.append((offset,) + img_np.shape)
+                fout.write(np.ascontiguousarray(img_np).tobytes())
+                offset += img_np.nbytes
+
+                index_masks.append((offset,) + mask_np.shape)
+                fout.write(np.ascontiguousarray(mask_np).tobytes())
+                offset += mask_np.nbytes
+
+        assert len(index_imgs) == n, msg.format(n, len(index_imgs))
+
+        with open(tmp_index, "wb") as fout:
+            pkl.dump({"images": index_imgs, "masks": index_masks, "size": offset}, fout,
+                     protocol=pkl.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_data, path_data)
+        os.replace(tmp_index, path_index)
+
+        return cls(path_data, path_index)
+
+    @property
+    def data(self):
+        """
+        The memory-map (read-only) of the pixels. Opened at the first access in each process.
+        """
+        if self._data is None:
+            self._data = np.memmap(self.path_data, dtype=np.uint8, mode="r")
+        return self._data
+
+    def get_image_np(self, i):
+        """
+        Returns a read-only view (no copy) over the pixels of the image i.
+        :param i: int, index of the sample.
+        :return: numpy.ndarray uint8 of shape (h, w, 3).
+        """
+        offset, h, w, c = self.index_imgs[i]
+        return self.data[offset: offset + h * w * c].reshape(h, w, c)
+
+    def get_mask_np(self, i):
+        """
+        Returns a read-only view (no copy) over the pixels of the mask i.
+        :param i: int, index of the sample.
+        :return: numpy.ndarray uint8 of shape (h, w). values in {0, 255}.
+        """
+        offset, h, w = self.index_masks[i]
+        return self.data[offset: offset + h * w].reshape(h, w)
+
+    def get_image(self, i):
+        """
+        Returns the image i.
+        :param i: int, index of the sample.
+        :return: PIL.Image.Image RGB.
+        """
+        return Image.fromarray(self.get_image_np(i), mode="RGB")
+
+    def get_mask(self, i):
+        """
+        Returns the mask i.
+        :param i: int, index of the sample.
+        :return: PIL.Image.Image L.
+        """
+        return Image.fromarray(self.get_mask_np(i), mode="L")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None  # do not pickle the memory-map. It is re-opened in the process.
+        return state
+
+    def __len__(self):
+        return self.n
+
+
+class _StoreView(object):
+    """
+    List-like access to the images (or the masks) of a DecodedImageStore.
+    """
+    def __init__(self, store, masks=False):
+        self.store = store
+        self.is_masks = masks
+
+    def __getitem__(self, i):
+        if self.is_masks:
+            return self.store.get_mask(i)
+        return self.store.get_image(i)
+
+    def __len__(self):
+        return len(self.store)
+
+
+class EvalSampleCache(object):
+    """
+    Bounded LRU cache of evaluation samples that are ready to be converted into tensors.
+
+    Evaluation samples are deterministic: there is no need to upscale/pad them at every epoch. We store them in a
+    compact form: the image as uint8 (h, w, 3), and the binary mask bit-packed (1 bit per pixel). The float
+    conversion/normalization is done at each access (it is cheap compared to the upscaling). The total size of the
+    stored arrays never exceeds `max_bytes`: the least recently used samples are evicted first.
+    The cache is thread-safe (see ThreadedDataLoader).
+    """
+    def __init__(self, max_bytes):
+        """
+        Init. function.
+        :param max_bytes: int > 0. Maximum size (bytes) of the stored samples.
+        """
+        msg = "'max_bytes' must be > 0. found {}.".format(max_bytes)
+        assert max_bytes > 0, msg
+
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]  # locks can not be pickled.
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_entry_nbytes(entry):
+        """
+        Returns the size (bytes) of an entry.
+        """
+        img, mask, _, _, _ = entry
+        return img.nbytes + mask.nbytes
+
+    def get(self, index):
+        """
+        Returns the sample `index` or None if it is not in the cache.
+        :param index: int, index of the sample.
+        :return: None or (img, mask, target): numpy.ndarray uint8 (h, w, 3), numpy.ndarray float32 (h, w) in {0, 1},
+        int.
+        """
+        with self.lock:
+            entry = self.entries.get(index, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(index)
+        img, mask, shape, packed, target = entry
+        if packed:
+            mask = np.unpackbits(mask)[:shape[0] * shape[1]].reshape(shape).astype(np.float32)
+        else:
+            mask = mask.astype(np.float32) / 255.
+
+        return img, mask, target
+
+    @staticmethod
+    def encode(img, mask, target):
+        """
+        Convert a sample into the stored form (an entry of the cache).
+        :param img: PIL.Image.Image RGB.
+        :param mask: PIL.Image.Image L.
+        :param target: int.
+        :return: tuple, the entry.
+        """
+        img_np = np.array(img, dtype=np.uint8)
+        mask_np = np.array(mask, dtype=np.uint8)
+        packed = bool(np.all((mask_np == 0) | (mask_np == 255)))
+        if packed:
+            return img_np, np.packbits(mask_np != 0), mask_np.shape, True, target
+        return img_np, mask_np, mask_np.shape, False, target
+
+    def put(self, index, img, mask, target):
+        """
+        Store a sample. The least recently used samples are evicted if necessary.
+        :param index: int, index of the sample.
+        :param img: PIL.Image.Image RGB.
+        :param mask: PIL.Image.Image L.
+        :param target: int.
+        :return: bool. True if the sample has been stored (it may be larger than the whole cache).
+        """
+        return self.put_entry(index, self.encode(img, mask, target))
+
+    def put_entry(self, index, entry):
+        """
+        Store an entry (see self.encode()). The least recently used samples are evicted if necessary.
+        :param index: int, index of the sample.
+        :param entry: tuple, the entry.
+        :return: bool. True if the entry has been stored (it may be larger than the whole cache).
+        """
+        nbytes = self.get_entry_nbytes(entry)
+        if nbytes > self.max_bytes:
+            return False
+
+        with self.lock:
+            if index in self.entries:
+                self.nbytes -= self.get_entry_nbytes(self.entries.pop(index))
+
+            while self.nbytes + nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self.get_entry_nbytes(evicted)
+
+            self.entries[index] = entry
+            self.nbytes += nbytes
+
+        return True
+
+    def is_full_with(self, nbytes):
+        """
+        Returns True if storing `nbytes` more would evict a sample.
+        """
+        return self.nbytes + nbytes > self.max_bytes
+
+    def __contains__(self, index):
+        return index in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "{}(samples={}, size={:.2f}MB/{:.2f}MB, hits={}, misses={})".format(
+            self.__class__.__name__, len(self), self.nbytes / 2.**20, self.max_bytes / 2.**20, self.hits,
+            self.misses)
+
 
 class PhotoDataset(Dataset):
     """
@@ -159,7 +1098,14 @@ class PhotoDataset(Dataset):
                  padding_mode="reflect",
                  force_div_32=False,
                  up_scale_small_dim_to=None,
-                 do_not_save_samples=False
+                 do_not_save_samples=False,
+                 store_dir=None,
+                 preload_workers=0,
+                 preload_backend="thread",
+                 eval_cache_bytes=0,
+                 crop_first=False,
+                 uint8_output=False,
+                 mask_transport="float"
                  ):
         """
         :param data: A list of str absolute paths of the images of dataset.
@@ -186,7 +1132,10 @@ class PhotoDataset(Dataset):
                the number of workers if you use a batch
                size of 1).
         :param transform_img: a composition of transforms that performs over
-               images: torchvision.transforms.Compose().  or None.
+               images: tools.SeededCompose() (the randomness is drawn from
+               the generator of the sample), torchvision.transforms.Compose()
+               (the randomness is drawn from the global state, re-seeded
+               per sample), or None.
         :param resize: int, or sequence of two int (w, h), or None.
                The size to which the original image is resized.
                If None, the original image is used. (needed only when data
@@ -234,6 +1183,37 @@ class PhotoDataset(Dataset):
                since we will be processing the samples
                sequentially, and we want to avoid to load a sample ahead (no
                point of doing that).
+        :param store_dir: str or None. If not None, the preloaded images and
+               masks are decoded once into a memory-mapped store in this
+               folder (one per fold), and shared by all the workers and the
+               experiments on the node instead of being kept as PIL images in
+               each process. See DecodedImageStore.
+        :param preload_workers: int >= 0. Number of workers used to decode
+               the samples when preloading them (and to prepare them in
+               self.set_ready_eval()). 0: sequential.
+        :param preload_backend: str. `thread` (pool of threads. PIL
+               releases the GIL) or `process` (pool of processes) for the
+               decoding.
+        :param eval_cache_bytes: int >= 0. If > 0 and the samples are
+               deterministic (no random crop, no image transform. i.e.
+               evaluation with set_for_eval=False), the prepared samples are
+               kept in a bounded LRU cache of this size (bytes) across the
+               epochs. See EvalSampleCache and self.warm_eval_cache().
+        :param crop_first: bool. If True, in training, the random crop
+               window is drawn first (in the coordinates of the upscaled and
+               padded image), then, only the region of the original image
+               that falls inside it is upscaled and padded. Gives the same
+               crops as the default ordering (upscale, pad, then crop) with
+               much less work. See self.crop_first_sample().
+        :param uint8_output: bool. If True, the images are returned as
+               uint8 tensors (3, h, w) without `transform_tensor`: the
+               conversion to float, the normalization (and the augmentation)
+               are done per batch (see tools.BatchAugmenter).
+        :param mask_transport: str. Encoding of the returned masks (see
+               MASK_TRANSPORTS, self.encode_mask()): `float` (float32 (1, h,
+               w)), `uint8` (uint8 (1, h, w)) or `packed` (bit-packed uint8
+               (ceil(h * w / 8),)). Use loader.decode_masks() on the
+               consumer side.
         """
 
         if set_for_eval:
@@ -260,6 +1240,13 @@ class PhotoDataset(Dataset):
         self.name_classes = name_classes
         self.up_scale_small_dim_to = up_scale_small_dim_to
         self.do_not_save_samples = do_not_save_samples
+        self.store_dir = store_dir
+        self.store = None
+        self.preload_workers = preload_workers
+        self.preload_backend = preload_backend
+        self.eval_cache = None
+        if eval_cache_bytes > 0 and (not crop_size) and (transform_img is None) and (not set_for_eval):
+            self.eval_cache = EvalSampleCache(eval_cache_bytes)
 
         assert dataset_name in [
             "glas", "Caltech-UCSD-Birds-200-2011", "Oxford-flowers-102"], "dataset_name = {} unsupported. Please " \
@@ -278,6 +1265,14 @@ class PhotoDataset(Dataset):
         # case of list of samples, each sample is an absolute path to an image.
         self.samples = data
 
+        # Per-sample seeds are derived from (seed, epoch, index): they do not depend on the global state nor on the
+        # number of workers.
+        self.seed_stream = reproducibility.SeedStream(int(os.environ.get("MYSEED", reproducibility.DEFAULT_SEED)),
+                                                      reproducibility.STREAM_DATA)
+        # The seeds of the last NBR_SEED_SLOTS epochs live in shared memory: the persistent workers see the updates
+        # of self.set_up_new_seeds() (see PersistentDataLoader).
+        self.seed_table = shared_array_multi_processes((NBR_SEED_SLOTS, len(self.samples)), ctypes.c_int64)
+        self.seed_epoch = -1
         self.seeds = None
         self.set_up_new_seeds()  # set up seeds for the initialization.
 
@@ -302,6 +1297,11 @@ class PhotoDataset(Dataset):
                   "https://pytorch.org/docs/stable/torchvision/transforms.html#torchvision.transforms.functional.pad"
             assert padding_mode is not None, msg
         self.padding_mode = padding_mode
+        self.crop_first = crop_first
+        self.uint8_output = uint8_output
+        msg = "'mask_transport' must be in {}. found {} .... [NOT OK]".format(MASK_TRANSPORTS, mask_transport)
+        assert mask_transport in MASK_TRANSPORTS, msg
+        self.mask_transport = mask_transport
         self.n = len(self.samples)
         self.images = []
         self.original_images_size = [None for _ in range(len(self))]
@@ -328,17 +1328,55 @@ class PhotoDataset(Dataset):
 
     def set_up_new_seeds(self):
         """
-        Set up new seed for each sample.
-        :return:
+        Set up new seed for each sample. Called once per epoch.
+        The seeds are written in place in the slot of the epoch of the shared seed table. self.seeds is a view of it.
+        :return: int, the slot of the seed table of the new epoch.
+        """
+        self.seed_epoch += 1
+        slot = self.seed_epoch % NBR_SEED_SLOTS
+        self.seed_table[slot] = self.get_new_seeds()
+        self.seeds = self.seed_table[slot]
+        return slot
+
+    def encode_index(self, index, slot):
+        """
+        Encode the index of a sample with the slot of the seed table of its epoch. Used by the persistent loaders
+        whose workers may prepare the samples of two epochs at once. See self.decode_index().
+        :param index: int, the index of the sample within the whole dataset.
+        :param slot: int, the slot of the seed table.
+        :return: int >= len(self).
+        """
+        return index + self.n * (1 + slot)
+
+    def decode_index(self, index):
         """
-        self.seeds = self.get_new_seeds()
+        Decode an index received by self.__getitem__(): an index < len(self) uses the seeds of the current epoch of
+        this process. Otherwise, it is encoded with the slot of the seed table of its epoch (see self.encode_index()).
+        :param index: int.
+        :return: index, seeds: int, the index of the sample, numpy.ndarray, the seeds of its epoch.
+        """
+        if index < self.n:
+            return index, self.seeds
+        slot, index = divmod(index - self.n, self.n)
+        return index, self.seed_table[slot]
 
     def get_new_seeds(self):
         """
-        Generate a seed per sample.
-        :return:
+        Generate a seed per sample for the current epoch (self.seed_epoch).
+        :return: numpy.ndarray of seeds.
+        """
+        return np.array([self.seed_stream.seed(self.seed_epoch, i) for i in range(len(self))], dtype=np.int64)
+
+    def get_sample_rng(self, index, seeds=None):
+        """
+        Returns the generator of the sample `index` for the current epoch. All the randomness of the sample (crop,
+        augmentations) is drawn from it.
+        :param index: int, index of the sample.
+        :param seeds: None or numpy.ndarray, the seeds of the epoch. If None, self.seeds.
+        :return: numpy.random.RandomState.
         """
-        return np.random.randint(0, 10000, len(self))
+        seeds = self.seeds if seeds is None else seeds
+        return np.random.RandomState(seeds[index])
 
     def get_original_input_img(self, i):
         """
@@ -354,35 +1392,7 @@ class PhotoDataset(Dataset):
         :param i: index of the sample.
         :return:
         """
-        mask = Image.open(self.samples[i][1], "r").convert("L")
-
-        # GLAS: a pixel belongs to the mask if its value > 0.
-        # Convert mask into binary. In the provided masks, the non-gland regions are 0, while the glands are
-        # enumerated as 1, 2, 3, 4, .... Therefore, the new binary mask contains only the values {0, 1},
-        # where 0 indicates non-gland regions, while 1 indicates gland-regions.
-
-        # Masks are used only for evaluation once the training is finished. They are not used for any reason
-        # during training. Therefore, we keep their format as PIL.Image.Image.
-
-        # Caltech-UCSD-Birds-200-2011: a pixel belongs to the mask if its value > 255/2. (an image is annotated
-        # by many workers. If more than half of the workers agreed on the pixel to be a bird, we consider that
-        # pixel as a bird.
-
-        # Oxford-flowers-102: a pixel belongs to the mask if its value > 0. The mask has only {0, 255} as values. The
-        # new binary mask will contain only {0, 1} values where 0 is the background and 1 is the foreground.
-        mask_np = np.array(mask)
-        if self.dataset_name == "glas":
-            mask_np = (mask_np != 0).astype(np.uint8)
-        elif self.dataset_name == "Caltech-UCSD-Birds-200-2011":
-            mask_np = (mask_np > (255 / 2.)).astype(np.uint8)
-        elif self.dataset_name == 'Oxford-flowers-102':
-            mask_np = (mask_np != 0).astype(np.uint8)
-        else:
-            raise ValueError("Dataset name {} unsupported. Exiting .... [NOT OK]".format(self.dataset_name))
-
-        mask = Image.fromarray(mask_np * 255, mode="L")
-
-        return mask
+        return load_binary_mask(self.samples[i][1], self.dataset_name)
 
     def get_original_input_label_int(self, i):
         """
@@ -399,28 +1409,72 @@ class PhotoDataset(Dataset):
         :param i: index of the sample to load.
         :return: image, mask, label.
         """
-        img = self.get_original_input_img(i)
-        mask = self.get_original_input_mask(i)
+        # The resize is not used.
+        img, mask, size = decode_sample(self.samples[i][0], self.samples[i][1], self.dataset_name, self.resize)
         label = self.get_original_input_label_int(i)
 
-        self.original_images_size[i] = img.size
-
-        # This if is not used.
-        if self.resize:
-            img = img.resize(self.resize)
-            mask = mask.resize(self.resize)
+        self.original_images_size[i] = size
 
         return img, mask, label
 
+    def get_preload_executor(self):
+        """
+        Returns the pool used to decode the samples in parallel, or None if the decoding is sequential.
+        Threads are enough in most cases: PIL releases the GIL while decoding/resizing.
+        :return: concurrent.futures executor or None.
+        """
+        if self.preload_workers <= 0:
+            return None
+        if self.preload_backend == "thread":
+            return ThreadPoolExecutor(max_workers=self.preload_workers)
+        elif self.preload_backend == "process":
+            return ProcessPoolExecutor(max_workers=self.preload_workers)
+        else:
+            raise ValueError("Unsupported preload backend {} .... [NOT OK]".format(self.preload_backend))
+
+    def iter_decoded_samples(self):
+        """
+        Decode all the samples (image, binary mask), in parallel if self.preload_workers > 0. The samples are
+        yielded in their order in the dataset, whatever the number of workers.
+        Records the original size of each image, and reports the decoding speed (images/sec).
+
+        :return: generator of (img, mask, label).
+        """
+        executor = self.get_preload_executor()
+        t0 = time.perf_counter()
+        args = ([sample[0] for sample in self.samples],
+                [sample[1] for sample in self.samples],
+                [self.dataset_name] * self.n,
+                [self.resize] * self.n)
+        try:
+            if executor is None:
+                decoded = map(decode_sample, *args)
+            else:
+                chunksize = max(1, self.n // (self.preload_workers * 4)) if self.preload_backend == "process" else 1
+                decoded = executor.map(decode_sample, *args, chunksize=chunksize)
+
+            for i, (img, mask, size) in tqdm.tqdm(enumerate(decoded), ncols=80, total=self.n):
+                self.original_images_size[i] = size
+                yield img, mask, self.get_original_input_label_int(i)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        duration = time.perf_counter() - t0
+        print("{} decoded {} samples in {:.2f}s ({:.1f} images/sec, {} {} workers) .... [OK]".format(
+            self.__class__.__name__, self.n, duration, self.n / max(duration, 1e-8), self.preload_workers,
+            self.preload_backend))
+
     def preload_images(self):
         """
         Preload images/masks/labels.
         :return:
         """
+        if self.store_dir is not None:
+            self.preload_images_store()
+            return
 
-        for i in tqdm.tqdm(range(self.n), ncols=80, total=self.n):
-            img, mask, label = self.load_sample_i(i)
-
+        for img, mask, label in self.iter_decoded_samples():
             self.images.append(img)
             self.masks.append(mask)
             self.labels.append(label)
@@ -428,6 +1482,58 @@ class PhotoDataset(Dataset):
         self.preloaded = True
         print("{} has successfully loaded the images with {} samples .... [OK]".format(self.__class__.__name__, self.n))
 
+    def preload_images_store(self):
+        """
+        Preload images/masks/labels through the memory-mapped store (see DecodedImageStore): build it if it does not
+        exist yet, then open it. self.images and self.masks give access to the stored samples as PIL images.
+        :return:
+        """
+        path_data, path_index = DecodedImageStore.get_paths(self.store_dir, self.dataset_name, self.samples,
+                                                            self.resize)
+        if os.path.isfile(path_data) and os.path.isfile(path_index):
+            self.store = DecodedImageStore(path_data, path_index)
+            print("{} has opened the store {} .... [OK]".format(self.__class__.__name__, path_data))
+        else:
+            decoded = ((img, mask) for img, mask, _ in self.iter_decoded_samples())
+            self.store = DecodedImageStore.build(path_data, path_index, decoded, self.n)
+            print("{} has built the store {} .... [OK]".format(self.__class__.__name__, path_data))
+
+        msg = "The store {} has {} samples. Expected {} .... [NOT OK]".format(path_data, len(self.store), self.n)
+        assert len(self.store) == self.n, msg
+
+        self.images = self.store.images
+        self.masks = self.store.masks
+        self.labels = [self.get_original_input_label_int(i) for i in range(self.n)]
+        for i in range(self.n):
+            _, h, w, _ = self.store.index_imgs[i]
+            self.original_images_size[i] = (w, h)
+
+        self.preloaded = True
+        print("{} has successfully loaded the images with {} samples .... [OK]".format(self.__class__.__name__, self.n))
+
+    def get_prepared_size(self, index):
+        """
+        Compute the size of the sample `index` once prepared (see self.prepare_sample()), without preparing it.
+        :param index: int, the index of the sample within the whole dataset.
+        :return: h, w: int, the height and the width of the prepared image.
+        """
+        if self.randomCropper:
+            return tuple(self.randomCropper.size)
+
+        if self.resize:
+            w, h = self.resize
+        elif self.original_images_size[index] is not None:
+            w, h = self.original_images_size[index]
+        else:
+            with Image.open(self.absolute_paths_imgs[index], "r") as img:  # reads only the header.
+                w, h = img.size
+
+        w, h = self.get_upscaled_dims(w, h, self.up_scale_small_dim_to)
+        if self.force_div_32:
+            w, h = w + sum(self.get_padding(w, 32)), h + sum(self.get_padding(h, 32))
+
+        return h, w
+
     @staticmethod
     def get_upscaled_dims(w, h, up_scale_small_dim_to):
         """
@@ -484,8 +1590,15 @@ class PhotoDataset(Dataset):
         # Turn off momentarily self.set_for_eval.
         self.set_for_eval = False
 
-        for i in tqdm.tqdm(range(len(self.images)), ncols=80, total=self.n):
-            sample, mask, target = self.__getitem__(i)
+        # Each sample uses only its own generator: the samples can be prepared by a pool of threads. map() keeps
+        # the order.
+        if self.preload_workers > 0:
+            with ThreadPoolExecutor(max_workers=self.preload_workers) as executor:
+                prepared = list(tqdm.tqdm(executor.map(self.__getitem__, range(self.n)), ncols=80, total=self.n))
+        else:
+            prepared = (self.__getitem__(i) for i in tqdm.tqdm(range(len(self.images)), ncols=80, total=self.n))
+
+        for sample, mask, target in prepared:
             self.inputs_ready.append(sample)
             self.masks_ready.append(mask)
             self.labels_ready.append(target)
@@ -524,16 +1637,14 @@ class PhotoDataset(Dataset):
         """
         Return one sample and its label and extra information that we need later.
 
-        :param index: int, the index of the sample within the whole dataset.
+        :param index: int, the index of the sample within the whole dataset, or an index encoded with the slot of
+               the seed table of its epoch (see self.encode_index()).
         :return: sample: pytorch.tensor of size (1, C, H, W) and datatype torch.FloatTensor. Where C is the number of
                  color channels (=3), and H is the height of the patch, and W is its width.
                  mask: PIL.Image.Image, the mask of the regions of interest.
                  label: int, the label of the sample.
         """
-        # Force seeding: a workaround to deal with reproducibility when suing different number of workers if want to
-        # preserve the reproducibility. Each sample has its won seed.
-        reproducibility.force_seed(self.seeds[index])
-
+        index, seeds = self.decode_index(index)
         if self.set_for_eval:
             error_msg = "Something wrong. You didn't ask to set the data ready for evaluation, but here we are " \
                         ".... [NOT OK]"
@@ -544,11 +1655,120 @@ class PhotoDataset(Dataset):
 
             return img, mask, target
 
+        prepared = None
+        if self.eval_cache is not None:
+            cached = self.eval_cache.get(index)
+            if cached is None:
+                prepared = self.prepare_sample(index, seeds)
+                if self.eval_cache.put(index, *prepared):
+                    cached = self.eval_cache.get(index)
+
+            if cached is not None:
+                img, mask, target = cached
+                if self.uint8_output:
+                    img = self.to_uint8_tensor(img)
+                elif self.transform_tensor:
+                    img = self.transform_tensor(img)  # ToTensor() accepts uint8 numpy arrays.
+                if self.mask_transport == "float":
+                    mask = self.to_tensor(np.expand_dims(mask, axis=-1))
+                else:
+                    mask = self.encode_mask(mask > 0.5)
+
+                return img, mask, target
+
+        img, mask, target = prepared if prepared is not None else self.prepare_sample(index, seeds)
+
+        if self.uint8_output:
+            img = self.to_uint8_tensor(img)
+        elif self.transform_tensor:  # just for training: do not transform the mask (since it is not used).
+            img = self.transform_tensor(img)
+
+        # Prepare the mask to be used on GPU to compute Dice index.
+        if self.mask_transport == "float":
+            mask = np.array(mask, dtype=np.float32) / 255.  # full of 0 and 1.
+            mask = self.to_tensor(np.expand_dims(mask, axis=-1))  # mak the mask with shape (h, w, 1).
+        else:
+            mask = self.encode_mask(np.asarray(mask) > 127)
+
+        return img, mask, target
+
+    @staticmethod
+    def to_uint8_tensor(img):
+        """
+        Convert an image into a uint8 tensor (no scaling, no normalization).
+        :param img: PIL.Image.Image RGB or numpy.ndarray uint8 of shape (h, w, 3).
+        :return: torch.Tensor uint8 of shape (3, h, w).
+        """
+        return torch.from_numpy(np.ascontiguousarray(np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)))
+
+    def encode_mask(self, mask):
+        """
+        Encode a binary mask to be sent by the dataloader workers with the encoding self.mask_transport (`uint8` or
+        `packed`). See decode_masks().
+        :param mask: numpy.ndarray bool of shape (h, w).
+        :return: torch.Tensor uint8 of shape (1, h, w) (`uint8`) or (ceil(h * w / 8),) (`packed`).
+        """
+        if self.mask_transport == "uint8":
+            return torch.from_numpy(mask.astype(np.uint8)[np.newaxis])
+        elif self.mask_transport == "packed":
+            return torch.from_numpy(np.packbits(mask.ravel()))
+        else:
+            raise ValueError("Unsupported mask encoding {} .... [NOT OK]".format(self.mask_transport))
+
+    def prepare_sample(self, index, seeds=None):
+        """
+        Prepare the sample `index` up to the conversion into tensors: upscale, pad, crop, transform.
+        :param index: int, the index of the sample within the whole dataset.
+        :param seeds: None or numpy.ndarray, the seeds of the epoch. If None, self.seeds.
+        :return: img, mask, target: PIL.Image.Image, PIL.Image.Image, int.
+        """
+        seeds = self.seeds if seeds is None else seeds
         if self.do_not_save_samples:
             img, mask, target = self.load_sample_i(index)
         else:
             assert self.preloaded, "Sorry, you need to preload the data first .... [NOT OK]"
             img, mask, target = self.images[index], self.masks[index], self.labels[index]
+
+        # Each sample has its own generator: reproducibility does not depend on the number of workers. Transforms
+        # that are not seeded use the global state: for them, we force the seed of the sample.
+        rng = self.get_sample_rng(index, seeds)
+        if self.transform_img and not isinstance(self.transform_img, SeededCompose):
+            reproducibility.force_seed(seeds[index])
+        if self.crop_first and self.can_crop_first(img, rng):
+            img, mask = self.crop_first_sample(img, mask, rng)
+        else:
+            img, mask = self.upscale_pad_crop_sample(img, mask, rng)
+
+        # Pad the image to be div. by 32 in both sides.
+        if self.force_div_32:
+            w, h = img.size
+            pad_left, pad_right = self.get_padding(w, 32)
+            pad_top, pad_bottom = self.get_padding(h, 32)
+            padding = (pad_left, pad_top, pad_right, pad_bottom)
+            img = TF.pad(img, padding=padding, padding_mode="reflect")
+            # This is not necessary in training nor in test. It may be necessary during training if your patch size
+            # is not dividable by 32 and you want to make it dividable by 32.
+            # We are going to comment this.
+            # if not self.set_for_eval_backup:  # we want to keep the mask intact for evaluation.
+            # just for tracking. Not used for training.
+            #    mask = TF.pad(mask, padding=padding, padding_mode="reflect")
+
+        if self.transform_img:  # just for training: do not transform the mask (since it is not used).
+            if isinstance(self.transform_img, SeededCompose):
+                img = self.transform_img(img, rng)
+            else:
+                img = self.transform_img(img)
+
+        return img, mask, target
+
+    def upscale_pad_crop_sample(self, img, mask, rng):
+        """
+        Upscale the image (if necessary), then, pad the image and the mask, and crop them randomly (training only).
+        :param img: PIL.Image.Image, the image.
+        :param mask: PIL.Image.Image, the mask.
+        :param rng: numpy.random.RandomState of the sample, or None.
+        :return: img, mask: PIL.Image.Image, PIL.Image.Image.
+        """
         # Upscale on the fly. Sorry, this may add an extra time, but, we do not want to save in memory upscaled
         # images!!!! it takes a lot of space, especially for large datasets. So, compromise? upscale only when
         # necessary.
@@ -569,36 +1789,240 @@ class PhotoDataset(Dataset):
                 img = TF.pad(img, padding=padding, padding_mode=self.padding_mode)
                 mask = TF.pad(mask, padding=padding, padding_mode=self.padding_mode)  # just for tracking.
 
-            img, (i, j, h, w) = self.randomCropper(img)
+            img, (i, j, h, w) = self.randomCropper(img, rng)
             # print("Dadaloader Index {} i  {}  j {} seed {}".format(index, i, j, self.seeds[index]))
             # crop the mask
             mask = TF.crop(mask, i, j, h, w)  # just for tracking. Not used for actual training.
 
-        # Pad the image to be div. by 32 in both sides.
-        if self.force_div_32:
-            w, h = img.size
-            pad_left, pad_right = self.get_padding(w, 32)
-            pad_top, pad_bottom = self.get_padding(h, 32)
-            padding = (pad_left, pad_top, pad_right, pad_bottom)
-            img = TF.pad(img, padding=padding, padding_mode="reflect")
-            # This is not necessary in training nor in test. It may be necessary during training if your patch size
-            # is not dividable by 32 and you want to make it dividable by 32.
-            # We are going to comment this.
-            # if not self.set_for_eval_backup:  # we want to keep the mask intact for evaluation.
-            # just for tracking. Not used for training.
-            #    mask = TF.pad(mask, padding=padding, padding_mode="reflect")
+        return img, mask
 
-        if self.transform_img:  # just for training: do not transform the mask (since it is not used).
-            img = self.transform_img(img)
+    def get_upscaled_padded_dims(self, w, h):
+        """
+        Compute the size of the image after upscaling it (if necessary) and the padding (in pixels) applied to it
+        before the random crop, without processing the image.
+        :param w: int, width of the original image.
+        :param h: int, height of the original image.
+        :return: w_up, h_up, pw, ph: int, the size of the upscaled image, and the padding (left/right, top/bottom).
+        """
+        w_up, h_up = w, h
+        if self.up_scale_small_dim_to is not None:
+            w_up, h_up = self.get_upscaled_dims(w, h, self.up_scale_small_dim_to)
 
-        if self.transform_tensor:  # just for training: do not transform the mask (since it is not used).
-            img = self.transform_tensor(img)
+        pw, ph = 0, 0
+        if self.padding_size:
+            ratio_h, ratio_w = self.padding_size
+            pw, ph = int(ratio_w * w_up), int(ratio_h * h_up)
 
-        # Prepare the mask to be used on GPU to compute Dice index.
-        mask = np.array(mask, dtype=np.float32) / 255.  # full of 0 and 1.
-        mask = self.to_tensor(np.expand_dims(mask, axis=-1))  # mak the mask with shape (h, w, 1).
+        return w_up, h_up, pw, ph
 
-        return img, mask, target
+    def can_crop_first(self, img, rng):
+        """
+        Check if the sample can be prepared with self.crop_first_sample(): training with a random crop drawn from
+        `rng`, and a reflect padding (if any) smaller than the image (and its mask).
+        :param img: PIL.Image.Image, the original image.
+        :param rng: numpy.random.RandomState of the sample, or None.
+        :return: bool.
+        """
+        if (not self.randomCropper) or (rng is None):
+            return False
+
+        if not self.padding_size:
+            return True
+
+        w, h = img.size
+        w_up, h_up, pw, ph = self.get_upscaled_padded_dims(w, h)
+        # the mask is padded at the original size of the image.
+        return (self.padding_mode == "reflect") and (pw < w) and (ph < h)
+
+    @staticmethod
+    def get_reflect_indices(start, length, size, pad):
+        """
+        Map the indices [start, start + length) of an axis padded with a `reflect` padding (np.pad(mode="reflect"),
+        pad < size) of `pad` pixels on both sides back to the indices of the non-padded axis.
+        :param start: int, first index in the padded axis.
+        :param length: int, number of indices.
+        :param size: int, the size of the non-padded axis.
+        :param pad: int, the padding on both sides.
+        :return: numpy.ndarray of int of shape (length,). -1 for the indices outside the padded axis.
+        """
+        p = np.arange(start, start + length)
+        x = np.abs(p - pad)
+        x = np.where(x >= size, 2 * (size - 1) - x, x)
+        x[(p < 0) | (p >= size + 2 * pad)] = -1
+        return x
+
+    def crop_first_sample(self, img, mask, rng):
+        """
+        Same as self.upscale_pad_crop_sample() but the random crop window is drawn first in the coordinates of the
+        upscaled and padded image (with the same draw from `rng`), then, only the region of the original image that
+        is inside the window is upscaled, and the padding is done by indexing. This avoids upscaling and padding the
+        entire image to throw most of it away.
+
+        The image crop is the same as the default ordering up to the rounding of the resize coefficients (PIL
+        resizes the region `box` with the coefficients of the full resize). The mask crop is the same.
+
+        :param img: PIL.Image.Image, the original image.
+        :param mask: PIL.Image.Image, the original mask.
+        :param rng: numpy.random.RandomState of the sample.
+        :return: img, mask: PIL.Image.Image, PIL.Image.Image.
+        """
+        w, h = img.size
+        w_up, h_up, pw, ph = self.get_upscaled_padded_dims(w, h)
+        i, j, th, tw = MyRandomCropper.get_seeded_params_size(w_up + 2 * pw, h_up + 2 * ph, self.randomCropper.size,
+                                                             rng)
+
+        # Image: the window is always inside the padded upscaled image.
+        rows = self.get_reflect_indices(i, th, h_up, ph)
+        cols = self.get_reflect_indices(j, tw, w_up, pw)
+        r0, r1 = int(rows.min()), int(rows.max()) + 1
+        c0, c1 = int(cols.min()), int(cols.max()) + 1
+        if (w_up, h_up) != (w, h):
+            sw, sh = w / float(w_up), h / float(h_up)
+            region = img.resize((c1 - c0, r1 - r0), resample=PIL.Image.BILINEAR,
+                                box=(c0 * sw, r0 * sh, c1 * sw, r1 * sh))
+        else:
+            region = img.crop((c0, r0, c1, r1))
+        img = Image.fromarray(np.asarray(region)[np.ix_(rows - r0, cols - c0)], mode=region.mode)
+
+        # Mask: not upscaled, but padded and cropped as the upscaled image. Outside the padded mask: 0 (PIL crop).
+        # Just for tracking.
+        wm, hm = mask.size
+        rows = self.get_reflect_indices(i, th, hm, ph)
+        cols = self.get_reflect_indices(j, tw, wm, pw)
+        vr, vc = rows >= 0, cols >= 0
+        cropped = np.zeros((th, tw), dtype=np.uint8)
+        if vr.any() and vc.any():
+            cropped[np.ix_(vr, vc)] = np.asarray(mask)[np.ix_(rows[vr], cols[vc])]
+        mask = Image.fromarray(cropped, mode="L")
+
+        return img, mask
+
+    def warm_eval_cache(self):
+        """
+        Fill the evaluation cache (see EvalSampleCache) with the prepared samples, in parallel if
+        self.preload_workers > 0, until the cache is full.
+        The samples are submitted by windows of 2 * self.preload_workers: at most one window of samples is prepared
+        ahead of the cache. Once the cache is full, nothing is submitted anymore, and the pending samples are
+        cancelled.
+        :return: bool. True if all the samples are in the cache.
+        """
+        assert self.eval_cache is not None, "The evaluation cache is not activated .... [NOT OK]"
+
+        def prepare(index):
+            # encoded in the worker: only the compact form is held.
+            return EvalSampleCache.encode(*self.prepare_sample(index))
+
+        t0 = time.perf_counter()
+        indices = collections.deque([i for i in range(self.n) if i not in self.eval_cache])
+        executor = None
+        if self.preload_workers > 0:
+            executor = ThreadPoolExecutor(max_workers=self.preload_workers)
+        window = 2 * self.preload_workers
+        pending = collections.deque()
+
+        try:
+            while indices or pending:
+                if executor is None:
+                    i = indices.popleft()
+                    entry = prepare(i)
+                else:
+                    while indices and len(pending) < window:
+                        i = indices.popleft()
+                        pending.append((i, executor.submit(prepare, i)))
+                    i, future = pending.popleft()
+                    entry = future.result()
+
+                # size of the stored encoding.
+                if self.eval_cache.is_full_with(EvalSampleCache.get_entry_nbytes(entry)):
+                    break
+                self.eval_cache.put_entry(i, entry)
+        finally:
+            if executor is not None:
+                for _, future in pending:
+                    future.cancel()
+                executor.shutdown(wait=True)  # the running ones only.
+
+        complete = len(self.eval_cache) == self.n
+        print("{}: {} warmed in {:.2f}s. Complete: {} .... [OK]".format(
+            self.__class__.__name__, self.eval_cache, time.perf_counter() - t0, complete))
+
+        return complete
 
     def __len__(self):
         return len(self.samples)
+
+
+def make_synthetic_samples(folder, n, size, nbr_classes=2):
+    """
+    Write `n` random images (jpeg) and masks (png) of size `size` (w, h) in `folder`. Used only for benchmarking.
+    :return: list of samples (path image, path mask, label).
+    """
+    rng = np.random.RandomState(0)
+    samples = []
+    for i in range(n):
+        path_img = join(folder, "img-{}.jpg".format(i))
+        path_mask = join(folder, "mask-{}.png".format(i))
+        Image.fromarray(rng.randint(0, 256, size=(size[1], size[0], 3)).astype(np.uint8)).save(path_img)
+        Image.fromarray(((rng.rand(size[1], size[0]) > 0.5) * 255).astype(np.uint8)).save(path_mask)
+        samples.append((path_img, path_mask, str(i % nbr_classes)))
+    return samples
+
+
+def test_threaded_loader(nbr_epochs=3, num_workers=8):
+    """
+    Benchmark the in-process ThreadedDataLoader against the forked DataLoader (fork of the workers at each epoch)
+    on synthetic data of the size of GlaS (85 train images 775x522, crop 416, batch 8. Evaluation: batch 1) and of
+    CUB (a subset of 600 train images 500x375 upscaled to 432, crop 416, batch 8). Both loaders must give the same
+    batches.
+    """
+    import shutil
+    import tempfile
+    from tools import SeededCompose, SeededColorJitter, SeededRandomHorizontalFlip, SeededRandomVerticalFlip
+
+    transform_tensor = transforms.Compose([transforms.ToTensor(), transforms.Normalize([0.5, 0.5, 0.5],
+                                                                                        [0.5, 0.5, 0.5])])
+    configs = [
+        ("GlaS train", "glas", 85, (775, 522), dict(crop_size=416, padding_size=(0.01, 0.01), up_scale_small_dim_to=None,
+                                                    transform_img=SeededCompose([
+                                                        SeededColorJitter(0.5, 0.5, 0.5, 0.05),
+                                                        SeededRandomHorizontalFlip(),
+                                                        SeededRandomVerticalFlip()])), 8),
+        ("GlaS eval", "glas", 85, (775, 522), dict(crop_size=None, padding_size=None, up_scale_small_dim_to=None,
+                                                   transform_img=None), 1),
+        ("CUB train", "Caltech-UCSD-Birds-200-2011", 600, (500, 375),
+         dict(crop_size=416, padding_size=None, up_scale_small_dim_to=432,
+              transform_img=SeededCompose([SeededRandomHorizontalFlip()])), 8)
+    ]
+    folder = tempfile.mkdtemp()
+    try:
+        for name, dataset_name, n, size, kwargs, batch_size in configs:
+            samples = make_synthetic_samples(folder, n, size)
+            dataset = PhotoDataset(samples, dataset_name, {"0": 0, "1": 1}, transform_tensor, set_for_eval=False,
+                                   preload_workers=num_workers, **kwargs)
+            loaders = [("forked", lambda: DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                                     num_workers=num_workers, collate_fn=default_collate)),
+                       ("threaded", lambda: ThreadedDataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                                               num_workers=num_workers, collate_fn=default_collate))
+                       ]
+            firsts = []
+            for loader_name, get_loader in loaders:
+                dataset.seed_epoch = -1
+                loader = get_loader() if loader_name == "threaded" else None
+                t0 = time.perf_counter()
+                for epoch in range(nbr_epochs):
+                    dataset.set_up_new_seeds()
+                    loader = get_loader() if loader_name == "forked" else loader  # forked at each epoch.
+                    for i, (data, _, _) in enumerate(loader):
+                        if epoch == 0 and i == 0:
+                            firsts.append(data)
+                duration = time.perf_counter() - t0
+                print("{}: {} loader, {} epochs of {} batches: {:.2f}s ({:.2f}s/epoch)".format(
+                    name, loader_name, nbr_epochs, len(loader), duration, duration / nbr_epochs))
+
+            assert torch.equal(firsts[0], firsts[1]), "The loaders mismatch .... [NOT OK]"
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    test_threaded_loader()
@@ -15,6 +15,7 @@ from torch.utils.data import DataLoader
 
 from deepmil.train import train_one_epoch
 from deepmil.train import validate
+from deepmil.tiled_inference import TiledInference
 
 from tools import get_exp_name
 from tools import copy_code
@@ -28,15 +29,23 @@ from tools import init_stats
 from tools import get_cpu_device
 from tools import get_transforms_tensor
 from tools import get_train_transforms_img
+from tools import get_train_transforms_batch
+from tools import get_transforms_batch_tensor
 from tools import plot_curves
 from tools import announce_msg
 from tools import check_if_allow_multgpu_mode
 from tools import copy_model_state_dict_from_gpu_to_cpu
+from tools import StageTimer
+from tools import StepProfiler
 
 from loader import csv_loader
 from loader import MyDataParallel
 from loader import PhotoDataset
 from loader import default_collate
+from loader import stack_collate
+from loader import PersistentDataLoader
+from loader import ThreadedDataLoader
+from loader import SeededRandomSampler
 from loader import _init_fn
 
 from instantiators import instantiate_models
@@ -156,6 +165,15 @@ if __name__ == "__main__":
 
     train_transform_img = get_train_transforms_img(args)
     transform_tensor = get_transforms_tensor(args)
+    # Batched augmentation: the train workers only decode/crop into uint8,
+    # the augmentation and the normalization are done per batch.
+    train_transform_batch = None
+    if args.batch_augment:
+        train_transform_img = None
+        train_transform_batch = get_train_transforms_batch(args)
+    elif args.train_transport != "float":
+        # uint8 transport: the normalization is done per batch.
+        train_transform_batch = get_transforms_batch_tensor(args)
 
     # ==========================================================================
     # Datasets: create folds, load csv, preprocess files and save on disc,
@@ -207,21 +225,55 @@ if __name__ == "__main__":
                             crop_size=args.crop_size,
                             padding_size=args.padding_size,
                             padding_mode=args.padding_mode,
-                            up_scale_small_dim_to=args.up_scale_small_dim_to
+                            up_scale_small_dim_to=args.up_scale_small_dim_to,
+                            store_dir=args.store_dir,
+                            preload_workers=args.preload_workers,
+                            preload_backend=args.preload_backend,
+                            crop_first=args.crop_first,
+                            uint8_output=(train_transform_batch is not None),
+                            mask_transport=args.train_transport
                             )
 
     reproducibility.force_seed(myseed)
 
 
     reproducibility.force_seed(myseed)
-    train_loader = DataLoader(trainset,
-                              batch_size=args.batch_size,
-                              shuffle=True,
-                              num_workers=args.num_workers,
-                              pin_memory=True,
-                              worker_init_fn=_init_fn,
-                              collate_fn=default_collate
-                              )
+    if args.loader_backend == "thread":
+        # In-process: the samples are prepared by threads.
+        train_loader = ThreadedDataLoader(
+            trainset,
+            batch_size=args.batch_size,
+            shuffle=True,
+            num_workers=max(1, args.num_workers),
+            pin_memory=True,
+            collate_fn=(default_collate if args.train_transport == "float"
+                        else stack_collate),
+            prefetch_batches=args.prefetch_batches
+        )
+    elif args.persistent_workers:
+        # The workers are forked once. The order of the samples and their
+        # seeds of each epoch are set up by the loader.
+        train_loader = PersistentDataLoader(
+            trainset,
+            batch_size=args.batch_size,
+            sampler=SeededRandomSampler(len(trainset), myseed),
+            num_workers=args.num_workers,
+            pin_memory=True,
+            worker_init_fn=_init_fn,
+            collate_fn=(default_collate if args.train_transport == "float"
+                        else stack_collate)
+        )
+    else:
+        train_loader = DataLoader(trainset,
+                                  batch_size=args.batch_size,
+                                  shuffle=True,
+                                  num_workers=args.num_workers,
+                                  pin_memory=True,
+                                  worker_init_fn=_init_fn,
+                                  collate_fn=(default_collate
+                                              if args.train_transport == "float"
+                                              else stack_collate)
+                                  )
     reproducibility.force_seed(myseed)
     validset, valid_loader = get_eval_dataset(args,
                                               myseed,
@@ -232,6 +284,18 @@ if __name__ == "__main__":
     # #################### Instantiate models ##################################
     reproducibility.force_seed(myseed)
     model = instantiate_models(args)
+    # Timers of the stages of the steps (the model times its forward).
+    timer = StageTimer(enabled=args.stage_timing)
+    model.timer = timer
+    stage_timings_log = join(OUTD, "stage_timings.jsonl")
+    # Capture of the operators over a window of steps.
+    profiler = StepProfiler(outd=join(OUTD, "profiler"),
+                            timer=timer,
+                            epoch=args.profile_epoch,
+                            start=args.profile_start_step,
+                            nbr_steps=args.profile_nbr_steps,
+                            use_cuda=(DEVICE.type == "cuda")
+                            )
 
     # Check if we are using a user specific pre-trained model other than our
     # pre-defined pre-trained models.
@@ -297,8 +361,11 @@ if __name__ == "__main__":
                         folderout=None,
                         epoch=-1,
                         log_file=training_log,
-                        name_set="valid"
+                        name_set="valid",
+                        timer=timer,
+                        profiler=profiler
                         )
+    timer.dump(stage_timings_log, "valid", -1)
 
     announce_msg("start training")
     reproducibility.force_seed(int(os.environ["MYSEED"]))
@@ -307,10 +374,13 @@ if __name__ == "__main__":
     for epoch in range(args.max_epochs):
         # TODO: IN THE FUTURE: DO NOT USE MAX_EPOCHS IN THE COMPUTATION OF THE CURRENT SEED!!!!
         # REPLACE IT WITH A CONSTANT (400 IN OUR CASE ON GLAS)
+        # With persistent workers, the loaders set up the seeds of each epoch.
         reproducibility.force_seed(myseed + (epoch + 1) * 10000 + 400)
-        trainset.set_up_new_seeds()
+        if not isinstance(train_loader, PersistentDataLoader):
+            trainset.set_up_new_seeds()
         reproducibility.force_seed(myseed + (epoch + 2) * 10000 + 400)
-        validset.set_up_new_seeds()
+        if not isinstance(valid_loader, PersistentDataLoader):
+            validset.set_up_new_seeds()
 
         # Start the training with fresh seeds.
         reproducibility.force_seed(myseed + (epoch + 3) * 10000 + 400)
@@ -326,8 +396,12 @@ if __name__ == "__main__":
                                    epoch,
                                    training_log,
                                    ALLOW_MULTIGPUS=ALLOW_MULTIGPUS,
-                                   NBRGPUS=NBRGPUS
+                                   NBRGPUS=NBRGPUS,
+                                   transform_batch=train_transform_batch,
+                                   timer=timer,
+                                   profiler=profiler
                                    )
+        timer.dump(stage_timings_log, "train", epoch)
 
         if lr_scheduler:  # for > 1.1 : opt.step() then l_r_s.step().
             lr_scheduler.step(epoch)
@@ -343,8 +417,11 @@ if __name__ == "__main__":
                             folderout=None,
                             epoch=epoch,
                             log_file=training_log,
-                            name_set="valid"
+                            name_set="valid",
+                            timer=timer,
+                            profiler=profiler
                             )
+        timer.dump(stage_timings_log, "valid", epoch)
 
         reproducibility.force_seed(myseed + (epoch + 6) * 10000 + 400)
 
@@ -401,6 +478,17 @@ if __name__ == "__main__":
     del trainset
     del train_loader
 
+    # The images larger than a tile are processed by tiles.
+    tiler = None
+    if args.tiled_inference:
+        tiler = TiledInference(model,
+                               tile_size=args.tile_size,
+                               overlap=args.tile_overlap,
+                               blending=args.tile_blending,
+                               device=DEVICE
+                               )
+        print("Final evaluation with {} .... [OK]".format(tiler))
+
     reproducibility.force_seed(myseed)
     validate(model=model,
              dataset=validset,
@@ -414,7 +502,8 @@ if __name__ == "__main__":
              log_file=results_log,
              name_set="valid",
              store_on_disc=False,
-             store_imgs=False
+             store_imgs=False,
+             tiler=tiler
              )
     del validset
     del valid_loader
@@ -437,7 +526,8 @@ if __name__ == "__main__":
              log_file=results_log,
              name_set="test",
              store_on_disc=True,
-             store_imgs=True
+             store_imgs=True,
+             tiler=tiler
              )
     del testset
     del test_loader
@@ -461,7 +551,8 @@ if __name__ == "__main__":
              log_file=results_log,
              name_set="train",
              store_on_disc=False,
-             store_imgs=False
+             store_imgs=False,
+             tiler=tiler
              )
 
     del trainset_eval
@@ -2,7 +2,10 @@ from torch.utils.data import DataLoader
 
 
 from loader import PhotoDataset
-from loader import default_collate
+from loader import pad_collate
+from loader import BucketBatchSampler
+from loader import PersistentDataLoader
+from loader import ThreadedDataLoader
 from loader import _init_fn
 
 
@@ -36,18 +39,57 @@ def get_eval_dataset(args,
                             padding_size=pad_vld_sz,
                             padding_mode=pad_vl_md,
                             force_div_32=False,
-                            up_scale_small_dim_to=args.up_scale_small_dim_to
+                            up_scale_small_dim_to=args.up_scale_small_dim_to,
+                            store_dir=args.store_dir,
+                            preload_workers=args.preload_workers,
+                            preload_backend=args.preload_backend,
+                            eval_cache_bytes=int(args.eval_cache_mb * 2**20)
                             )
 
+    num_workers = args.num_workers * FACTOR_MUL_WORKERS
+    if validset.eval_cache is not None:
+        # Once all the samples are in the cache, preparing a sample is cheap:
+        # no need to fork workers.
+        if validset.warm_eval_cache():
+            num_workers = 0
+
+    # Images do not have the same size: batches are formed within buckets of
+    # similar sizes, and padded (see loader.BucketBatchSampler, pad_collate).
+    batch_size = int(args.valid_batch_size)
+    if batch_size > 1:
+        sizes = [validset.get_prepared_size(i) for i in range(len(validset))]
+        batch_sampler = BucketBatchSampler(sizes, batch_size,
+                                           args.valid_bucket_multiple)
+        print("{} .... [OK]".format(batch_sampler))
+    else:
+        batch_sampler = None
+
     reproducibility.force_seed(myseed)
-    valid_loader = DataLoader(validset,
-                              batch_size=1,
-                              shuffle=False,
-                              num_workers=args.num_workers * FACTOR_MUL_WORKERS,
-                              pin_memory=True,
-                              collate_fn=default_collate,
-                              worker_init_fn=_init_fn
-                              )  # we need more workers since the batch size is
-    # 1, and set_for_eval is False (need more time to prepare a sample).
+    if args.loader_backend == "thread" and num_workers > 0:
+        # In-process: the samples are prepared by threads.
+        valid_loader = ThreadedDataLoader(validset,
+                                          batch_size=1,
+                                          shuffle=False,
+                                          batch_sampler=batch_sampler,
+                                          num_workers=num_workers,
+                                          pin_memory=True,
+                                          collate_fn=pad_collate,
+                                          prefetch_batches=args.prefetch_batches
+                                          )
+    else:
+        # Persistent workers: forked once for all the evaluations of this set.
+        loader_class = PersistentDataLoader if args.persistent_workers else \
+            DataLoader
+        valid_loader = loader_class(validset,
+                                    batch_size=1,
+                                    shuffle=False,
+                                    batch_sampler=batch_sampler,
+                                    num_workers=num_workers,
+                                    pin_memory=True,
+                                    collate_fn=pad_collate,
+                                    worker_init_fn=_init_fn
+                                    )  # we need more workers since the batch
+        # size is small, and set_for_eval is False (need more time to prepare a
+        # sample).
     reproducibility.force_seed(myseed)
-    return validset, valid_loader
\ No newline at end of file
+    return validset, valid_loader
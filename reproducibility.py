@@ -12,6 +12,15 @@ from tools import announce_msg
 
 DEFAULT_SEED = 0
 
+# Namespaces of the seed streams (see SeedStream). Each consumer has its own
+# namespace so their streams never overlap.
+STREAM_DATA = 0  # per-sample randomness of the datasets (crops, augmentations).
+STREAM_TRAIN = 1  # per-step randomness of the training loop (dropout, ...).
+STREAM_AUG = 2  # per-step randomness of the batched augmentation.
+STREAM_SHUFFLE = 3  # per-epoch order of the samples (see loader.SeededRandomSampler).
+
+_MASK64 = (1 << 64) - 1
+
 
 def get_seed():
     """
@@ -119,3 +128,89 @@ def force_seed_thread(seed):
     # torch.backends.cudnn.benchmark = False
     # torch.backends.cudnn.deterministic = True  # Deterministic mode can have a performance impact, depending on your
     # model: https://pytorch.org/docs/stable/notes/randomness.html#cudnn
+
+
+def _mix64(z):
+    """
+    SplitMix64 finalizer: a bijective mixing of a 64 bits integer.
+    :param z: int.
+    :return: int in [0, 2**64[.
+    """
+    z = (z + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+def derive_seed(base_seed, *keys):
+    """
+    Derive a seed from a base seed and a sequence of integer keys (epoch,
+    index, ...) using a counter-based hash.
+
+    The same (base_seed, keys) always give the same seed, independently of
+    any global state, of the order of the calls, and of the process
+    that makes the call (DataLoader workers).
+
+    :param base_seed: int. The base seed.
+    :param keys: int. keys.
+    :return: int in [0, 2**32[ (accepted by torch and numpy).
+    """
+    z = _mix64(int(base_seed) & _MASK64)
+    for k in keys:
+        z = _mix64(z ^ (int(k) & _MASK64))
+
+    return int(z & 0xFFFFFFFF)
+
+
+class SeedStream(object):
+    """
+    Stream of seeds and random generators derived from a base seed and a
+    namespace (STREAM_DATA, STREAM_TRAIN, ...).
+
+    Instead of re-seeding all the global generators (force_seed()) before
+    every random operation, each consumer (sample, training step) asks for
+    its own generator that is derived from (base seed, namespace, epoch,
+    index). The global state is never touched, so the results do not depend
+    on the number of workers nor on the order in which the samples are
+    processed.
+    """
+    def __init__(self, base_seed, namespace=STREAM_DATA):
+        """
+        Init. function.
+        :param base_seed: int. The base seed (MYSEED).
+        :param namespace: int. the namespace of the stream.
+        """
+        self.base_seed = int(base_seed)
+        self.namespace = int(namespace)
+
+    def seed(self, *keys):
+        """
+        Returns the seed of the keys.
+        :param keys: int. e.g. epoch, index.
+        :return: int in [0, 2**32[.
+        """
+        return derive_seed(self.base_seed, self.namespace, *keys)
+
+    def torch_generator(self, *keys):
+        """
+        Returns a new CPU torch.Generator seeded with the seed of the keys.
+        :param keys: int. e.g. epoch, index.
+        :return: torch.Generator.
+        """
+        generator = torch.Generator()
+        generator.manual_seed(self.seed(*keys))
+        return generator
+
+    def numpy_generator(self, *keys):
+        """
+        Returns a new numpy generator seeded with the seed of the keys.
+        We use numpy.random.RandomState (numpy.random.Generator is not
+        available in the version of numpy we use).
+        :param keys: int. e.g. epoch, index.
+        :return: numpy.random.RandomState.
+        """
+        return np.random.RandomState(self.seed(*keys))
+
+    def __repr__(self):
+        return "{}(base_seed={}, namespace={})".format(
+            self.__class__.__name__, self.base_seed, self.namespace)
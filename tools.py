@@ -28,11 +28,14 @@ from io import BytesIO
 import zipfile
 from collections import OrderedDict
 import subprocess
+import json
+import inspect
 
 import torch
 
 from sklearn.metrics import confusion_matrix, roc_curve, precision_recall_curve, auc, f1_score
 from torchvision import transforms
+import torchvision.transforms.functional as TF
 from scipy import interp
 import pydensecrf.densecrf as dcrf
 
@@ -87,6 +90,278 @@ class AverageMeter(object):
             return self.latest_avg
 
 
+class DeviceAccumulator(object):
+    """
+    Accumulate scalar tensors (losses) on their device without synchronizing with the host at every step.
+
+    1. Histories: append() keeps the values of each step as tensors. They are converted into floats and appended to
+    the lists of `stats` every `flush_every` steps, or when calling flush(): one synchronization per flush instead of
+    one per value per step. The floats are the same as with tensor.item().
+    2. Running sums: add() accumulates the values in float64 on the device (the same values as summing
+    tensor.item() in python). sum() returns the float (one synchronization).
+    """
+    def __init__(self, device, stats=None, flush_every=0):
+        """
+        Init. function.
+        :param device: torch.device where the values are accumulated.
+        :param stats: None or dict of lists (see init_stats()) where the histories are flushed.
+        :param flush_every: int >= 0. flush the histories every `flush_every` steps. 0: only when calling flush().
+        """
+        msg = "'flush_every' must be >= 0. found {} .... [NOT OK]".format(flush_every)
+        assert flush_every >= 0, msg
+
+        self.device = device
+        self.stats = stats
+        self.flush_every = flush_every
+        self.pending = OrderedDict()  # key: list of scalar tensors not flushed yet.
+        self.sums = OrderedDict()  # key: float64 scalar tensor.
+        self.nbr_steps = 0
+
+    def to_scalar(self, value):
+        """
+        Convert a value (tensor of one element, or float) into a scalar tensor (no gradient) on self.device.
+        """
+        if not isinstance(value, torch.Tensor):
+            value = torch.tensor(value)
+        return value.detach().reshape([]).to(self.device)
+
+    def append(self, **values):
+        """
+        Append the values of one step to the histories. Every key must be appended at every step.
+        """
+        for k, v in values.items():
+            self.pending.setdefault(k, []).append(self.to_scalar(v))
+        self.nbr_steps += 1
+        if self.flush_every > 0 and self.nbr_steps % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the pending histories to `stats` as floats.
+        """
+        if not self.pending:
+            return
+        keys = list(self.pending.keys())
+        values = torch.stack([torch.stack(self.pending[k]).float() for k in keys]).tolist()
+        for k, v in zip(keys, values):
+            self.stats[k].extend(v)
+        self.pending = OrderedDict()
+
+    def add(self, weight=1, **values):
+        """
+        Add values (multiplied by `weight`) to the running sums.
+        """
+        for k, v in values.items():
+            v = self.to_scalar(v).double() * weight
+            self.sums[k] = (self.sums[k] + v) if k in self.sums else v
+
+    def sum(self, key):
+        """
+        Return the running sum of `key` as a float (0. if nothing was added).
+        """
+        if key not in self.sums:
+            return 0.
+        return self.sums[key].item()
+
+
+class _NullStage(object):
+    """Context of a stage when the timing is disabled: does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Stage(object):
+    """Context that times a stage, and/or labels it in the profiler trace (see StageTimer.stage())."""
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.t0 = 0.
+        self.label = None
+
+    def __enter__(self):
+        if self.timer.labels:
+            self.label = RECORD_FUNCTION(self.name)
+            self.label.__enter__()
+        if self.timer.enabled:
+            self.timer.synchronize()
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.enabled:
+            self.timer.synchronize()
+            self.timer.add(self.name, time.perf_counter() - self.t0)
+        if self.label is not None:
+            self.label.__exit__(*exc)
+        return False
+
+
+NULL_STAGE = _NullStage()
+# Labels of the user-defined ranges in the profiler trace. Not available in old versions of pytorch.
+RECORD_FUNCTION = getattr(torch.autograd.profiler, "record_function", None)
+
+
+class StageTimer(object):
+    """
+    Named timers of the stages of a step (data wait, transfer, segment, classify, loss, backward, ...).
+
+    Usage:
+        with timer.stage("segment"):
+            ...
+    The durations of each stage are collected over an epoch, then their percentiles are appended to a JSON-lines
+    file (dump()).
+
+    When disabled, stage() returns a shared context that does nothing: the cost is a method call per stage.
+    When enabled with `sync`, the device is synchronized at the boundaries of each stage so that the asynchronous
+    cuda kernels are attributed to the stage that launched them (this removes the overlap between the stages: the
+    step is slower than without timing).
+    """
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self, enabled=False, sync=True):
+        """
+        Init. function.
+        :param enabled: bool. If False, nothing is timed.
+        :param sync: bool. If True, synchronize the cuda device at the boundaries of the stages.
+        """
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.durations = OrderedDict()  # name of the stage: list of durations (seconds).
+        self.labels = False  # If True, the stages are labeled in the profiler trace (set by StepProfiler).
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def stage(self, name):
+        """
+        Context that times the stage `name` (and labels it in the profiler trace while profiling).
+        """
+        if not (self.enabled or self.labels):
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, duration):
+        """
+        Record a duration (seconds) of the stage `name` measured elsewhere (e.g. the data wait of
+        loader.BatchPrefetcher).
+        """
+        if self.enabled:
+            self.durations.setdefault(name, []).append(duration)
+
+    def summary(self):
+        """
+        Compute the statistics of the durations of each stage (milliseconds).
+        :return: OrderedDict: name of the stage: dict (count, total, mean, max, p50, p90, p99).
+        """
+        out = OrderedDict()
+        for name, values in self.durations.items():
+            values = np.array(values) * 1000.
+            stats = OrderedDict([("count", int(values.size)), ("total", float(values.sum())),
+                                 ("mean", float(values.mean())), ("max", float(values.max()))])
+            for p, v in zip(self.PERCENTILES, np.percentile(values, self.PERCENTILES)):
+                stats["p{}".format(p)] = float(v)
+            out[name] = stats
+        return out
+
+    def dump(self, fname, name_set, epoch):
+        """
+        Append the statistics of the stages as one JSON line to a file, then reset the timers. Does nothing if
+        disabled or nothing was timed.
+        :param fname: str, path to the file (e.g. OUTD/stage_timings.jsonl).
+        :param name_set: str, name of the set (train, valid, ...).
+        :param epoch: int, the epoch.
+        """
+        if self.enabled and self.durations:
+            line = OrderedDict([("set", name_set), ("epoch", epoch), ("unit", "ms"), ("stages", self.summary())])
+            log(fname, json.dumps(line))
+        self.reset()
+
+    def reset(self):
+        self.durations = OrderedDict()
+
+
+class StepProfiler(object):
+    """
+    Capture the operators (torch.autograd.profiler) over a window of steps of a loop (training or evaluation), then
+    export a Chrome trace (chrome://tracing) and a table of the operators into a folder.
+
+    The window is the steps [start, start + nbr_steps[ of the epoch `epoch`. Call step() at the beginning of each
+    step, and stop() after the loop. While capturing, the stages of the StageTimer (segment, classify, the wildcat
+    heads, the loss, ...) are labeled in the trace (if pytorch provides record_function).
+    The shapes of the inputs and the memory are recorded if pytorch supports it.
+    """
+    def __init__(self, outd=None, timer=None, epoch=-1, start=0, nbr_steps=0, use_cuda=False):
+        """
+        Init. function.
+        :param outd: str, folder where the traces are exported. Created if needed.
+        :param timer: None or StageTimer, whose stages are labeled during the capture.
+        :param epoch: int, the epoch to profile.
+        :param start: int >= 0, the first step of the window.
+        :param nbr_steps: int >= 0, the number of steps of the window. 0: nothing is captured.
+        :param use_cuda: bool. If True, the cuda kernels are timed too.
+        """
+        msg = "'start' must be >= 0. found {} .... [NOT OK]".format(start)
+        assert start >= 0, msg
+        msg = "'nbr_steps' must be >= 0. found {} .... [NOT OK]".format(nbr_steps)
+        assert nbr_steps >= 0, msg
+
+        self.outd = outd
+        self.timer = timer
+        self.epoch = epoch
+        self.start = start
+        self.nbr_steps = nbr_steps
+        self.use_cuda = use_cuda
+        self.prof = None
+        self.name = ""  # name of the current capture.
+
+        params = inspect.signature(torch.autograd.profiler.profile.__init__).parameters
+        self.kwargs = {k: True for k in ["record_shapes", "profile_memory"] if k in params}
+
+    def step(self, name_set, epoch, i):
+        """
+        Call at the beginning of the step `i`: start the capture at the first step of the window, stop it after the
+        last one.
+        :param name_set: str, name of the loop (train, valid, ...). Used to name the exported files.
+        :param epoch: int, the current epoch.
+        :param i: int, the current step.
+        """
+        if self.prof is not None and i >= self.start + self.nbr_steps:
+            self.stop()
+        if self.prof is None and self.nbr_steps > 0 and epoch == self.epoch and i == self.start:
+            self.name = "{}-epoch-{}-steps-{}-{}".format(name_set, epoch, self.start,
+                                                         self.start + self.nbr_steps - 1)
+            if self.timer is not None and RECORD_FUNCTION is not None:
+                self.timer.labels = True
+            self.prof = torch.autograd.profiler.profile(use_cuda=self.use_cuda, **self.kwargs)
+            self.prof.__enter__()
+
+    def stop(self):
+        """
+        Stop the capture (if any), and export the trace and the table of the operators.
+        """
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        if self.timer is not None:
+            self.timer.labels = False
+
+        if not os.path.exists(self.outd):
+            os.makedirs(self.outd)
+        self.prof.export_chrome_trace(join(self.outd, self.name + ".trace.json"))
+        sort_by = "cuda_time_total" if self.use_cuda else "cpu_time_total"
+        with open(join(self.outd, self.name + ".txt"), "w") as f:
+            f.write(self.prof.key_averages().table(sort_by=sort_by))
+            if self.kwargs.get("record_shapes", False):
+                f.write("\n\nGrouped by the shapes of the inputs:\n")
+                f.write(self.prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by))
+        announce_msg("Profiler: {} exported into {} .... [OK]".format(self.name, self.outd))
+        self.prof = None
+
+
 class CRF(object):
     """
     CRF class to perform post-processing when called.
@@ -1836,6 +2111,21 @@ def get_yaml_args(input_args):
                             help="Optimizer name.")
         parser.add_argument("--valid_batch_size", type=str, default=None,
                             help="Batch size for validation.")
+        parser.add_argument("--valid_bucket_multiple", type=int, default=None,
+                            help="Sizes of the validation images are rounded"
+                                 " up to a multiple of this to form the "
+                                 "buckets of the batches.")
+        parser.add_argument("--tiled_inference", type=str2bool, default=None,
+                            help="Whether or not to process the large images "
+                                 "by tiles in the final evaluation.")
+        parser.add_argument("--tile_size", type=int, default=None,
+                            help="Size of the tiles (tiled inference).")
+        parser.add_argument("--tile_overlap", type=int, default=None,
+                            help="Overlap between two consecutive tiles "
+                                 "(tiled inference).")
+        parser.add_argument("--tile_blending", type=str, default=None,
+                            help="Blending window of the overlapping tiles: "
+                                 "constant, hann (tiled inference).")
         parser.add_argument("--nesterov", type=str2bool, default=None,
                             help="Whether or not to use nesterov.")
         parser.add_argument("--lr_scheduler_name", type=str, default=None,
@@ -1879,6 +2169,18 @@ def get_yaml_args(input_args):
         parser.add_argument("--model_name", type=str, default=None,
                             help="Name of the model: resnet18, resnet50, "
                                  "resnet101")
+        parser.add_argument("--batch_pos_neg", type=str2bool, default=None,
+                            help="whether or not classify X+ and X- in one "
+                                 "single pass.")
+        parser.add_argument("--lowres_mask", type=str2bool, default=None,
+                            help="whether or not compute the training mask "
+                                 "at the resolution of the classifier.")
+        parser.add_argument("--fused_mask", type=str2bool, default=None,
+                            help="whether or not compute and downscale X+ and"
+                                 " X- in one fused operation.")
+        parser.add_argument("--fold_heads", type=str2bool, default=None,
+                            help="whether or not fold the class-wise pooling "
+                                 "into the 1x1 conv. in evaluation.")
 
         parser.add_argument("--use_reg", type=str2bool, default=None,
                             help="whether to use or not a loss regularization "
@@ -1896,6 +2198,54 @@ def get_yaml_args(input_args):
                             help="whether or not pad during evaluation.")
         parser.add_argument("--dataset", type=str, default=None,
                             help="dataset's name.")
+        parser.add_argument("--store_dir", type=str, default=None,
+                            help="Folder of the memory-mapped stores of "
+                                 "the decoded images.")
+        parser.add_argument("--preload_workers", type=int, default=None,
+                            help="Number of workers to decode the images "
+                                 "when preloading them.")
+        parser.add_argument("--eval_cache_mb", type=float, default=None,
+                            help="Size (MB) of the cache of the prepared "
+                                 "evaluation samples. 0: no cache.")
+        parser.add_argument("--batch_augment", type=str2bool, default=None,
+                            help="whether or not augment/normalize the "
+                                 "training samples per batch.")
+        parser.add_argument("--train_transport", type=str, default=None,
+                            help="Encoding of the training samples sent by "
+                                 "the dataloader workers: float, uint8, "
+                                 "packed.")
+        parser.add_argument("--loader_backend", type=str, default=None,
+                            help="Backend of the dataloaders: process, "
+                                 "thread.")
+        parser.add_argument("--prefetch_batches", type=int, default=None,
+                            help="Number of batches prepared in advance by "
+                                 "the thread loader backend.")
+        parser.add_argument("--prefetch_device_batches", type=int,
+                            default=None,
+                            help="Number of batches kept ready on the "
+                                 "device by a background thread. 0: off.")
+        parser.add_argument("--flush_stats_every", type=int, default=None,
+                            help="Flush the training losses kept on the "
+                                 "device every n steps. 0: epoch end.")
+        parser.add_argument("--profile_epoch", type=int, default=None,
+                            help="Epoch whose steps are profiled.")
+        parser.add_argument("--profile_start_step", type=int, default=None,
+                            help="First profiled step of the epoch.")
+        parser.add_argument("--profile_nbr_steps", type=int, default=None,
+                            help="Number of profiled steps. 0: off.")
+        parser.add_argument("--stage_timing", type=str2bool, default=None,
+                            help="whether or not time the stages of the "
+                                 "steps (written into stage_timings.jsonl).")
+        parser.add_argument("--persistent_workers", type=str2bool,
+                            default=None,
+                            help="whether or not keep the dataloader workers"
+                                 " across the epochs.")
+        parser.add_argument("--crop_first", type=str2bool, default=None,
+                            help="whether or not draw the training crop "
+                                 "before upscaling/padding the image.")
+        parser.add_argument("--preload_backend", type=str, default=None,
+                            help="Pool to decode the images when preloading"
+                                 " them: thread, process.")
 
         parser.add_argument("--use_size_const", type=str2bool, default=None,
                             help="whether or not use constraint on the size "
@@ -1917,6 +2267,15 @@ def get_yaml_args(input_args):
                                  "the background size.")
         parser.add_argument("--lambda_neg", type=float, default=None,
                             help="Lambda for the background loss.")
+        parser.add_argument("--fused_loss", type=str2bool, default=None,
+                            help="whether or not compute the training loss "
+                                 "in one pass over the stacked scores.")
+        parser.add_argument("--neg_every", type=int, default=None,
+                            help="Classify X- only every this number of "
+                                 "training steps.")
+        parser.add_argument("--neg_ratio", type=float, default=None,
+                            help="Ratio of the batch over which X- is "
+                                 "classified during training.")
 
 
         parser.add_argument(
@@ -1987,31 +2346,318 @@ def get_yaml_args(input_args):
     return args, args_dict
 
 
+class SeededCompose(object):
+    """
+    Compose transforms that draw their randomness from a generator passed
+    at call time (instead of the global `random` module). See
+    reproducibility.SeedStream.
+    """
+    def __init__(self, transforms_list):
+        """
+        Init. function.
+        :param transforms_list: list of seeded transforms.
+        """
+        self.transforms = transforms_list
+
+    def __call__(self, img, rng):
+        """
+        :param img: PIL.Image.Image.
+        :param rng: numpy.random.RandomState.
+        :return: PIL.Image.Image.
+        """
+        for t in self.transforms:
+            img = t(img, rng)
+        return img
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.transforms)
+
+
+class SeededRandomHorizontalFlip(transforms.RandomHorizontalFlip):
+    """
+    transforms.RandomHorizontalFlip() with the randomness drawn from `rng`.
+    """
+    def __call__(self, img, rng):
+        p = getattr(self, "p", 0.5)
+        if rng.uniform() < p:
+            return TF.hflip(img)
+        return img
+
+
+class SeededRandomVerticalFlip(transforms.RandomVerticalFlip):
+    """
+    transforms.RandomVerticalFlip() with the randomness drawn from `rng`.
+    """
+    def __call__(self, img, rng):
+        p = getattr(self, "p", 0.5)
+        if rng.uniform() < p:
+            return TF.vflip(img)
+        return img
+
+
+class SeededColorJitter(transforms.ColorJitter):
+    """
+    transforms.ColorJitter() with the randomness drawn from `rng`: the
+    factors are sampled from the same ranges, and the transforms are applied
+    in a random order.
+    """
+    @staticmethod
+    def get_range(value, center):
+        """
+        Returns the sampling range (min, max) of a factor.
+        Torchvision stores either a float (old versions) or a range.
+        :param value: None, float or tuple of 2 floats.
+        :param center: float. 1. for brightness, contrast, saturation. 0.
+        for hue.
+        :return: tuple (min, max) or None if there is nothing to sample.
+        """
+        if value is None:
+            return None
+        if isinstance(value, numbers.Number):
+            if value <= 0:
+                return None
+            low = max(0., center - value) if center > 0 else center - value
+            return low, center + value
+        if value[0] == value[1] == center:
+            return None
+        return float(value[0]), float(value[1])
+
+    def get_seeded_params(self, rng):
+        """
+        Sample the factors and the order of the transforms.
+        :param rng: numpy.random.RandomState.
+        :return: list of (function, factor) to apply.
+        """
+        funcs = []
+        ranges = [(self.brightness, 1., TF.adjust_brightness),
+                  (self.contrast, 1., TF.adjust_contrast),
+                  (self.saturation, 1., TF.adjust_saturation),
+                  (self.hue, 0., TF.adjust_hue)
+                  ]
+        for value, center, adjust in ranges:
+            rg = self.get_range(value, center)
+            if rg is not None:
+                funcs.append((adjust, rng.uniform(rg[0], rg[1])))
+
+        return [funcs[k] for k in rng.permutation(len(funcs))]
+
+    def __call__(self, img, rng):
+        for adjust, factor in self.get_seeded_params(rng):
+            img = adjust(img, factor)
+        return img
+
+
+class BatchAugmenter(object):
+    """
+    Augmentation and normalization of a collated batch of uint8 images
+    (B, 3, H, W) with vectorized torch operations (on the device of the
+    batch). It is the batched counterpart of SeededColorJitter,
+    SeededRandomHorizontalFlip, SeededRandomVerticalFlip, ToTensor and
+    Normalize: each sample has its own parameters (jittering factors, order
+    of the jittering transforms, flips) sampled from the same distributions,
+    and drawn from a torch.Generator passed at call time.
+
+    The images are kept in float between the jittering transforms (PIL
+    rounds them to uint8 after each transform).
+    """
+    def __init__(self,
+                 brightness=0.,
+                 contrast=0.,
+                 saturation=0.,
+                 hue=0.,
+                 hflip=False,
+                 vflip=False,
+                 mean=(0.5, 0.5, 0.5),
+                 std=(0.5, 0.5, 0.5)
+                 ):
+        """
+        Init. function.
+        :param brightness: float >= 0. Same as in transforms.ColorJitter().
+        :param contrast: float >= 0. Same as in transforms.ColorJitter().
+        :param saturation: float >= 0. Same as in transforms.ColorJitter().
+        :param hue: float in [0, 0.5]. Same as in transforms.ColorJitter().
+        :param hflip: bool. If True, flip horizontally with probability 0.5.
+        :param vflip: bool. If True, flip vertically with probability 0.5.
+        :param mean: tuple of 3 floats. Mean of the normalization.
+        :param std: tuple of 3 floats. Standard deviation of the
+        normalization.
+        """
+        msg = "'hue' must be in [0, 0.5]. found {} .... [NOT OK]".format(hue)
+        assert 0 <= hue <= 0.5, msg
+
+        # (index of the transform, sampling range).
+        self.jitters = []
+        for k, (value, center) in enumerate([(brightness, 1.), (contrast, 1.),
+                                             (saturation, 1.), (hue, 0.)]):
+            rg = SeededColorJitter.get_range(value, center)
+            if rg is not None:
+                self.jitters.append((k, rg))
+
+        self.hflip = hflip
+        self.vflip = vflip
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+    def get_params(self, b, generator=None):
+        """
+        Sample the parameters of each sample of the batch.
+        :param b: int, size of the batch.
+        :param generator: torch.Generator (CPU) or None (global state).
+        :return: factors, order, hflips, vflips: torch.Tensor (CPU) of
+        shape (b, nbr jitters) float, (b, nbr jitters) long (the order of
+        the jittering transforms of each sample), (b,) bool, (b,) bool.
+        """
+        n = len(self.jitters)
+        factors = torch.rand(b, max(n, 1), generator=generator)
+        for c, (_, (low, high)) in enumerate(self.jitters):
+            factors[:, c] = low + factors[:, c] * (high - low)
+        order = torch.rand(b, max(n, 1), generator=generator).argsort(dim=1)
+        hflips = torch.rand(b, generator=generator) < 0.5
+        vflips = torch.rand(b, generator=generator) < 0.5
+        return factors, order, hflips, vflips
+
+    @staticmethod
+    def get_grayscale(x):
+        """
+        Grayscale (ITU-R 601-2 luma, as in PIL) of a batch.
+        :param x: torch.Tensor float of shape (B, 3, H, W).
+        :return: torch.Tensor float of shape (B, 1, H, W).
+        """
+        return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+    @staticmethod
+    def rgb_to_hsv(x):
+        """
+        Convert a batch of RGB images in [0, 1] into HSV (as colorsys).
+        :param x: torch.Tensor float of shape (B, 3, H, W).
+        :return: h, s, v: torch.Tensor float of shape (B, H, W), in [0, 1].
+        """
+        r, g, b = x[:, 0], x[:, 1], x[:, 2]
+        maxc = x.max(dim=1)[0]
+        minc = x.min(dim=1)[0]
+        delta = maxc - minc
+        s = torch.where(maxc > 0, delta / maxc.clamp(min=1e-12), torch.zeros_like(maxc))
+        safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+        rc = (maxc - r) / safe_delta
+        gc = (maxc - g) / safe_delta
+        bc = (maxc - b) / safe_delta
+        h = torch.where(r == maxc, bc - gc, torch.where(g == maxc, 2. + rc - bc, 4. + gc - rc))
+        h = torch.where(delta > 0, (h / 6.) % 1., torch.zeros_like(h))
+        return h, s, maxc
+
+    @staticmethod
+    def hsv_to_rgb(h, s, v):
+        """
+        Convert a batch of HSV images into RGB (as colorsys).
+        :param h: torch.Tensor float of shape (B, H, W), in [0, 1].
+        :param s: torch.Tensor float of shape (B, H, W), in [0, 1].
+        :param v: torch.Tensor float of shape (B, H, W), in [0, 1].
+        :return: torch.Tensor float of shape (B, 3, H, W).
+        """
+        h6 = h * 6.
+        i = torch.floor(h6)
+        f = h6 - i
+        i = i.long() % 6
+        p = v * (1. - s)
+        q = v * (1. - s * f)
+        t = v * (1. - s * (1. - f))
+        idx = i.unsqueeze(1)
+        r = torch.stack((v, q, p, p, t, v), dim=1).gather(1, idx)
+        g = torch.stack((t, v, v, q, p, p), dim=1).gather(1, idx)
+        b = torch.stack((p, p, t, v, v, q), dim=1).gather(1, idx)
+        return torch.cat((r, g, b), dim=1)
+
+    def adjust(self, x, k, factor):
+        """
+        Apply the jittering transform `k` (0: brightness, 1: contrast,
+        2: saturation, 3: hue) to a batch.
+        :param x: torch.Tensor float of shape (B, 3, H, W) in [0, 1].
+        :param k: int, the transform.
+        :param factor: torch.Tensor float of shape (B,). Factor of each
+        sample.
+        :return: torch.Tensor float of shape (B, 3, H, W) in [0, 1].
+        """
+        f = factor.view(-1, 1, 1, 1)
+        if k == 0:  # brightness: blend with black.
+            return (x * f).clamp_(0., 1.)
+        elif k == 1:  # contrast: blend with the mean of the grayscale.
+            m = self.get_grayscale(x).mean(dim=(2, 3), keepdim=True)
+            return (f * x + (1. - f) * m).clamp_(0., 1.)
+        elif k == 2:  # saturation: blend with the grayscale.
+            return (f * x + (1. - f) * self.get_grayscale(x)).clamp_(0., 1.)
+        elif k == 3:  # hue: shift the hue.
+            h, s, v = self.rgb_to_hsv(x)
+            h = (h + factor.view(-1, 1, 1)) % 1.
+            return self.hsv_to_rgb(h, s, v)
+        else:
+            raise ValueError("Unknown jittering transform {} .... [NOT OK]".format(k))
+
+    def __call__(self, x, generator=None, augment=True):
+        """
+        Augment and normalize a batch.
+        :param x: torch.Tensor uint8 of shape (B, 3, H, W).
+        :param generator: torch.Generator (CPU) or None (global state).
+        :param augment: bool. If False, only convert and normalize.
+        :return: torch.Tensor float32 of shape (B, 3, H, W).
+        """
+        msg = "Expected a uint8 batch (B, 3, H, W). found {} {} .... [NOT OK]".format(x.dtype, tuple(x.shape))
+        assert x.dtype == torch.uint8 and x.dim() == 4 and x.shape[1] == 3, msg
+
+        x = x.float().div_(255.)
+        if augment:
+            b = x.shape[0]
+            factors, order, hflips, vflips = [
+                v.to(x.device) for v in self.get_params(b, generator)]
+
+            # Per step, each jittering transform is applied to the whole
+            # batch, and each sample keeps the result of the transform at this
+            # position of its order (no host synchronization).
+            for step in range(len(self.jitters)):
+                current = order[:, step].view(-1, 1, 1, 1)
+                out = x
+                for c, (k, _) in enumerate(self.jitters):
+                    out = torch.where(current == c,
+                                      self.adjust(x, k, factors[:, c]), out)
+                x = out
+
+            if self.hflip:
+                x = torch.where(hflips.view(-1, 1, 1, 1), x.flip(3), x)
+            if self.vflip:
+                x = torch.where(vflips.view(-1, 1, 1, 1), x.flip(2), x)
+
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+    def __repr__(self):
+        return "{}(jitters={}, hflip={}, vflip={})".format(
+            self.__class__.__name__, self.jitters, self.hflip, self.vflip)
+
+
 def get_train_transforms_img(args):
     """
     Get the transformation to perform over the images for the train samples.
     All the transformation must perform on PIL.Image.Image and returns a PIL.Image.Image object.
+    The randomness is drawn from a generator passed at call time (per sample). See SeededCompose.
 
     :param args: object. Contains the configuration of the exp that has been read from the yaml file.
-    :return: a torchvision.transforms.Compose() object.
+    :return: a SeededCompose() object.
     """
 
     if args.dataset == "glas":
         # TODO: check values of jittering: https://arxiv.org/pdf/1806.07064.pdf
-        return transforms.Compose([
-            transforms.ColorJitter(0.5, 0.5, 0.5, 0.05),
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomVerticalFlip()
+        return SeededCompose([
+            SeededColorJitter(0.5, 0.5, 0.5, 0.05),
+            SeededRandomHorizontalFlip(),
+            SeededRandomVerticalFlip()
         ])
     elif args.dataset == "Caltech-UCSD-Birds-200-2011":
-        return transforms.Compose([
-            # transforms.ColorJitter(0.4, 0.4, 0.4, 0.00),
-            transforms.RandomHorizontalFlip()
+        return SeededCompose([
+            # SeededColorJitter(0.4, 0.4, 0.4, 0.00),
+            SeededRandomHorizontalFlip()
         ])
     elif args.dataset == 'Oxford-flowers-102':
-        return transforms.Compose([
-            # transforms.ColorJitter(0.4, 0.4, 0.4, 0.00),
-            transforms.RandomHorizontalFlip()
+        return SeededCompose([
+            # SeededColorJitter(0.4, 0.4, 0.4, 0.00),
+            SeededRandomHorizontalFlip()
         ])
     else:
         raise ValueError("Dataset {} unsupported. Exiting .... [NOT OK]".format(args.dataset))
@@ -2051,6 +2697,37 @@ def get_transforms_tensor(args):
         raise ValueError("Dataset {} unsupported. Exiting .... [NOT OK]".format(args.dataset))
 
 
+def get_train_transforms_batch(args):
+    """
+    Get the batched counterpart (BatchAugmenter) of get_train_transforms_img() followed by get_transforms_tensor(): it
+    augments and normalizes the collated uint8 batches of the train samples (see PhotoDataset(uint8_output=True)).
+
+    :param args: object. Contains the configuration of the exp that has been read from the yaml file.
+    :return: a BatchAugmenter() object.
+    """
+    if args.dataset == "glas":
+        return BatchAugmenter(0.5, 0.5, 0.5, 0.05, hflip=True, vflip=True,
+                              mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    elif args.dataset in ["Caltech-UCSD-Birds-200-2011", 'Oxford-flowers-102']:
+        return BatchAugmenter(hflip=True, mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    else:
+        raise ValueError("Dataset {} unsupported. Exiting .... [NOT OK]".format(args.dataset))
+
+
+def get_transforms_batch_tensor(args):
+    """
+    Get the batched counterpart (BatchAugmenter without augmentation) of get_transforms_tensor(): it converts into
+    float and normalizes the collated uint8 batches (see PhotoDataset(uint8_output=True)).
+
+    :param args: object. Contains the configuration of the exp that has been read from the yaml file.
+    :return: a BatchAugmenter() object.
+    """
+    if args.dataset in ["glas", "Caltech-UCSD-Birds-200-2011", 'Oxford-flowers-102']:
+        return BatchAugmenter(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    else:
+        raise ValueError("Dataset {} unsupported. Exiting .... [NOT OK]".format(args.dataset))
+
+
 # ===============
 # Multiprocessing
 # ===============
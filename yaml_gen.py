@@ -46,9 +46,83 @@ config = {
     # transforms.functional.pad
     "preload": True,  # If True, images are loaded and saved in RAM to avoid
     # disc access.
+    "store_dir": None,  # None or str. If str, a folder where the preloaded
+    # images/masks are decoded once into a memory-mapped file per fold,
+    # shared by all the dataloader workers and the experiments on the node.
+    # See loader.DecodedImageStore. e.g. "./tmp/stores".
+    "preload_workers": 8,  # int >= 0. number of workers used to decode the
+    # images/masks when preloading them. 0: sequential.
+    "preload_backend": "thread",  # str. `thread` or `process`. pool used to
+    # decode the images/masks when preloading them.
+    "batch_augment": False,  # If True, the train workers only decode/crop
+    # the samples into uint8. The augmentation (jittering, flips) and the
+    # normalization are done per batch on the device. See tools.BatchAugmenter.
+    "train_transport": "float",  # str. encoding of the training samples sent
+    # by the dataloader workers. `float`: float32 normalized images and
+    # masks. `uint8`: uint8 images and masks. `packed`: uint8 images and
+    # bit-packed masks. With `uint8`/`packed`, the samples are stacked in
+    # shared memory by the workers and converted/normalized per batch on the
+    # device. See loader.stack_collate().
+    "crop_first": False,  # If True, the random crop window of the training
+    # samples is drawn first, then, only the region of the image inside it is
+    # upscaled/padded (same crops, less work). See loader.PhotoDataset.
+    "eval_cache_mb": 0,  # float >= 0. size (MB) of the cache of the prepared
+    # evaluation samples (uint8 images, bit-packed masks) kept across the
+    # epochs. 0: no cache. See loader.EvalSampleCache.
     "batch_size": 8,  # the batch size for training.
-    "valid_batch_size": 1,  # the batch size for validation.
+    "valid_batch_size": 1,  # the batch size for validation. If > 1, the
+    # images are batched by buckets of similar sizes (see
+    # loader.BucketBatchSampler).
+    "valid_bucket_multiple": 1,  # int > 0. in validation, the sizes of the
+    # images are rounded up to a multiple of this value to form the buckets.
+    # The images of a batch are padded (bottom, right) to the same size.
+    # The mask of each image is normalized over its own valid region, and
+    # the wildcat poolings ignore the padding: the predictions of an image do
+    # not depend on the other images of its batch.
+    # 1: only the images with the same size are batched together (the
+    # predictions are the same as with a batch size of 1, up to the rounding
+    # of the batched convolutions). > 1: the padding still changes the
+    # features near the bottom/right borders of the smaller images (receptive
+    # field of the convolutions).
+    "tiled_inference": False,  # If True, in the final evaluation, the images
+    # larger than a tile are processed by overlapping tiles (the memory is
+    # bounded by the size of the tiles). See
+    # deepmil.tiled_inference.TiledInference.
+    "tile_size": 512,  # int > 0. size (height and width) of the tiles.
+    "tile_overlap": 64,  # int >= 0. overlap between two consecutive tiles.
+    "tile_blending": "hann",  # str. blending window of the overlapping tiles:
+    # `constant` (average of the tiles), `hann` (2D Hann window: less weight
+    # on the borders of the tiles).
     "num_workers": 8,  # number of workers for dataloader of the trainset.
+    "loader_backend": "process",  # str. `process`: torch DataLoader (forked
+    # workers). `thread`: in-process loader, the samples are prepared by
+    # `num_workers` threads (no fork, no pickling. Suited to small preloaded
+    # datasets). See loader.ThreadedDataLoader.
+    "prefetch_batches": 2,  # int > 0. number of batches prepared in advance
+    # by the `thread` loader backend.
+    "prefetch_device_batches": 0,  # int >= 0. number of batches kept ready
+    # on the device (pinned, transferred and decoded by a background thread
+    # while the current batch is processed) in training and evaluation. 0:
+    # the batches are transferred synchronously. See loader.BatchPrefetcher.
+    "persistent_workers": False,  # If True, the workers of the dataloaders
+    # are forked once and kept across the epochs. The per-sample seeds of
+    # each epoch are shared with them in memory. See
+    # loader.PersistentDataLoader.
+    "stage_timing": False,  # If True, the stages of the training and
+    # evaluation steps (data wait, transfer, segment, classify, loss,
+    # backward, ...) are timed, and their percentiles are written per epoch
+    # into OUTD/stage_timings.jsonl. The cuda device is synchronized at the
+    # boundaries of the stages. See tools.StageTimer.
+    "flush_stats_every": 0,  # int >= 0. the training losses are kept on the
+    # device, and copied into the stats every `flush_stats_every` steps (one
+    # synchronization per flush). 0: at the end of the epoch. See
+    # tools.DeviceAccumulator.
+    "profile_epoch": 0,  # int. epoch whose training and validation steps are
+    # profiled (torch.autograd.profiler). -1: the validation before the
+    # training. Chrome traces and tables of the operators are exported into
+    # OUTD/profiler. See tools.StepProfiler.
+    "profile_start_step": 5,  # int >= 0. first profiled step of the epoch.
+    "profile_nbr_steps": 0,  # int >= 0. number of profiled steps. 0: off.
     "max_epochs": 400,  # number of training epochs.
     # ######################### VISUALISATION OF REGIONS OF INTEREST #######
     "normalize": True,  # If True, maps are normalized using softmax.
@@ -120,6 +194,20 @@ config = {
         "alpha": 0.0,  # alpha. (wildcat)
         "dropout": 0.0,  # dropout over the kmin and kmax selected activations.
         # . (wildcat).
+        "batch_pos_neg": False,  # if True, X+ and X- are classified in one
+        # single pass through the classifier trunk (concatenated along the
+        # batch axis). The batch-norm layers still normalize them separately.
+        "lowres_mask": False,  # if True, in training, M+ is upsampled only
+        # to the input resolution of the classifier (scale_in_cl), and the
+        # masking and the size constraint are done at this resolution. The
+        # evaluation masks are at full resolution.
+        "fused_mask": False,  # if True, X+ and X- are computed and
+        # downscaled to the input resolution of the classifier in one fused
+        # operation, without the full resolution masked images (see
+        # deepmil.models.MaskDownscale).
+        "fold_heads": False,  # if True, in evaluation mode, the class-wise
+        # pooling of the wildcat heads is folded into their 1x1 conv. (one
+        # conv. to num_classes maps instead of num_classes * modalities).
         # ===============================  Segmentor ===========================
         "sigma": 0.15,  # simga for the thresholding (init. value).
         "delta_sigma": 0.001,  # how much to increase sigma each epoch.
@@ -137,7 +225,14 @@ config = {
     "mulcoef": 1.01,  # elb for size cons. over background.
     "normalize_sz": False,  # normalize or not the size of a background mask.
     "epsilon": 0.,  # elb for size cons. over background.
-    "lambda_neg": 1e-7  # lambda for the background loss.
+    "lambda_neg": 1e-7,  # lambda for the background loss.
+    "fused_loss": False,  # If True, the training loss is computed in one
+    # pass over the stacked scores (one log-softmax for both cross-entropies
+    # and the background loss). See deepmil.criteria.FusedTrainLoss.
+    "neg_every": 1,  # int >= 1. X- is classified (training) only every
+    # `neg_every` steps. The background loss is rescaled accordingly.
+    "neg_ratio": 1.  # float in ]0, 1]. ratio of the samples of the batch over
+    # which X- is classified (training) when it is classified.
 }
 
 